@@ -0,0 +1,70 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares chunk_file with the previous splitter-per-page implementation.
+
+    python -m benchmarks.bench_chunking --pages 1000
+"""
+import argparse
+import os
+import time
+
+from langchain.docstore.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from langchain_lab.core.chunking import chunk_file
+from langchain_lab.core.parsing import TxtFile
+
+LOREM = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.\n"
+
+
+def legacy_chunk_file(file, chunk_size, chunk_overlap, model_name="gpt-3.5-turbo"):
+    chunked_docs = []
+    for doc in file.docs:
+        text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            model_name=model_name,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+        for i, chunk in enumerate(text_splitter.split_text(doc.page_content)):
+            chunked_docs.append(Document(page_content=chunk, metadata={"page": doc.metadata.get("page", 1), "chunk": i + 1}))
+    return chunked_docs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--chunk-size", type=int, default=200)
+    parser.add_argument("--chunk-overlap", type=int, default=20)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    docs = [Document(page_content=f"Page {i}\n" + LOREM * 30, metadata={"page": i + 1}) for i in range(args.pages)]
+    file = TxtFile(name="bench.txt", id="bench", docs=docs)
+
+    start = time.perf_counter()
+    count = len(legacy_chunk_file(file, args.chunk_size, args.chunk_overlap))
+    baseline = time.perf_counter() - start
+    print(f"legacy            {baseline:.2f}s chunks={count}")
+
+    workers = 1
+    while workers <= args.max_workers:
+        start = time.perf_counter()
+        count = len(chunk_file(file, args.chunk_size, args.chunk_overlap, workers=workers))
+        elapsed = time.perf_counter() - start
+        print(f"registry workers={workers} {elapsed:.2f}s chunks={count} speedup={baseline / elapsed:.2f}x")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
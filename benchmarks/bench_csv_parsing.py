@@ -0,0 +1,76 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares the chunked CsvFile parser with the previous iterrows implementation.
+
+    python -m benchmarks.bench_csv_parsing --rows 10000 100000 1000000
+"""
+import argparse
+import io
+import json
+import time
+import tracemalloc
+
+import pandas as pd
+from langchain.docstore.document import Document
+
+from langchain_lab.core.parsing import CsvFile
+
+
+def make_csv(rows: int) -> bytes:
+    lines = ["id,name,city,comment"]
+    for i in range(rows):
+        lines.append(f"{i}, user{i} ,城市{i % 97},order {i} shipped to https://example.com/{i}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def legacy_parse(data: bytes):
+    text = data.decode("utf-8")
+    df = pd.read_csv(io.StringIO(text), dtype=str)
+    docs = []
+    for index, row in df.iterrows():
+        line = {}
+        for key in df.columns:
+            line[key] = row[key].strip()
+        docs.append(Document(page_content=json.dumps(line, ensure_ascii=False)))
+    return docs
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    docs = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024, len(docs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--rows-per-doc", type=int, default=1)
+    parser.add_argument("--legacy-max-rows", type=int, default=100_000, help="skip the slow legacy parser above this size")
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        data = make_csv(rows)
+        elapsed, peak, count = measure(CsvFile.parse, memoryview(data), args.rows_per_doc)
+        print(f"rows={rows} chunked {elapsed:.2f}s peak={peak:.0f}MB docs={count}")
+        if rows <= args.legacy_max_rows:
+            elapsed, peak, count = measure(legacy_parse, data)
+            print(f"rows={rows} legacy  {elapsed:.2f}s peak={peak:.0f}MB docs={count}")
+
+
+if __name__ == "__main__":
+    main()
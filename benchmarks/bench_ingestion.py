@@ -0,0 +1,102 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares the staged read_file -> chunk_file -> embed_docs ingestion with the
+streaming pipeline on a large text file, reporting the time until the first
+chunk is searchable, the total time and the peak of traced Python memory.
+
+    python -m benchmarks.bench_ingestion --megabytes 20 --latency 0.05
+
+Embedding uses a fake model that sleeps `latency` seconds per batch call, like
+a remote API or a local model would.
+"""
+import argparse
+import time
+import tracemalloc
+from io import BytesIO
+from typing import List
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.chunking import chunk_file
+from langchain_lab.core.embedding import embed_docs
+from langchain_lab.core.parsing import read_file
+from langchain_lab.core.pipeline import IngestProgress, ingest_files
+from langchain_lab.core.store import ChunkStore
+
+LOREM = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.\n"
+
+
+class SlowEmbedding(DeterministicFakeEmbedding):
+    latency: float = 0.05
+    batch_size: int = 64
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            end = start + self.batch_size
+            time.sleep(self.latency)
+            vectors.extend(super().embed_documents(texts[start:end]))
+        return vectors
+
+
+def make_upload(megabytes: float, title: str) -> BytesIO:
+    paragraph = LOREM * 8 + "\n"
+    # a different title per run, so no run reuses the token indexes cached for the file by another
+    upload = BytesIO((f"{title}\n\n" + paragraph * int(megabytes * 1024 * 1024 / len(paragraph))).encode("utf-8"))
+    upload.name = "large.txt"
+    return upload
+
+
+def staged(upload: BytesIO, embedding, chunk_size: int):
+    start = time.perf_counter()
+    store = chunk_file(read_file(upload), chunk_size, store=ChunkStore(), use_token_index=True)
+    folder_index = embed_docs(store, embedding, "faiss", index_type="flat")
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed, folder_index.index.index.ntotal
+
+
+def streaming(upload: BytesIO, embedding, chunk_size: int, batch_size: int):
+    start = time.perf_counter()
+    progress = IngestProgress()
+    first = None
+    for folder_index in ingest_files([upload], embedding, chunk_size, batch_size=batch_size, progress=progress, index_type="flat"):
+        first = first or time.perf_counter() - start
+    return first, time.perf_counter() - start, folder_index.index.index.ntotal
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=float, default=20)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--dim", type=int, default=1536)
+    args = parser.parse_args()
+
+    embedding = SlowEmbedding(size=args.dim, latency=args.latency, batch_size=args.batch_size)
+    print(f"file={args.megabytes}MB chunk_size={args.chunk_size} latency={args.latency}s/{args.batch_size} chunks dim={args.dim}")
+    print(f"{'ingestion':<10} {'chunks':>7} {'first (s)':>10} {'total (s)':>10} {'peak MB':>8}")
+    for name, run in (
+        ("staged", lambda: staged(make_upload(args.megabytes, "staged"), embedding, args.chunk_size)),
+        ("streaming", lambda: streaming(make_upload(args.megabytes, "streaming"), embedding, args.chunk_size, args.batch_size)),
+    ):
+        tracemalloc.start()
+        first, total, chunks = run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:<10} {chunks:>7} {first:>10.2f} {total:>10.2f} {peak / 1024 / 1024:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares SentenceTransformer.encode with fixed size batches against length
+bucketed batches on a CPU, over a shuffled mix of short CSV rows and long
+latin and Chinese chunks, reporting chunks per second and the share of padding tokens.
+
+    python -m benchmarks.bench_local_batching --model huggingface/moka-ai_m3e-base --short 0.7
+
+Without --model a randomly initialised MiniLM sized BERT is used.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.bench_local_encoding import WORDS, random_model
+from langchain_lab.core.local_encoding import BucketedEncoder, bucket_batches
+
+
+def make_corpus(count: int, short: float, short_words: int, long_words: int, cjk: float, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    characters = [chr(c) for c in range(0x4E00, 0x4E00 + 500)]
+    # short rows of short_words / 2 to 2 * short_words words, long chunks of long_words / 4 to long_words words
+    sizes = np.where(rng.random(count) < short, rng.integers(short_words // 2, short_words * 2 + 1, count), rng.integers(long_words // 4, long_words + 1, count))
+    # one token per CJK character, ordering by characters puts them with much shorter latin chunks
+    return ["".join(rng.choice(characters, size)) if rng.random() < cjk else " ".join(rng.choice(WORDS, size)) for size in sizes]
+
+
+def padded_tokens(lengths: np.ndarray, batches) -> int:
+    return int(sum(lengths[batch].max() * len(batch) for batch in batches))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--short", type=float, default=0.7, help="share of short chunks")
+    parser.add_argument("--short-words", type=int, default=8)
+    parser.add_argument("--long-words", type=int, default=400)
+    parser.add_argument("--cjk", type=float, default=0.3, help="share of Chinese chunks")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-batch-tokens", type=int, default=16384)
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(args.threads)
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.model is None:
+            random_model(tmp)
+        model = SentenceTransformer(args.model or tmp, device="cpu")
+    texts = make_corpus(args.chunks, args.short, args.short_words, args.long_words, args.cjk)
+    encoder = BucketedEncoder(model, max_batch_tokens=args.max_batch_tokens)
+    lengths = np.asarray(encoder.token_lengths(texts))
+    # encode sorts by characters, longest first, and cuts fixed size batches
+    order = np.argsort([-len(text) for text in texts], kind="stable")
+    fixed = np.array_split(order, range(args.batch_size, len(texts), args.batch_size))
+    bucketed = bucket_batches(lengths.tolist(), args.max_batch_tokens, encoder.max_batch_size)
+    model.encode(texts[:8])
+    print(f"model={args.model or 'random MiniLM'} chunks={args.chunks} short={args.short} cjk={args.cjk} threads={args.threads} tokens={int(lengths.sum())}")
+    print(f"{'batching':<10} {'batches':>7} {'padding':>8} {'chunks/s':>9}")
+
+    start = time.perf_counter()
+    model.encode(texts, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"{'fixed':<10} {len(fixed):>7} {1 - lengths.sum() / padded_tokens(lengths, fixed):>8.1%} {args.chunks / elapsed:>9.1f}")
+
+    start = time.perf_counter()
+    encoder.encode(texts)
+    elapsed = time.perf_counter() - start
+    print(f"{'bucketed':<10} {len(bucketed):>7} {1 - lengths.sum() / padded_tokens(lengths, bucketed):>8.1%} {args.chunks / elapsed:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
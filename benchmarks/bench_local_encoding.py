@@ -0,0 +1,92 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures local sentence-transformers encoding throughput in chunks per second
+for a single process and for an EncodingPool with a growing number of workers.
+
+    python -m benchmarks.bench_local_encoding --model huggingface/moka-ai_m3e-base --workers 1,2,4
+
+Without --model a randomly initialised MiniLM sized BERT is used, so the
+benchmark runs offline.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from langchain_lab.core.local_encoding import EncodingPool
+
+WORDS = "the service failed to start after upgrade error license key expired restart pick up new configuration index search vector".split()
+
+
+def random_model(path: str, hidden_size: int = 384, layers: int = 6):
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    vocab = os.path.join(path, "vocab.txt")
+    with open(vocab, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *WORDS]))
+    config = BertConfig(vocab_size=len(WORDS) + 5, hidden_size=hidden_size, num_hidden_layers=layers, num_attention_heads=12, intermediate_size=hidden_size * 4)
+    BertModel(config).save_pretrained(path)
+    BertTokenizerFast(vocab_file=vocab).save_pretrained(path)
+
+
+def make_chunks(count: int, words: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return [" ".join(rng.choice(WORDS, words)) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--words", type=int, default=120)
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--threads-per-worker", type=int, default=0)
+    parser.add_argument("--shard-size", type=int, default=64)
+    args = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model = args.model
+        if model is None:
+            model = tmp
+            random_model(model)
+        chunks = make_chunks(args.chunks, args.words)
+        print(f"model={args.model or 'random MiniLM'} chunks={args.chunks} words={args.words} cores={os.cpu_count()}")
+        print(f"{'workers':<8} {'threads':>7} {'chunks/s':>9}")
+
+        single = SentenceTransformer(model, device="cpu")
+        single.encode(chunks[:32])
+        start = time.perf_counter()
+        single.encode(chunks, batch_size=32)
+        print(f"{'single':<8} {'-':>7} {args.chunks / (time.perf_counter() - start):>9.1f}")
+        del single
+
+        for workers in [int(w) for w in args.workers.split(",")]:
+            pool = EncodingPool(model, workers=workers, threads_per_worker=args.threads_per_worker, shard_size=args.shard_size, model_kwargs={"device": "cpu"})
+            try:
+                # wait for every worker to load the model
+                pool.encode(chunks[: workers * args.shard_size])
+                start = time.perf_counter()
+                pool.encode(chunks)
+                elapsed = time.perf_counter() - start
+            finally:
+                pool.close()
+            print(f"{workers:<8} {pool.threads_per_worker:>7} {args.chunks / elapsed:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
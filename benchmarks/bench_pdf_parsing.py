@@ -0,0 +1,66 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures how PdfFile page extraction scales with the number of workers.
+
+    python -m benchmarks.bench_pdf_parsing --pages 1000
+"""
+import argparse
+import os
+import time
+from io import BytesIO
+
+import fitz
+
+from langchain_lab.core.parsing import PdfFile
+
+LOREM = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. "
+
+
+def make_pdf(pages: int) -> bytes:
+    pdf = fitz.open()
+    for i in range(pages):
+        page = pdf.new_page()
+        page.insert_textbox(fitz.Rect(36, 36, 560, 800), f"Page {i + 1}\n\n" + LOREM * 30, fontsize=9)
+    data = pdf.tobytes()
+    pdf.close()
+    return data
+
+
+def run(data: bytes, workers: int) -> float:
+    file = BytesIO(data)
+    file.name = "bench.pdf"
+    start = time.perf_counter()
+    PdfFile.from_bytes(file, workers=workers)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    data = make_pdf(args.pages)
+    print(f"pages={args.pages} size={len(data) / 1024 / 1024:.1f}MB")
+    baseline = run(data, 1)
+    print(f"workers=1 {baseline:.2f}s speedup=1.00x")
+    workers = 2
+    while workers <= args.max_workers:
+        elapsed = run(data, workers)
+        print(f"workers={workers} {elapsed:.2f}s speedup={baseline / elapsed:.2f}x")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
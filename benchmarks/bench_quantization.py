@@ -0,0 +1,88 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures recall@k and index memory of float16/int8 quantization, with and
+without full precision rescoring, against exact float32 search.
+
+    python -m benchmarks.bench_quantization --vectors 100000 --dim 1024
+"""
+import argparse
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.faiss_index import (
+    RescoringFAISS,
+    VectorFile,
+    create_faiss_index,
+)
+
+
+def make_vectors(count: int, dim: int, queries: int, seed: int = 0):
+    """Clustered unit vectors, roughly the shape of sentence embeddings"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(count // 100, 1), dim))
+    vectors = centers[rng.integers(0, len(centers), count)] + rng.normal(scale=0.5, size=(count, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    picked = rng.choice(count, queries, replace=False)
+    query_vectors = vectors[picked] + rng.normal(scale=0.02, size=(queries, dim))
+    return vectors.astype(np.float32), query_vectors.astype(np.float32)
+
+
+def recall(found: np.ndarray, expected: np.ndarray) -> float:
+    return float(np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, expected)]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rescore", type=int, default=4)
+    parser.add_argument("--index-type", default="flat")
+    args = parser.parse_args()
+
+    vectors, queries = make_vectors(args.vectors, args.dim, args.queries)
+    _, expected = create_faiss_index(vectors, "flat").search(queries, args.k)
+    ids = [str(i) for i in range(args.vectors)]
+    docstore = InMemoryDocstore({id: Document(page_content=id) for id in ids})
+    print(f"vectors={args.vectors} dim={args.dim} index={args.index_type} k={args.k}")
+    print(f"{'mode':<10} {'bytes/vector':>12} {'index MB':>9} {'recall':>7} {'recall rescored':>16}")
+    for quantization in ("none", "float16", "int8"):
+        index = create_faiss_index(vectors, args.index_type, quantization=quantization)
+        size = faiss.serialize_index(index).nbytes
+        _, found = index.search(queries, args.k)
+        rescored = "-"
+        if quantization != "none":
+            store = RescoringFAISS(
+                DeterministicFakeEmbedding(size=args.dim),
+                index,
+                docstore,
+                dict(enumerate(ids)),
+                vectors=VectorFile(args.dim),
+                vector_positions={},
+                rescore=args.rescore,
+            )
+            store.add_vectors(ids, vectors)
+            found_rescored = [[int(doc.page_content) for doc, _ in store.similarity_search_with_score_by_vector(query, k=args.k)] for query in queries]
+            rescored = f"{recall(np.array(found_rescored), expected):.4f}"
+        print(f"{quantization:<10} {size / args.vectors:>12.0f} {size / 1024 / 1024:>9.1f} {recall(found, expected):>7.4f} {rescored:>16}")
+    print(f"rescoring keeps {args.vectors * args.dim * 4 / 1024 / 1024:.1f}MB of float32 vectors in a memory-mapped file")
+
+
+if __name__ == "__main__":
+    main()
@@ -21,4 +21,7 @@ if "DEFAULT_AI_PLATFORM" not in os.environ:
 if "HUGGINGFACE_CATCH_PATH" not in os.environ:
     os.environ["HUGGINGFACE_CATCH_PATH"] = os.path.join(WORK_DIR, "huggingface")
 
+if "LANGCHAIN_LAB_CACHE_PATH" not in os.environ:
+    os.environ["LANGCHAIN_LAB_CACHE_PATH"] = os.path.join(WORK_DIR, "cache")
+
 from langchain_lab.scenarios.agents import *  # noqa: F401, E402, F403
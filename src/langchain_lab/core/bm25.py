@@ -0,0 +1,137 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import re
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# runs of CJK characters or latin words and numbers
+_TOKEN_PATTERN = re.compile(r"([぀-ヿ㐀-䶿一-鿿가-힯]+)|[^\W_]+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased words and numbers, CJK runs become overlapping character bigrams"""
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(text.lower()):
+        run = match.group(1)
+        if run is None:
+            tokens.append(match.group(0))
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i] + run[i + 1] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    """Okapi BM25 inverted index over integer document ids.
+
+    Postings are two int32 arrays per term (document ids and term
+    frequencies), appended to as documents are added. Ids are expected to be
+    dense, like ChunkStore rows, since document lengths are an array indexed
+    by id. Deleted documents are tombstoned and skipped when scoring.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._terms: Dict[str, int] = {}
+        self._doc_ids: List[array] = []
+        self._freqs: List[array] = []
+        # token count by id, -1 for ids never added and -2 for deleted ones
+        self._lengths = array("i")
+        self._count = 0
+        self._total_length = 0
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[Tuple[int, str]], **kwargs) -> "BM25Index":
+        index = cls(**kwargs)
+        for doc_id, text in texts:
+            index.add(doc_id, text)
+        return index
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, doc_id: int) -> bool:
+        return 0 <= doc_id < len(self._lengths) and self._lengths[doc_id] >= 0
+
+    def add(self, doc_id: int, text: str):
+        if doc_id < len(self._lengths) and self._lengths[doc_id] != -1:
+            raise ValueError(f"Document {doc_id} was already indexed")
+        if doc_id >= len(self._lengths):
+            self._lengths.extend([-1] * (doc_id + 1 - len(self._lengths)))
+        tokens = tokenize(text)
+        self._lengths[doc_id] = len(tokens)
+        self._count += 1
+        self._total_length += len(tokens)
+        for term, freq in Counter(tokens).items():
+            term_id = self._terms.get(term)
+            if term_id is None:
+                term_id = self._terms[term] = len(self._doc_ids)
+                self._doc_ids.append(array("i"))
+                self._freqs.append(array("i"))
+            self._doc_ids[term_id].append(doc_id)
+            self._freqs[term_id].append(freq)
+
+    def delete(self, doc_ids: Iterable[int]):
+        for doc_id in doc_ids:
+            if 0 <= doc_id < len(self._lengths) and self._lengths[doc_id] >= 0:
+                self._count -= 1
+                self._total_length -= self._lengths[doc_id]
+                self._lengths[doc_id] = -2
+
+    def search(self, query: str, k: int = 4, allowed: Optional[Sequence[int]] = None) -> List[Tuple[int, float]]:
+        """Returns up to k (doc_id, score) pairs, best first, optionally only among `allowed` ids"""
+        if not self._count:
+            return []
+        lengths = np.frombuffer(self._lengths, dtype=np.int32)
+        average_length = max(self._total_length / self._count, 1e-9)
+        scores = np.zeros(len(lengths), dtype=np.float64)
+        for term in set(tokenize(query)):
+            term_id = self._terms.get(term)
+            if term_id is None:
+                continue
+            doc_ids = np.frombuffer(self._doc_ids[term_id], dtype=np.int32)
+            freqs = np.frombuffer(self._freqs[term_id], dtype=np.int32).astype(np.float64)
+            doc_lengths = lengths[doc_ids]
+            live = doc_lengths >= 0
+            frequency = int(live.sum())
+            if not frequency:
+                continue
+            idf = math.log(1 + (self._count - frequency + 0.5) / (frequency + 0.5))
+            doc_ids, freqs, doc_lengths = doc_ids[live], freqs[live], doc_lengths[live]
+            scores[doc_ids] += idf * freqs * (self.k1 + 1) / (freqs + self.k1 * (1 - self.b + self.b * doc_lengths / average_length))
+        if allowed is not None:
+            mask = np.zeros(len(scores), dtype=bool)
+            allowed_ids = np.asarray(allowed, dtype=np.int64)
+            mask[allowed_ids[allowed_ids < len(scores)]] = True
+            scores[~mask] = 0.0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        order = sorted(candidates.tolist(), key=lambda doc_id: (-scores[doc_id], doc_id))
+        return [(doc_id, float(scores[doc_id])) for doc_id in order]
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[int]], k: int = 60) -> List[int]:
+    """Merges rankings of ids by the sum of 1 / (k + rank) over the rankings an id appears in"""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda id: (-scores[id], id))
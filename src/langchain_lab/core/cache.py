@@ -0,0 +1,374 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from hashlib import md5, sha1
+from typing import Any, Dict, FrozenSet, Hashable, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from langchain_lab import logger
+
+
+class ParseCache:
+    """On-disk LRU cache of parsed Documents keyed by content hash and parser version.
+
+    Each entry is a zlib compressed pickle of the file id, metadata and
+    (page_content, metadata) pairs. Entries are touched on every hit so the
+    file modification time doubles as the LRU clock.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(content_hash: str, parser: str, version: int, **options) -> str:
+        """Builds an entry key, parser options that change the output are part of it"""
+        key = f"{content_hash}-{parser}-v{version}"
+        if options:
+            key += "-" + md5(repr(sorted(options.items())).encode("utf-8")).hexdigest()[:8]
+        return key
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.bin")
+
+    def get(self, key: str) -> Optional[Tuple[str, dict[str, Any], List[Document]]]:
+        """Returns (id, metadata, docs) for a cached file or None on a miss"""
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, "rb") as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Dropping unreadable parse cache entry {key}: {e}")
+            self._remove(entry_path)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        docs = [Document(page_content=page_content, metadata=metadata) for page_content, metadata in entry["docs"]]
+        return entry["id"], entry["metadata"], docs
+
+    def put(self, key: str, id: str, metadata: dict[str, Any], docs: List[Document]):
+        entry = {
+            "id": id,
+            "metadata": metadata,
+            "docs": [(doc.page_content, doc.metadata) for doc in docs],
+        }
+        data = zlib.compress(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+        if len(data) > self.max_bytes:
+            return
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, entry_path)
+        self._evict()
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes"""
+        with self._lock:
+            entries = []
+            total = 0
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.endswith(".bin"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+            entries.sort()
+            for _, size, entry_path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(entry_path)
+                total -= size
+
+    @staticmethod
+    def _remove(entry_path: str):
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+
+_parse_cache: Optional[ParseCache] = None
+
+
+def get_parse_cache() -> ParseCache:
+    """Returns the process wide parse cache stored under LANGCHAIN_LAB_CACHE_PATH"""
+    global _parse_cache
+    if _parse_cache is None:
+        _parse_cache = ParseCache(
+            path=os.path.join(os.environ["LANGCHAIN_LAB_CACHE_PATH"], "parse"),
+            max_bytes=int(os.environ.get("LANGCHAIN_LAB_PARSE_CACHE_BYTES", 512 * 1024 * 1024)),
+        )
+    return _parse_cache
+
+
+class EmbeddingCache:
+    """On-disk LRU cache of embedding vectors keyed by namespace and text hash.
+
+    Vectors are stored as float16 blobs in a sqlite database, which halves the
+    footprint of float32 at a precision loss far below what nearest neighbour
+    search can notice. Every read refreshes the entry's last use time and the
+    least recently used entries are dropped once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS vectors_used ON vectors (used)")
+
+    @staticmethod
+    def key(namespace: str, text: str) -> str:
+        return f"{namespace}:{sha1(text.encode('utf-8')).hexdigest()}"
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Returns the cached float32 vectors of `keys`, missing keys are left out"""
+        found: Dict[str, np.ndarray] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            # stay below sqlite's limit on bound parameters
+            for start in range(0, len(unique), 500):
+                end = start + 500
+                batch = unique[start:end]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._db.execute(f"SELECT key, vector FROM vectors WHERE key IN ({placeholders})", batch).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float16).astype(np.float32)
+                if rows:
+                    now = time.time()
+                    self._db.executemany("UPDATE vectors SET used = ? WHERE key = ?", [(now, key) for key, _ in rows])
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype=np.float16).tobytes(), now) for key, vector in items.items()]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO vectors (key, vector, used) VALUES (?, ?, ?)", rows)
+        self._evict()
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes"""
+        with self._lock:
+            count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM vectors").fetchone()
+            if total <= self.max_bytes:
+                return
+            # drop a proportional share of entries in one statement, with some headroom
+            excess = int(count * (1 - self.max_bytes / total)) + 1
+            self._db.execute("DELETE FROM vectors WHERE key IN (SELECT key FROM vectors ORDER BY used LIMIT ?)", (excess,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that serves vectors from an EmbeddingCache.
+
+    `namespace` identifies the provider and model, so vectors of different
+    models never mix. Queries are cached apart from documents because some
+    models embed them differently.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, namespace: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.namespace = namespace
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.cache.key(f"{self.namespace}:doc", text) for text in texts]
+        found = self.cache.get_many(keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            # round trip through float16 so a vector is the same whether it came from the model or the cache
+            computed = {key: np.asarray(vector, dtype=np.float16).astype(np.float32) for key, vector in zip(missing, vectors)}
+            self.cache.put_many(computed)
+            found.update(computed)
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.cache.key(f"{self.namespace}:query", text)
+        found = self.cache.get_many([key])
+        if key in found:
+            return found[key].tolist()
+        vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float16).astype(np.float32)
+        self.cache.put_many({key: vector})
+        return vector.tolist()
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Returns the process wide embedding cache stored under LANGCHAIN_LAB_CACHE_PATH"""
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache(
+            path=os.path.join(os.environ["LANGCHAIN_LAB_CACHE_PATH"], "embeddings.sqlite"),
+            max_bytes=int(os.environ.get("LANGCHAIN_LAB_EMBEDDING_CACHE_BYTES", 1024 * 1024 * 1024)),
+        )
+    return _embedding_cache
+
+
+_IDENTIFIER_PATTERN = re.compile(r"\w*\d\w*")
+
+
+def identifiers(text: str) -> FrozenSet[str]:
+    """Tokens of a text that hold digits: years, versions, part numbers, error codes"""
+    return frozenset(_IDENTIFIER_PATTERN.findall(text.lower()))
+
+
+class AnswerCache:
+    """In-memory cache of answers looked up by the embedding of the question.
+
+    Entries are grouped by a hashable scope, e.g. a FolderIndex, the chain
+    that answered and the `identifiers` of the question, which embeddings
+    barely tell apart. A lookup returns the value cached for the most similar
+    question of the same scope when their cosine similarity reaches
+    `threshold`. At most `max_entries` are kept, the least recently used are
+    evicted first, and entries expire `ttl` seconds after they were added.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 24 * 3600, threshold: float = 0.98):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._next_id = 0
+        # entry id -> (scope, unit vector, value, created) in LRU order
+        self._entries: OrderedDict[int, Tuple[Hashable, np.ndarray, Any, float]] = OrderedDict()
+        self._scopes: Dict[Hashable, List[int]] = {}
+
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, scope: Hashable, vector: List[float], threshold: Optional[float] = None) -> Optional[Any]:
+        """Returns the value cached for the most similar question of `scope`, None on a miss"""
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            self._expire()
+            ids = self._scopes.get(scope, [])
+            if ids:
+                similarities = np.stack([self._entries[id][1] for id in ids]) @ self._unit(vector)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= threshold:
+                    self.hits += 1
+                    self._entries.move_to_end(ids[best])
+                    return self._entries[ids[best]][2]
+            self.misses += 1
+            return None
+
+    def put(self, scope: Hashable, vector: List[float], value: Any):
+        with self._lock:
+            id = self._next_id
+            self._next_id += 1
+            self._entries[id] = (scope, self._unit(vector), value, time.monotonic())
+            self._scopes.setdefault(scope, []).append(id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        # insertion order is not LRU order, so every entry is checked
+        for id in [id for id, (_, _, _, created) in self._entries.items() if created < deadline]:
+            self._remove(id)
+
+    def _remove(self, id: int):
+        scope = self._entries.pop(id)[0]
+        ids = self._scopes[scope]
+        ids.remove(id)
+        if not ids:
+            del self._scopes[scope]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "entries": len(self)}
+
+
+_answer_cache: Optional[AnswerCache] = None
+
+
+def get_answer_cache() -> AnswerCache:
+    """Returns the process wide answer cache, shared by every session"""
+    global _answer_cache
+    if _answer_cache is None:
+        _answer_cache = AnswerCache(
+            max_entries=int(os.environ.get("LANGCHAIN_LAB_ANSWER_CACHE_ENTRIES", 1024)),
+            ttl=float(os.environ.get("LANGCHAIN_LAB_ANSWER_CACHE_TTL", 24 * 3600)),
+            threshold=float(os.environ.get("LANGCHAIN_LAB_ANSWER_CACHE_THRESHOLD", 0.98)),
+        )
+    return _answer_cache
@@ -11,67 +11,259 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
+import threading
 from abc import ABC
-from typing import List
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain, islice
+from typing import Hashable, Iterable, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
+import tiktoken
 from langchain.docstore.document import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-from src.langchain_lab.core.parsing import File
+from langchain_lab.core.parsing import File, process_pool
+from langchain_lab.core.store import ChunkStore
+
+# files with fewer pages than this are chunked serially
+CHUNK_PARALLEL_MIN_PAGES = 64
+# pages sent to a chunking worker per task
+CHUNK_PARALLEL_PAGES_PER_TASK = 16
+
+
+@lru_cache(maxsize=16)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """Returns the process wide tiktoken encoding of a model"""
+    return tiktoken.encoding_for_model(model_name)
+
+
+@lru_cache(maxsize=64)
+def get_splitter(model_name: str, chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+    """Returns the process wide splitter for (model_name, chunk_size, chunk_overlap)"""
+    get_encoding(model_name)
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        model_name=model_name,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+
+
+def _split_texts(texts: List[str], model_name: str, chunk_size: int, chunk_overlap: int) -> List[List[str]]:
+    splitter = get_splitter(model_name, chunk_size, chunk_overlap)
+    return [splitter.split_text(text) for text in texts]
+
+
+def split_pages(
+    docs: Iterable[Document],
+    chunk_size: int,
+    chunk_overlap: int = 0,
+    model_name="gpt-3.5-turbo",
+    workers: int = 1,
+    token_index_key: Optional[Hashable] = None,
+) -> Iterator[Tuple[int, List[str]]]:
+    """Splits each document and yields (page, chunks) in document order
+
+    With more than one worker the documents are sent in batches to a process
+    pool, at most two batches per worker are in flight and results are yielded
+    in submission order so chunk numbering does not depend on scheduling.
+    With a `token_index_key` (e.g. the file id) each document is tokenised once
+    into a cached TokenIndex and later splits with other sizes only slice it.
+    """
+    if token_index_key is not None:
+        for i, doc in enumerate(docs):
+            index = token_index_cache.get((token_index_key, i), doc.page_content, model_name)
+            yield doc.metadata.get("page", 1), index.chunks(chunk_size, chunk_overlap)
+        return
+
+    if workers <= 1:
+        splitter = get_splitter(model_name, chunk_size, chunk_overlap)
+        for doc in docs:
+            yield doc.metadata.get("page", 1), splitter.split_text(doc.page_content)
+        return
+
+    docs = iter(docs)
+    with process_pool(workers) as executor:
+        pending = []
+        while True:
+            batch = list(islice(docs, CHUNK_PARALLEL_PAGES_PER_TASK))
+            if batch:
+                pages = [doc.metadata.get("page", 1) for doc in batch]
+                texts = [doc.page_content for doc in batch]
+                pending.append((pages, executor.submit(_split_texts, texts, model_name, chunk_size, chunk_overlap)))
+            if pending and (not batch or len(pending) >= workers * 2):
+                pages, future = pending.pop(0)
+                yield from zip(pages, future.result())
+            if not batch and not pending:
+                break
+
+
+# preference of cutting a chunk right after these characters, higher is better
+_BOUNDARY_SCORES = {"\n": 3, ".": 2, "!": 2, "?": 2, "。": 2, "！": 2, "？": 2, "；": 1, ";": 1, "，": 1, ",": 1, " ": 1, "\t": 1}
+
+
+class TokenIndex:
+    """Token offsets of a text, computed once, to re-chunk it for any size without re-encoding
+
+    `offsets[i]` is the character offset where token i starts (the last entry
+    is the text length) and `scores[i]` how good a cut before token i is.
+    """
+
+    def __init__(self, text: str, offsets: np.ndarray, scores: np.ndarray):
+        self.text = text
+        self.offsets = offsets
+        self.scores = scores
+
+    @classmethod
+    def from_text(cls, text: str, model_name: str = "gpt-3.5-turbo") -> "TokenIndex":
+        encoding = get_encoding(model_name)
+        tokens = encoding.encode(text, allowed_special=set(), disallowed_special=())
+        _, starts = encoding.decode_with_offsets(tokens)
+        dtype = np.int32 if len(text) < np.iinfo(np.int32).max else np.int64
+        offsets = np.fromiter(starts, dtype=dtype, count=len(starts))
+        offsets = np.append(offsets, np.array([len(text)], dtype=dtype))
+        scores = np.zeros(len(offsets), dtype=np.int8)
+        previous = -1
+        for i, offset in enumerate(starts):
+            if offset > 0 and offset != previous:
+                score = _BOUNDARY_SCORES.get(text[offset - 1], 0)
+                # paragraph breaks beat line breaks
+                scores[i] = score + 1 if score == 3 and offset > 1 and text[offset - 2] == "\n" else score
+            previous = offset
+        return cls(text, offsets, scores)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def windows(self, chunk_size: int, chunk_overlap: int = 0) -> List[Tuple[int, int]]:
+        """Returns the (start, end) token ranges of at most chunk_size tokens
+
+        Each window ends at the best boundary in its second half, consecutive
+        windows share chunk_overlap tokens but at most half of the earlier window.
+        """
+        count = len(self)
+        chunk_size = max(1, chunk_size)
+        windows = []
+        start = 0
+        while start < count:
+            end = min(start + chunk_size, count)
+            if end < count:
+                lowest = start + max(1, chunk_size // 2)
+                stop = end + 1
+                candidates = self.scores[lowest:stop]
+                if len(candidates) and candidates.max() > 0:
+                    # last position holding the best score
+                    end = lowest + len(candidates) - 1 - int(np.argmax(candidates[::-1]))
+            windows.append((start, end))
+            if end >= count:
+                break
+            # boundary snapping may shorten a window to half its size, never step back by more than half of it
+            start += max(1, end - start - chunk_overlap, (end - start) // 2)
+        return windows
+
+    def chunks(self, chunk_size: int, chunk_overlap: int = 0) -> List[str]:
+        chunks = []
+        for start, end in self.windows(chunk_size, chunk_overlap):
+            begin, finish = self.offsets[start], self.offsets[end]
+            chunk = self.text[begin:finish].strip()
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+
+class TokenIndexCache:
+    """LRU cache of TokenIndex instances bounded by their total number of tokens"""
+
+    def __init__(self, max_tokens: int = 50_000_000):
+        self.max_tokens = max_tokens
+        self._indexes: OrderedDict[Hashable, TokenIndex] = OrderedDict()
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, text: str, model_name: str = "gpt-3.5-turbo") -> TokenIndex:
+        key = (key, model_name)
+        with self._lock:
+            if key in self._indexes:
+                self._indexes.move_to_end(key)
+                return self._indexes[key]
+        index = TokenIndex.from_text(text, model_name)
+        with self._lock:
+            if key not in self._indexes:
+                self._indexes[key] = index
+                self._tokens += len(index)
+            while self._tokens > self.max_tokens and len(self._indexes) > 1:
+                _, evicted = self._indexes.popitem(last=False)
+                self._tokens -= len(evicted)
+        return index
+
+
+token_index_cache = TokenIndexCache()
 
 
 class Chunking(ABC):
     def __init__(self, chunk_size: int, chunk_overlap: int = 0, model_name="gpt-3.5-turbo"):
-        self.splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            model_name=model_name,
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-        )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.model_name = model_name
+        self.splitter = get_splitter(model_name, chunk_size, chunk_overlap)
 
     def chunk(self, file: File):
-        chunked_docs = []
-        for doc in file.docs:
-            chunks = self.splitter.split_text(doc.page_content)
-            for i, chunk in enumerate(chunks):
-                doc = Document(
-                    page_content=chunk,
-                    metadata={
-                        "page": doc.metadata.get("page", 1),
-                        "chunk": i + 1,
-                        "source": f"{doc.metadata.get('page', 1)}-{i + 1}",
-                    },
-                )
-                chunked_docs.append(doc)
         chunked_file = file.copy()
-        chunked_file.docs = chunked_docs
+        chunked_file.docs = chunk_file(file, self.chunk_size, self.chunk_overlap, self.model_name)
         return chunked_file
 
 
-def chunk_file(file: File, chunk_size: int, chunk_overlap: int = 0, model_name="gpt-3.5-turbo") -> List[Document]:
+def chunk_file(
+    file: File,
+    chunk_size: int,
+    chunk_overlap: int = 0,
+    model_name="gpt-3.5-turbo",
+    store: Optional[ChunkStore] = None,
+    source_prefix: str = "",
+    workers: Optional[int] = None,
+    use_token_index: bool = False,
+) -> Union[List[Document], ChunkStore]:
     """Chunks each document in a file into smaller documents
     according to the specified chunk size and overlap
     where the size is determined by the number of token for the specified model.
+
+    When a ChunkStore is given the chunks are appended to it, tagged with the
+    file name and id, and the store is returned instead of a list of Documents.
+    Files with many pages are split on `workers` processes (default: the
+    number of cpus), pass 1 to force serial chunking.
+    With `use_token_index` chunks are cut from a cached per document TokenIndex,
+    so re-chunking the same file with another size or overlap does not re-encode it.
     """
 
-    # split each document into chunks
-    chunked_docs = []
-    for doc in file.docs:
-        text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            model_name=model_name,
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-        )
+    workers = workers or os.cpu_count() or 1
+    docs = file.iter_docs()
+    if workers > 1 and file.is_lazy:
+        # peek at the pages of a lazy file, so a short one does not start a process pool
+        head = list(islice(docs, CHUNK_PARALLEL_MIN_PAGES))
+        if len(head) < CHUNK_PARALLEL_MIN_PAGES:
+            workers = 1
+        docs = chain(head, docs)
+    elif workers > 1 and len(file.docs) < CHUNK_PARALLEL_MIN_PAGES:
+        workers = 1
 
-        chunks = text_splitter.split_text(doc.page_content)
+    file_index = store.add_file(file.name, file.id, source_prefix) if store is not None else -1
 
+    # split each document into chunks
+    chunked_docs = []
+    token_index_key = file.id if use_token_index else None
+    for page, chunks in split_pages(docs, chunk_size, chunk_overlap, model_name, workers, token_index_key):
         for i, chunk in enumerate(chunks):
+            if store is not None:
+                store.append(chunk, page=page, chunk=i + 1, file_index=file_index)
+                continue
             doc = Document(
                 page_content=chunk,
                 metadata={
-                    "page": doc.metadata.get("page", 1),
+                    "page": page,
                     "chunk": i + 1,
-                    "source": f"{doc.metadata.get('page', 1)}-{i + 1}",
+                    "source": f"{source_prefix}{page}-{i + 1}",
                 },
             )
             chunked_docs.append(doc)
-    return chunked_docs
+    return store if store is not None else chunked_docs
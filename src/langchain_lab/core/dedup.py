@@ -0,0 +1,135 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+from collections import defaultdict
+from hashlib import blake2b
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain.docstore.document import Document
+
+# latin words or single CJK characters
+_TOKEN_PATTERN = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]|[^\W_]+", re.UNICODE)
+_BITS = np.arange(64, dtype=np.uint64)
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """64 bit SimHash of the token shingles of a text"""
+    return _simhash(_tokenize(text), shingle_size)
+
+
+def _simhash(tokens: List[str], shingle_size: int) -> int:
+    if len(tokens) <= shingle_size:
+        shingles = [" ".join(tokens)]
+    else:
+        shingles = [" ".join(window) for window in zip(*(tokens[offset:] for offset in range(shingle_size)))]
+    hashes = np.fromiter((_hash64(shingle) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    bits = (hashes[:, None] >> _BITS) & np.uint64(1)
+    # a bit is set when most shingles have it set
+    votes = bits.sum(axis=0) * 2 > len(shingles)
+    return int(np.packbits(votes[::-1]).view(">u8")[0])
+
+
+class DedupResult:
+    """Rows to keep and where every dropped duplicate went"""
+
+    keep: List[int]
+    duplicates: Dict[int, int]
+
+    def __init__(self, keep: List[int], duplicates: Dict[int, int]):
+        self.keep = keep
+        self.duplicates = duplicates
+
+    @property
+    def removed(self) -> int:
+        return len(self.duplicates)
+
+
+def same_record(tokens: Sequence[str], other: Sequence[str], min_jaccard: float = 0.9) -> bool:
+    """Whether two near-identical token lists hold the same record: the same
+    tokens with digits (part numbers, error codes, dates) and token sets with
+    a Jaccard similarity of at least `min_jaccard`
+    """
+    words, other_words = set(tokens), set(other)
+    if {word for word in words if any(c.isdigit() for c in word)} != {word for word in other_words if any(c.isdigit() for c in word)}:
+        return False
+    return len(words & other_words) >= min_jaccard * len(words | other_words)
+
+
+class Deduplicator:
+    """Finds identical and near-identical chunks (SimHash within `max_distance` bits)
+    one chunk at a time, so chunks can be checked as they are produced.
+
+    Candidates are found with LSH over `bands` equal slices of the fingerprint,
+    by the pigeonhole principle two fingerprints within `max_distance < bands`
+    bits share at least one slice. A candidate is only a duplicate when
+    `same_record` confirms it, so records that differ in an identifier such as
+    a part number or an error code are both kept. The first occurrence of a
+    chunk is kept.
+    """
+
+    def __init__(self, max_distance: int = 3, bands: int = 4, min_jaccard: float = 0.9):
+        self.max_distance = max_distance
+        self.min_jaccard = min_jaccard
+        self.bands = bands
+        self._band_bits = 64 // bands
+        self._band_mask = (1 << self._band_bits) - 1
+        self._exact: Dict[str, int] = {}
+        self._buckets: Dict[tuple[int, int], List[int]] = defaultdict(list)
+        self._fingerprints: Dict[int, int] = {}
+        # normalized text of every kept row, the same strings as the keys of _exact
+        self._texts: Dict[int, str] = {}
+
+    def add(self, row: int, text: str) -> Optional[int]:
+        """Returns the row of the kept chunk `text` duplicates, None when the chunk is kept"""
+        normalized = " ".join(text.split()).lower()
+        if normalized in self._exact:
+            return self._exact[normalized]
+        tokens = _tokenize(normalized)
+        fingerprint = _simhash(tokens, 3)
+        keys = [(band, (fingerprint >> (band * self._band_bits)) & self._band_mask) for band in range(self.bands)]
+        candidates = dict.fromkeys(
+            candidate for key in keys for candidate in self._buckets.get(key, ()) if (fingerprint ^ self._fingerprints[candidate]).bit_count() <= self.max_distance
+        )
+        for candidate in candidates:
+            if same_record(tokens, _tokenize(self._texts[candidate]), self.min_jaccard):
+                return candidate
+        self._exact[normalized] = row
+        self._fingerprints[row] = fingerprint
+        self._texts[row] = normalized
+        for key in keys:
+            self._buckets[key].append(row)
+        return None
+
+
+def deduplicate(docs: Sequence[Document], max_distance: int = 3, bands: int = 4, min_jaccard: float = 0.9) -> DedupResult:
+    """Finds identical and near-identical chunks of a collection (see `Deduplicator`)"""
+    deduplicator = Deduplicator(max_distance=max_distance, bands=bands, min_jaccard=min_jaccard)
+    keep: List[int] = []
+    duplicates: Dict[int, int] = {}
+    for row, doc in enumerate(docs):
+        original = deduplicator.add(row, doc.page_content)
+        if original is None:
+            keep.append(row)
+        else:
+            duplicates[row] = original
+    return DedupResult(keep=keep, duplicates=duplicates)
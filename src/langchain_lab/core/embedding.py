@@ -11,53 +11,573 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import os
-from typing import List, Type
+import pickle
+import shutil
+import threading
+import uuid
+from hashlib import md5
+from typing import Dict, Iterable, List, Optional, Sequence, Type, Union
 
+import numpy as np
 import streamlit as st
 from langchain.docstore.document import Document
 from langchain.embeddings.base import Embeddings
 from langchain.vectorstores import VectorStore
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.embeddings import HuggingFaceEmbeddings, OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+from langchain_community.vectorstores.utils import DistanceStrategy
 
 from langchain_lab import logger
+from langchain_lab.core.bm25 import BM25Index, reciprocal_rank_fusion
+from langchain_lab.core.cache import CachedEmbeddings, get_embedding_cache
+from langchain_lab.core.dedup import deduplicate
+from langchain_lab.core.faiss_index import (
+    RescoringFAISS,
+    VectorFile,
+    create_faiss_index,
+    delete_vectors,
+    ensure_writable,
+    filtered_search,
+)
+from langchain_lab.core.local_encoding import BucketedEncoder, EncodingPool, pool_size
+from langchain_lab.core.scheduler import EmbeddingScheduler
+from langchain_lab.core.store import ChunkStore, ChunkStoreDocstore
 
 
 class FolderIndex:
-    """Index for a collection of files (a folder)"""
+    """Index for a collection of files (a folder)
 
-    def __init__(self, docs: List[Document], index: VectorStore):
+    `docs` holds every chunk while the vector index may only hold a subset of
+    them, `duplicates` maps the source of each chunk left out as a duplicate to
+    the source of the chunk that represents it in the index.
+
+    Chunks are identified by their source, `add_documents` and `delete` update
+    `docs`, the vector index and the BM25 keyword index together.
+    """
+
+    def __init__(self, docs: Union[List[Document], ChunkStore], index: VectorStore, duplicates: Optional[Dict[str, str]] = None):
         self.name: str = "default"
+        # identity and a counter bumped on every change of the chunks, for caches of answers from this index
+        self.uid = uuid.uuid4().hex
+        self.generation = 0
         self.docs = docs
         self.index: VectorStore = index
+        # source of each kept chunk -> sources of the duplicates it represents, rebuilt on first use after `duplicates` changes
+        self._represented: Optional[Dict[str, List[str]]] = None
+        self._represented_count = 0
+        self.duplicates = duplicates or {}
+        # source -> position in docs, built here and kept up to date by every change so cited sources resolve
+        # in constant time, and source -> vector store id, built on first use
+        self._positions: Optional[Dict[str, int]] = None
+        self._vector_ids: Optional[Dict[str, str]] = None
+        # file of every vector in index order as codes into _file_codes, built on first filtered search
+        self._vector_files: Optional[np.ndarray] = None
+        self._file_codes: Dict[Optional[str], int] = {}
+        # BM25 over the text of the embedded chunks by position in docs, built on first use
+        self._keywords: Optional[BM25Index] = None
+        self._source_positions()
 
     @classmethod
-    def from_docs(cls, docs: List[Document], embeddings: Embeddings, vector_store: Type[VectorStore]) -> "FolderIndex":
+    def from_docs(
+        cls,
+        docs: Union[List[Document], ChunkStore],
+        embeddings: Embeddings,
+        vector_store: Type[VectorStore],
+        rows: Optional[List[int]] = None,
+        **index_options,
+    ) -> "FolderIndex":
+        """Builds the index, embedding only the docs at `rows` when given.
+
+        `index_options` are passed to `create_faiss_index` for FAISS.
+        """
+        if vector_store is FAISS:
+            if isinstance(docs, ChunkStore):
+                return cls(docs=docs, index=faiss_from_store(docs, embeddings, rows, **index_options))
+            return cls(docs=docs, index=faiss_from_documents(docs if rows is None else [docs[row] for row in rows], embeddings, **index_options))
         index = vector_store.from_documents(
-            documents=docs,
+            documents=docs if rows is None else [docs[row] for row in rows],
             embedding=embeddings,
         )
         return cls(docs=docs, index=index)
 
+    @property
+    def duplicates(self) -> Dict[str, str]:
+        return self._duplicates
+
+    @duplicates.setter
+    def duplicates(self, duplicates: Dict[str, str]):
+        self._duplicates = duplicates
+        self._represented = None
+
+    def duplicates_of(self, source: str) -> List[str]:
+        """Sources of the chunks left out as duplicates of the chunk at `source`"""
+        # the streaming pipeline adds duplicates in place, a change in size means the map is stale
+        if self._represented is None or self._represented_count != len(self._duplicates):
+            represented: Dict[str, List[str]] = {}
+            items = list(self._duplicates.items())
+            for dropped, kept in items:
+                represented.setdefault(kept, []).append(dropped)
+            self._represented, self._represented_count = represented, len(items)
+        return self._represented.get(source, [])
+
+    def find_sources(self, sources: Iterable[str]) -> List[Document]:
+        """Chunks with the given sources in `docs` order, unknown sources are skipped"""
+        positions = self._source_positions()
+        found = {positions[source] for source in sources if source in positions}
+        return [self._document(position) for position in sorted(found)]
+
+    def _text(self, position: int) -> str:
+        if isinstance(self.docs, ChunkStore):
+            return self.docs.text(position)
+        return self.docs[position].page_content
+
+    def _source_positions(self) -> Dict[str, int]:
+        if self._positions is None:
+            if isinstance(self.docs, ChunkStore):
+                self._positions = {self.docs.source(row): row for row in self.docs.rows()}
+            else:
+                self._positions = {doc.metadata.get("source"): position for position, doc in enumerate(self.docs)}
+        return self._positions
+
+    def _source_vector_ids(self) -> Dict[str, str]:
+        if self._vector_ids is None:
+            if not isinstance(self.index, FAISS):
+                raise NotImplementedError(f"Incremental updates are not supported for {type(self.index).__name__}")
+            if isinstance(self.docs, ChunkStore):
+                self._vector_ids = {self.docs.source(int(id)): id for id in self.index.index_to_docstore_id.values()}
+            else:
+                self._vector_ids = {self.index.docstore.search(id).metadata.get("source"): id for id in self.index.index_to_docstore_id.values()}
+        return self._vector_ids
+
+    def keyword_index(self) -> BM25Index:
+        """BM25 index over every chunk in `docs`, keyed by position in `docs`.
+
+        Chunks left out of the vector index as duplicates are indexed too, so
+        the identifiers that tell them apart from their representative can
+        still be found by keyword.
+        """
+        if self._keywords is None:
+            self._keywords = BM25Index.from_texts((position, self._text(position)) for position in sorted(self._source_positions().values()))
+        return self._keywords
+
+    def _document(self, position: int) -> Document:
+        if isinstance(self.docs, ChunkStore):
+            return self.docs.document(position)
+        return self.docs[position]
+
+    def add_documents(self, docs: Iterable[Document]) -> List[str]:
+        """Adds chunks or replaces the chunks with the same source.
+
+        Only chunks that are new or whose text changed are embedded, returns their sources.
+        """
+        positions = self._source_positions()
+        changed: Dict[str, Document] = {}
+        for doc in docs:
+            source = doc.metadata.get("source")
+            position = positions.get(source)
+            if position is not None and source not in changed and self._text(position) == doc.page_content:
+                continue
+            changed[source] = doc
+        if not changed:
+            return []
+        self._ensure_writable()
+        self.delete([source for source in changed if source in positions])
+
+        vector_ids = self._source_vector_ids()
+        positions = self._source_positions()
+        documents = list(changed.values())
+        if isinstance(self.docs, ChunkStore):
+            # the ChunkStoreDocstore appends each document as the next row
+            ids = [str(len(self.docs) + i) for i in range(len(documents))]
+        else:
+            ids = [str(uuid.uuid4()) for _ in documents]
+        self.index.add_documents(documents, ids=ids)
+        for source, doc, id in zip(changed, documents, ids):
+            if isinstance(self.docs, ChunkStore):
+                positions[source] = int(id)
+            else:
+                positions[source] = len(self.docs)
+                self.docs.append(doc)
+            vector_ids[source] = id
+            if self._keywords is not None:
+                self._keywords.add(positions[source], doc.page_content)
+        self._vector_files = None
+        self.generation += 1
+        return list(changed)
+
+    def delete(self, sources: Iterable[str]) -> List[str]:
+        """Removes chunks by source from `docs` and the vector index, returns the sources that were found.
+
+        Duplicates represented by a deleted chunk are embedded in its place.
+        """
+        positions = self._source_positions()
+        vector_ids = self._source_vector_ids()
+        found = [source for source in dict.fromkeys(sources) if source in positions]
+        if not found:
+            return []
+        ids = [vector_ids[source] for source in found if source in vector_ids]
+        if ids:
+            self._ensure_writable()
+            if isinstance(self.index, RescoringFAISS):
+                self.index.delete(ids)
+            else:
+                delete_vectors(self.index, ids)
+            self._vector_files = None
+        for source in found:
+            vector_ids.pop(source, None)
+
+        deleted = set(found)
+        if isinstance(self.docs, ChunkStore):
+            rows = [positions.pop(source) for source in found]
+            self.docs.delete(rows)
+            if self._keywords is not None:
+                self._keywords.delete(rows)
+        else:
+            self.docs = [doc for doc in self.docs if doc.metadata.get("source") not in deleted]
+            # positions shift, both are rebuilt on next use
+            self._positions = None
+            self._keywords = None
+
+        orphans = [dropped for dropped, kept in self.duplicates.items() if kept in deleted and dropped not in deleted]
+        self.duplicates = {dropped: kept for dropped, kept in self.duplicates.items() if dropped not in deleted and kept not in deleted}
+        if orphans:
+            self._embed_orphans(orphans)
+        self.generation += 1
+        return found
+
+    def _embed_orphans(self, orphans: List[str]):
+        """Indexes duplicates whose representative was deleted, once per distinct text"""
+        positions = self._source_positions()
+        vector_ids = self._source_vector_ids()
+        representatives: Dict[str, str] = {}
+        for source in orphans:
+            text = self._text(positions[source])
+            if text in representatives:
+                self.duplicates[source] = representatives[text]
+            else:
+                representatives[text] = source
+        sources = list(representatives.values())
+        texts = list(representatives)
+        vectors = self.index.embeddings.embed_documents(texts)
+        if isinstance(self.docs, ChunkStore):
+            # the rows are already in the store, only their vectors are added
+            self.add_rows([positions[source] for source in sources], np.asarray(vectors, dtype=np.float32))
+            return
+        ids = [str(uuid.uuid4()) for _ in sources]
+        metadatas = [self.docs[positions[source]].metadata for source in sources]
+        self.index.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+        vector_ids.update(zip(sources, ids))
+        self._vector_files = None
+
+    def add_rows(self, rows: List[int], vectors: np.ndarray):
+        """Indexes chunks that are already in the ChunkStore with their precomputed vectors"""
+        ids = [str(row) for row in rows]
+        self._ensure_writable()
+        self.index.index.add(vectors)
+        start = len(self.index.index_to_docstore_id)
+        self.index.index_to_docstore_id.update({start + i: id for i, id in enumerate(ids)})
+        if isinstance(self.index, RescoringFAISS):
+            self.index.add_vectors(ids, vectors)
+        for row, id in zip(rows, ids):
+            source = self.docs.source(row)
+            if self._positions is not None:
+                self._positions[source] = row
+            if self._vector_ids is not None:
+                self._vector_ids[source] = id
+            # duplicates are already in the keyword index
+            if self._keywords is not None and row not in self._keywords:
+                self._keywords.add(row, self.docs.text(row))
+        self._vector_files = None
+        self.generation += 1
+
+    def _ensure_writable(self):
+        """Copies a memory-mapped FAISS index into memory before its first change"""
+        if isinstance(self.index, FAISS):
+            ensure_writable(self.index.index)
+
+    def _file_id(self, docstore_id: str) -> Optional[str]:
+        if isinstance(self.docs, ChunkStore):
+            return self.docs.file_id(int(docstore_id))
+        return self.index.docstore.search(docstore_id).metadata.get("file_id")
+
+    def files(self) -> Dict[str, str]:
+        """file_id -> file_name of the files in the index"""
+        if isinstance(self.docs, ChunkStore):
+            return self.docs.files()
+        return {doc.metadata["file_id"]: doc.metadata.get("file_name", "") for doc in self.docs if "file_id" in doc.metadata}
+
+    def add_files(self, docs: Iterable[Document]) -> List[str]:
+        """Adds the chunks of files that are not in the index yet, returns the ids of the added files.
+
+        Sources are renumbered with the position of the file in the index, so
+        they stay unique however many uploads the index collects.
+        """
+        added = number_files(docs, self.files())
+        self.add_documents(added)
+        return list(dict.fromkeys(doc.metadata["file_id"] for doc in added))
+
+    def _file_vector_positions(self, file_ids: Iterable[str]) -> np.ndarray:
+        """Positions in the vector index of the chunks of the given files"""
+        if self._vector_files is None:
+            mapping = self.index.index_to_docstore_id
+            codes: Dict[Optional[str], int] = {}
+            vector_files = np.fromiter((codes.setdefault(self._file_id(mapping[i]), len(codes)) for i in range(len(mapping))), dtype=np.int32, count=len(mapping))
+            self._vector_files, self._file_codes = vector_files, codes
+        wanted = [self._file_codes[file_id] for file_id in file_ids if file_id in self._file_codes]
+        return np.flatnonzero(np.isin(self._vector_files, wanted))
+
+    def similarity_search(self, query: str, k: int = 4, file_ids: Optional[Iterable[str]] = None, hybrid: bool = False, fetch_k: int = 20) -> List[Document]:
+        """Vector search over the whole index or, with `file_ids`, pre-filtered to the chunks of those files.
+
+        With `hybrid` the top `fetch_k` vector and BM25 keyword results are
+        merged by reciprocal rank fusion, so exact terms such as identifiers or
+        error codes are found even when their embedding is not close to the query.
+        """
+        if file_ids is not None:
+            file_ids = list(file_ids)
+        if not hybrid:
+            return self._vector_search(query, k, file_ids)
+        fetch_k = max(fetch_k, k)
+        positions = self._source_positions()
+        vector_ranking = [positions[doc.metadata.get("source")] for doc in self._vector_search(query, fetch_k, file_ids)]
+        allowed = None
+        if file_ids is not None:
+            mapping = self.index.index_to_docstore_id
+            allowed = [self._docstore_position(mapping[i]) for i in self._file_vector_positions(file_ids).tolist()]
+            wanted = set(file_ids)
+            dropped = [positions.get(source) for source in list(self.duplicates)]
+            allowed += [position for position in dropped if position is not None and self._position_file_id(position) in wanted]
+        keyword_ranking = [position for position, _ in self.keyword_index().search(query, k=fetch_k, allowed=allowed)]
+        return [self._document(position) for position in reciprocal_rank_fusion([vector_ranking, keyword_ranking])[:k]]
+
+    def _position_file_id(self, position: int) -> Optional[str]:
+        if isinstance(self.docs, ChunkStore):
+            return self.docs.file_id(position)
+        return self.docs[position].metadata.get("file_id")
+
+    def _docstore_position(self, docstore_id: str) -> int:
+        if isinstance(self.docs, ChunkStore):
+            return int(docstore_id)
+        return self._source_positions()[self.index.docstore.search(docstore_id).metadata.get("source")]
+
+    def _vector_search(self, query: str, k: int, file_ids: Optional[List[str]]) -> List[Document]:
+        if file_ids is None:
+            return self.index.similarity_search(query, k=k)
+        positions = self._file_vector_positions(file_ids)
+        if not len(positions):
+            return []
+        query_vector = np.asarray([self.index.embeddings.embed_query(query)], dtype=np.float32)
+        rescore = self.index.rescore if isinstance(self.index, RescoringFAISS) else 1
+        _, indices = filtered_search(self.index.index, query_vector, min(k * rescore, len(positions)), positions)
+        ids = [self.index.index_to_docstore_id[i] for i in indices[0] if i != -1]
+        if isinstance(self.index, RescoringFAISS):
+            ids = [id for id, _ in self.index.rerank(query_vector[0], ids)]
+        return [self.index.docstore.search(id) for id in ids[:k]]
+
+    def save(self, path: str):
+        """Writes the index, its ChunkStore and the vector id mapping to a directory"""
+        if not isinstance(self.docs, ChunkStore) or not isinstance(self.index, FAISS) or not isinstance(self.index.docstore, ChunkStoreDocstore):
+            raise NotImplementedError("Only FAISS indexes over a ChunkStore can be saved")
+        faiss = dependable_faiss_import()
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        faiss.write_index(self.index.index, os.path.join(tmp_path, "index.faiss"))
+        self.docs.save(tmp_path)
+        index_to_docstore_id = self.index.index_to_docstore_id
+        rows = np.fromiter((int(index_to_docstore_id[i]) for i in range(len(index_to_docstore_id))), dtype=np.int64, count=len(index_to_docstore_id))
+        np.save(os.path.join(tmp_path, "rows.npy"), rows)
+        meta = {"name": self.name, "duplicates": self.duplicates, "distance_strategy": self.index.distance_strategy}
+        if isinstance(self.index, RescoringFAISS):
+            # full precision vectors in index order
+            with open(os.path.join(tmp_path, "vectors.f32"), "wb") as f:
+                for start in range(0, len(rows), 65536):
+                    end = start + 65536
+                    f.write(self.index.vectors[[self.index.vector_positions[str(row)] for row in rows[start:end]]].tobytes())
+            meta["rescore"] = self.index.rescore
+        with open(os.path.join(tmp_path, "folder.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        with open(os.path.join(tmp_path, "keywords.pkl"), "wb") as f:
+            pickle.dump(self.keyword_index(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # another process saved the same index first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str, embeddings: Embeddings) -> "FolderIndex":
+        """Opens an index written by `save`, the FAISS index, the chunk text and
+        the full precision vectors of quantized indexes are memory-mapped and
+        copied into memory on the first change
+        """
+        faiss = dependable_faiss_import()
+        index = faiss.read_index(os.path.join(path, "index.faiss"), faiss.IO_FLAG_MMAP)
+        store = ChunkStore.load(path)
+        rows = np.load(os.path.join(path, "rows.npy"))
+        with open(os.path.join(path, "folder.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        ids = [str(row) for row in rows.tolist()]
+        args = (embeddings, index, ChunkStoreDocstore(store), dict(enumerate(ids)))
+        distance_strategy = DistanceStrategy(meta["distance_strategy"])
+        if "rescore" in meta:
+            vectors = VectorFile.load(os.path.join(path, "vectors.f32"), index.d)
+            vector_positions = {id: i for i, id in enumerate(ids)}
+            vector_store = RescoringFAISS(*args, distance_strategy=distance_strategy, vectors=vectors, vector_positions=vector_positions, rescore=meta["rescore"])
+        else:
+            vector_store = FAISS(*args, distance_strategy=distance_strategy)
+        folder_index = cls(docs=store, index=vector_store, duplicates=meta["duplicates"])
+        folder_index.name = meta["name"]
+        keywords_path = os.path.join(path, "keywords.pkl")
+        if os.path.exists(keywords_path):
+            with open(keywords_path, "rb") as f:
+                folder_index._keywords = pickle.load(f)
+        return folder_index
+
+
+def number_files(docs: Iterable[Document], known: Optional[Dict[str, str]] = None) -> List[Document]:
+    """Copies the chunks of files not in `known` with sources numbered by file,
+    continuing after the files that are known
+    """
+    known = known or {}
+    numbers: Dict[str, int] = {}
+    numbered = []
+    for doc in docs:
+        file_id = doc.metadata.get("file_id")
+        if file_id is None or file_id in known:
+            continue
+        number = numbers.setdefault(file_id, len(known) + len(numbers) + 1)
+        metadata = {**doc.metadata, "source": f"{number}-{doc.metadata.get('page', 1)}-{doc.metadata.get('chunk', 1)}"}
+        numbered.append(Document(page_content=doc.page_content, metadata=metadata))
+    return numbered
+
+
+def folder_index_key(file_ids: Sequence[str], embedding_model: str, chunk_size: int, chunk_overlap: int, **options) -> str:
+    """Identifies a FolderIndex by the content hashes of its files in order, the
+    embedding model and every parameter that changes the chunks or the vectors
+    """
+    parts = [*file_ids, embedding_model, str(chunk_size), str(chunk_overlap), repr(sorted(options.items()))]
+    return md5("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def folder_index_path(key: str) -> str:
+    return os.path.join(os.environ["LANGCHAIN_LAB_CACHE_PATH"], "index", key)
+
+
+def load_folder_index(key: str, embeddings: Embeddings) -> Optional[FolderIndex]:
+    """Returns the saved FolderIndex for `key` or None when there is none"""
+    path = folder_index_path(key)
+    if not os.path.isdir(path):
+        return None
+    try:
+        return FolderIndex.load(path, embeddings)
+    except Exception as e:
+        logger.warning(f"Dropping unreadable folder index {key}: {e}")
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+
+
+def save_folder_index(folder_index: FolderIndex, key: str):
+    path = folder_index_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        folder_index.save(path)
+    except NotImplementedError as e:
+        logger.info(f"Not saving folder index {key}: {e}")
+
+
+def faiss_from_store(store: ChunkStore, embeddings: Embeddings, rows: Optional[List[int]] = None, **index_options) -> FAISS:
+    """Builds a FAISS index whose docstore reads Document views from the ChunkStore
+    instead of holding a copy of every Document
+    """
+    rows = list(store.rows()) if rows is None else rows
+    vectors = np.asarray(embeddings.embed_documents([store.text(row) for row in rows]), dtype=np.float32)
+    return faiss_from_vectors(embeddings, vectors, ChunkStoreDocstore(store), [str(row) for row in rows], **index_options)
+
+
+def faiss_from_documents(docs: List[Document], embeddings: Embeddings, **index_options) -> FAISS:
+    """FAISS.from_documents with a configurable index type"""
+    vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+    ids = [str(uuid.uuid4()) for _ in docs]
+    return faiss_from_vectors(embeddings, vectors, InMemoryDocstore(dict(zip(ids, docs))), ids, **index_options)
+
+
+def faiss_from_vectors(embeddings: Embeddings, vectors: np.ndarray, docstore: Docstore, ids: List[str], rescore: int = 4, **index_options) -> FAISS:
+    """Wraps a new FAISS index in a vector store, quantized indexes keep their
+    full precision vectors on disk and rescore `rescore` times k candidates
+    """
+    index = create_faiss_index(vectors, **index_options)
+    if index_options.get("quantization", "none") == "none" or rescore <= 1:
+        return FAISS(embeddings, index, docstore, dict(enumerate(ids)))
+    vector_store = RescoringFAISS(embeddings, index, docstore, dict(enumerate(ids)), vectors=VectorFile(vectors.shape[1]), vector_positions={}, rescore=rescore)
+    vector_store.add_vectors(ids, vectors)
+    return vector_store
+
+
+# the EncodingPool of the current embedding, its worker processes are shut down once it is replaced
+_encoding_pool: Optional[EncodingPool] = None
+
+
+def replace_encoding_pool(pool: Optional[EncodingPool]) -> bool:
+    """Records the pool of a new embedding and closes the pool it replaces, returns whether one was closed"""
+    global _encoding_pool
+    previous, _encoding_pool = _encoding_pool, pool
+    if previous is None or previous is pool:
+        return False
+    logger.info("Shutting down the encoding workers of the replaced embedding")
+    previous.close()
+    return True
+
 
 @st.cache_resource
 def embedding_init(provider: str, api_url: str, api_key: str, model_name: str, model_kwargs):
     if provider == "openai":
-        embedding = OpenAIEmbeddings(model=model_name, openai_api_base=api_url, openai_api_key=api_key)
-    elif provider == "huggingface":
-        embedding = HuggingFaceEmbeddings(
-            model_name=os.path.join(os.environ["HUGGINGFACE_CATCH_PATH"], model_name),
-            cache_folder=os.environ["HUGGINGFACE_CATCH_PATH"],
-            model_kwargs=model_kwargs,
+        embedding = EmbeddingScheduler(
+            OpenAIEmbeddings(model=model_name, openai_api_base=api_url, openai_api_key=api_key),
+            max_concurrency=int(os.environ.get("LANGCHAIN_LAB_EMBEDDING_CONCURRENCY", 4)),
+            max_batch_tokens=int(os.environ.get("LANGCHAIN_LAB_EMBEDDING_BATCH_TOKENS", 100_000)),
         )
-        # embedding.client.max_seq_length = 512
-    st.session_state["EMBEDDING"] = embedding
+    elif provider == "huggingface":
+        model_path = os.path.join(os.environ["HUGGINGFACE_CATCH_PATH"], model_name)
+        # padded tokens per local batch
+        max_batch_tokens = int(os.environ.get("LANGCHAIN_LAB_LOCAL_BATCH_TOKENS", 16384))
+        # every worker holds a copy of the model, so the pool is only used when asked for
+        workers = int(os.environ.get("LANGCHAIN_LAB_EMBEDDING_WORKERS", 0))
+        if workers > 1 and model_kwargs.get("device", "cpu") == "cpu":
+            workers, threads_per_worker = pool_size(workers, int(os.environ.get("LANGCHAIN_LAB_EMBEDDING_THREADS", 0)))
+            embedding = EncodingPool(
+                model_path,
+                workers=workers,
+                threads_per_worker=threads_per_worker,
+                max_batch_tokens=max_batch_tokens,
+                model_kwargs={**model_kwargs, "cache_folder": os.environ["HUGGINGFACE_CATCH_PATH"]},
+            )
+        else:
+            client = HuggingFaceEmbeddings(
+                model_name=model_path,
+                cache_folder=os.environ["HUGGINGFACE_CATCH_PATH"],
+                model_kwargs=model_kwargs,
+            ).client
+            # client.max_seq_length = 512
+            embedding = BucketedEncoder(client, max_batch_tokens=max_batch_tokens)
+    if replace_encoding_pool(embedding if isinstance(embedding, EncodingPool) else None):
+        # settings cached with the closed pool are initialized again when they are asked for
+        embedding_init.clear()
+    st.session_state["EMBEDDING"] = CachedEmbeddings(embedding, cache=get_embedding_cache(), namespace=f"{provider}:{model_name}")
     logger.info(f"Initializing embedding with {model_name}")
 
 
-def embed_docs(docs: List[Document], embedding, vector_store: str, **kwargs) -> FolderIndex:
-    """Embeds a collection of files and stores them in a FolderIndex."""
+def embed_docs(docs: Union[List[Document], ChunkStore], embedding, vector_store: str, dedup: bool = False, **kwargs) -> FolderIndex:
+    """Embeds a collection of files and stores them in a FolderIndex.
+
+    With `dedup` identical and near-identical chunks are embedded only once,
+    `kwargs` select and tune the vector index (see `create_faiss_index`).
+    """
     supported_vector_stores: dict[str, Type[VectorStore]] = {"faiss": FAISS}
 
     if vector_store in supported_vector_stores:
@@ -65,8 +585,28 @@ def embed_docs(docs: List[Document], embedding, vector_store: str, **kwargs) ->
     else:
         raise NotImplementedError(f"Vector store {vector_store} not supported.")
 
-    return FolderIndex.from_docs(
+    rows = None
+    duplicates = {}
+    if dedup:
+        result = deduplicate(docs)
+        rows = result.keep
+        duplicates = {source_of(docs, row): source_of(docs, original) for row, original in result.duplicates.items()}
+        logger.info(f"Removed {result.removed} duplicate chunks of {len(docs)}, saved {result.removed} embedding inputs")
+
+    folder_index = FolderIndex.from_docs(
         docs=docs,
         embeddings=embedding,
         vector_store=_vector_store,
+        rows=rows,
+        **kwargs,
     )
+    folder_index.duplicates = duplicates
+    # the keyword index is cheap next to embedding, build it with the vectors
+    folder_index.keyword_index()
+    return folder_index
+
+
+def source_of(docs: Union[List[Document], ChunkStore], row: int) -> str:
+    if isinstance(docs, ChunkStore):
+        return docs.source(row)
+    return docs[row].metadata.get("source")
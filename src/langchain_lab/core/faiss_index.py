@@ -0,0 +1,325 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import os
+import shutil
+import tempfile
+from typing import IO, Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+from langchain_lab import logger
+
+FAISS_INDEX_TYPES = ("auto", "flat", "ivf_flat", "ivf_pq", "hnsw")
+# scalar quantizers, int8 learns a min/max range for every dimension
+QUANTIZATIONS = {"none": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+
+# below this many vectors exact search is fast enough and needs no training
+AUTO_FLAT_MAX_VECTORS = 20_000
+# faiss wants about 39 training points per centroid
+TRAIN_POINTS_PER_CENTROID = 64
+
+
+def resolve_index_type(index_type: str, count: int) -> str:
+    """Maps "auto" to exact search for small corpora and IVF-Flat for large ones"""
+    if index_type not in FAISS_INDEX_TYPES:
+        raise ValueError(f"Unknown FAISS index type {index_type}, expected one of {', '.join(FAISS_INDEX_TYPES)}")
+    if index_type == "auto":
+        return "flat" if count < AUTO_FLAT_MAX_VECTORS else "ivf_flat"
+    return index_type
+
+
+def default_nlist(count: int) -> int:
+    """4 * sqrt(n) inverted lists, with enough vectors to train every centroid"""
+    return max(1, min(int(4 * math.sqrt(count)), count // TRAIN_POINTS_PER_CENTROID))
+
+
+def default_pq_m(dim: int) -> int:
+    """Largest number of sub-quantizers dividing `dim` that keeps at least 8 dimensions each"""
+    m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def create_faiss_index(
+    vectors: np.ndarray,
+    index_type: str = "auto",
+    nlist: Optional[int] = None,
+    nprobe: Optional[int] = None,
+    pq_m: Optional[int] = None,
+    hnsw_m: int = 32,
+    ef_construction: int = 40,
+    ef_search: int = 64,
+    quantization: str = "none",
+    seed: int = 1234,
+) -> Any:
+    """Builds and fills a L2 FAISS index of the requested type.
+
+    `quantization` stores the vectors of flat, IVF-Flat and HNSW indexes as
+    float16 or int8 codes; IVF-PQ is compressed already and ignores it.
+    Quantizers are trained on a random sample of `vectors`. IVF-Flat and
+    IVF-PQ support deleting vectors, HNSW does not.
+    """
+    faiss = dependable_faiss_import()
+    count, dim = vectors.shape
+    index_type = resolve_index_type(index_type, count)
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization}, expected one of {', '.join(QUANTIZATIONS)}")
+    codes = QUANTIZATIONS[quantization]
+
+    nlist = nlist or default_nlist(count)
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim) if codes == "Flat" else faiss.index_factory(dim, codes)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m) if codes == "Flat" else faiss.index_factory(dim, f"HNSW{hnsw_m}_{codes}")
+        index.hnsw.efConstruction = ef_construction
+    elif index_type == "ivf_flat":
+        index = faiss.index_factory(dim, f"IVF{nlist},{codes}")
+    else:
+        # 8 bit codes need 256 training points per sub-quantizer. "np" skips
+        # polysemous training, which is slow and only helps hamming filtering
+        nbits = min(8, max(1, int(math.log2(max(count, 2)))))
+        index = faiss.index_factory(dim, f"IVF{nlist},PQ{pq_m or default_pq_m(dim)}x{nbits}np")
+    if not index.is_trained:
+        train_size = min(count, max(nlist, 256) * TRAIN_POINTS_PER_CENTROID)
+        sample = vectors[np.random.default_rng(seed).choice(count, train_size, replace=False)] if train_size < count else vectors
+        index.train(sample)
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    index.add(vectors)
+    logger.info(f"Built FAISS {index_type} index over {count} vectors with {quantization} quantization")
+    return index
+
+
+def set_search_params(index: Any, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Applies search time tunables to the index types that have them"""
+    faiss = dependable_faiss_import()
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = nprobe or max(1, ivf.nlist // 16)
+    elif isinstance(index, faiss.IndexHNSW) and ef_search:
+        index.hnsw.efSearch = ef_search
+
+
+def ensure_writable(index: Any):
+    """Copies inverted lists that `read_index` memory-mapped read-only into
+    memory, IVF indexes opened with IO_FLAG_MMAP abort the process on the
+    first add or remove otherwise. Other indexes are left as they are.
+    """
+    faiss = dependable_faiss_import()
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return
+    invlists = faiss.downcast_InvertedLists(ivf.invlists)
+    if not isinstance(invlists, faiss.OnDiskInvertedLists) or not invlists.read_only:
+        return
+    copy = faiss.ArrayInvertedLists(ivf.nlist, ivf.code_size)
+    for list_no in range(ivf.nlist):
+        size = invlists.list_size(list_no)
+        if size:
+            copy.add_entries(list_no, size, invlists.get_ids(list_no), invlists.get_codes(list_no))
+    ivf.replace_invlists(copy, True)
+    # the index owns the copy now
+    copy.this.disown()
+
+
+def remove_vectors(index: Any, positions: Iterable[int]):
+    """Removes vectors by position and shifts the positions after them down,
+    the way IndexFlat does and LangChain's FAISS wrapper expects.
+
+    IVF indexes keep the ids of the remaining vectors on removal, so their
+    inverted lists are renumbered. HNSW graphs can not remove vectors.
+    """
+    faiss = dependable_faiss_import()
+    if isinstance(index, faiss.IndexHNSW):
+        raise NotImplementedError("HNSW indexes do not support removing vectors")
+    removed = np.unique(np.fromiter(positions, dtype=np.int64))
+    index.remove_ids(faiss.IDSelectorBatch(removed))
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return
+    invlists = ivf.invlists
+    for list_no in range(ivf.nlist):
+        size = invlists.list_size(list_no)
+        if not size:
+            continue
+        ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), size).copy()
+        codes = faiss.rev_swig_ptr(invlists.get_codes(list_no), size * invlists.code_size).copy()
+        ids -= np.searchsorted(removed, ids)
+        invlists.update_entries(list_no, 0, size, faiss.swig_ptr(ids), faiss.swig_ptr(codes))
+
+
+def delete_vectors(vector_store: FAISS, ids: List[str]):
+    """FAISS.delete on top of `remove_vectors`"""
+    missing = set(ids).difference(vector_store.index_to_docstore_id.values())
+    if missing:
+        raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing}")
+    wanted = set(ids)
+    positions = {position for position, id in vector_store.index_to_docstore_id.items() if id in wanted}
+    remove_vectors(vector_store.index, positions)
+    vector_store.docstore.delete(ids)
+    remaining = [id for position, id in sorted(vector_store.index_to_docstore_id.items()) if position not in positions]
+    vector_store.index_to_docstore_id = dict(enumerate(remaining))
+
+
+def filtered_search(index: Any, queries: np.ndarray, k: int, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Searches only the vectors at `positions` in one ANN call.
+
+    The selection is applied inside the index, so k results come back even when
+    the subset is a small part of the collection. IVF indexes probe more lists
+    in proportion to how small the subset is.
+    """
+    faiss = dependable_faiss_import()
+    selector = faiss.IDSelectorBatch(np.asarray(positions, dtype=np.int64))
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        fraction = max(len(positions) / max(index.ntotal, 1), 1e-9)
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=min(ivf.nlist, math.ceil(ivf.nprobe / fraction)))
+    elif isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(queries, k, params=params)
+
+
+class VectorFile:
+    """Append-only float32 matrix kept in a file and memory-mapped.
+
+    Holds the full precision vectors that quantized indexes rescore with, so
+    they live in the page cache instead of process memory. New files are
+    unnamed temporary files under $LANGCHAIN_LAB_CACHE_PATH/vectors; a file
+    opened with `load` is read-only and copied on the first append.
+    """
+
+    def __init__(self, dim: int, file: Optional[IO[bytes]] = None, count: int = 0, writable: bool = True):
+        self.dim = dim
+        self.count = count
+        self._writable = writable
+        if file is None:
+            path = os.path.join(os.environ["LANGCHAIN_LAB_CACHE_PATH"], "vectors")
+            os.makedirs(path, exist_ok=True)
+            file = tempfile.TemporaryFile(dir=path)
+        self._file = file
+        self._remap()
+
+    @classmethod
+    def load(cls, path: str, dim: int) -> "VectorFile":
+        file = open(path, "rb")
+        return cls(dim, file=file, count=os.fstat(file.fileno()).st_size // (dim * 4), writable=False)
+
+    def _remap(self):
+        if self.count:
+            self._map = np.memmap(self._file, dtype=np.float32, mode="r", shape=(self.count, self.dim))
+        else:
+            self._map = np.empty((0, self.dim), dtype=np.float32)
+
+    def append(self, vectors: np.ndarray) -> range:
+        """Appends rows and returns their positions"""
+        if not self._writable:
+            copy = VectorFile(self.dim)
+            self._file.seek(0)
+            shutil.copyfileobj(self._file, copy._file)
+            self._file.close()
+            self._file, self._writable = copy._file, True
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        self._file.seek(self.count * self.dim * 4)
+        self._file.write(vectors.tobytes())
+        self._file.flush()
+        start = self.count
+        self.count += len(vectors)
+        self._remap()
+        return range(start, self.count)
+
+    def __getitem__(self, positions: Any) -> np.ndarray:
+        return np.asarray(self._map[positions])
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self._map.tobytes() if self.count else b"")
+
+    def nbytes(self) -> int:
+        return self.count * self.dim * 4
+
+
+class RescoringFAISS(FAISS):
+    """FAISS vector store over a quantized index that re-ranks the top
+    `rescore * k` candidates by their exact distance to the query.
+
+    `vector_positions` maps docstore ids to rows of the VectorFile.
+    """
+
+    def __init__(self, *args, vectors: VectorFile, vector_positions: Dict[str, int], rescore: int = 4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vectors = vectors
+        self.vector_positions = vector_positions
+        self.rescore = rescore
+
+    def add_vectors(self, ids: List[str], vectors: np.ndarray):
+        """Records the full precision vectors of `ids`"""
+        self.vector_positions.update(zip(ids, self.vectors.append(vectors)))
+
+    def add_embeddings(self, text_embeddings: Iterable[Tuple[str, List[float]]], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs) -> List[str]:
+        text_embeddings = list(text_embeddings)
+        ids = super().add_embeddings(text_embeddings, metadatas=metadatas, ids=ids, **kwargs)
+        self.add_vectors(ids, np.asarray([vector for _, vector in text_embeddings], dtype=np.float32))
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(zip(texts, self._embed_documents(texts)), metadatas=metadatas, ids=ids, **kwargs)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs) -> Optional[bool]:
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+        delete_vectors(self, ids)
+        for id in ids:
+            self.vector_positions.pop(id, None)
+        return True
+
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[Any] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        query = np.asarray(embedding, dtype=np.float32)
+        _, indices = self.index.search(query[None, :], (k if filter is None else fetch_k) * self.rescore)
+        filter_func = self._create_filter_func(filter) if filter is not None else None
+        score_threshold = kwargs.get("score_threshold")
+        docs = []
+        for id, distance in self.rerank(query, [self.index_to_docstore_id[i] for i in indices[0] if i != -1]):
+            doc = self.docstore.search(id)
+            if not isinstance(doc, Document):
+                raise ValueError(f"Could not find document for id {id}, got {doc}")
+            if filter_func is not None and not filter_func(doc.metadata):
+                continue
+            if score_threshold is not None and distance > score_threshold:
+                continue
+            docs.append((doc, distance))
+            if len(docs) == k:
+                break
+        return docs
+
+    def rerank(self, query: np.ndarray, ids: List[str]) -> List[Tuple[str, float]]:
+        """Orders docstore ids by their exact L2 distance to the query"""
+        if not ids:
+            return []
+        vectors = self.vectors[[self.vector_positions[id] for id in ids]]
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        return [(ids[j], float(distances[j])) for j in np.argsort(distances, kind="stable")]
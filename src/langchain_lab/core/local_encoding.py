@@ -0,0 +1,204 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from langchain_lab import logger
+
+# the model loaded by each worker process
+_model = None
+_encode_kwargs: Dict[str, Any] = {}
+
+
+def pool_size(workers: Optional[int] = None, threads_per_worker: Optional[int] = None) -> Tuple[int, int]:
+    """Workers and torch threads per worker that together use every core once"""
+    cores = os.cpu_count() or 1
+    if not workers:
+        workers = max(1, min(4, cores // (threads_per_worker or 1)))
+    if not threads_per_worker:
+        threads_per_worker = max(1, cores // workers)
+    return workers, threads_per_worker
+
+
+def _bucket(length: int) -> int:
+    return int(math.log2(max(length, 1)) * 4)
+
+
+def bucket_batches(lengths: Sequence[int], max_batch_tokens: int = 16384, max_batch_size: int = 256) -> List[List[int]]:
+    """Groups positions into buckets of token lengths within a quarter octave
+    (about 19%) of each other and cuts each bucket into batches whose padded
+    size, the longest length times the batch size, stays within `max_batch_tokens`.
+
+    Short texts share large batches and long texts get small ones, so little
+    time goes on padding. Batches are returned as lists of positions.
+    """
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    bucket = -1
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # ascending order, the text being added is the longest of the batch
+        if batch and (_bucket(lengths[i]) != bucket or (len(batch) + 1) * lengths[i] > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+        if not batch:
+            bucket = _bucket(lengths[i])
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def token_length_function(tokenizer: Any, max_length: Optional[int] = None) -> Callable[[List[str]], List[int]]:
+    """Token counts of texts as the model sees them, truncated to `max_length`"""
+
+    def token_lengths(texts: List[str]) -> List[int]:
+        encoded = tokenizer(texts, truncation=max_length is not None, max_length=max_length, return_attention_mask=False, return_token_type_ids=False)
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    return token_lengths
+
+
+def _init_worker(model_path: str, model_kwargs: Dict[str, Any], encode_kwargs: Dict[str, Any], threads: int):
+    global _model, _encode_kwargs
+    # set before torch creates its thread pools
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    _model = SentenceTransformer(model_path, **model_kwargs)
+    _encode_kwargs = encode_kwargs
+
+
+def _encode(texts: List[str]) -> np.ndarray:
+    # a shard is one batch, it is already grouped by length
+    return np.asarray(_model.encode(texts, batch_size=len(texts), convert_to_numpy=True, show_progress_bar=False, **_encode_kwargs), dtype=np.float32)
+
+
+class BucketedEncoder(Embeddings):
+    """Encodes with a sentence-transformers model in batches of similar token length.
+
+    `SentenceTransformer.encode` sorts by character count and uses one batch
+    size for every text. Here texts are sorted by token count and each batch
+    is sized to `max_batch_tokens` padded tokens (see `bucket_batches`).
+    Vectors are returned in the order of the texts.
+    """
+
+    def __init__(self, model: Any, max_batch_tokens: int = 16384, max_batch_size: int = 256, encode_kwargs: Optional[Dict[str, Any]] = None):
+        self.model = model
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.encode_kwargs = encode_kwargs or {}
+        self.token_lengths = token_length_function(model.tokenizer, model.max_seq_length)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        vectors: Optional[np.ndarray] = None
+        for batch in bucket_batches(self.token_lengths(texts), self.max_batch_tokens, self.max_batch_size):
+            encoded = self.model.encode([texts[i] for i in batch], batch_size=len(batch), convert_to_numpy=True, show_progress_bar=False, **self.encode_kwargs)
+            if vectors is None:
+                vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            vectors[batch] = encoded
+        return vectors if vectors is not None else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+
+class EncodingPool(Embeddings):
+    """Encodes with a sentence-transformers model on several processes.
+
+    Each worker loads the model once and runs torch on `threads_per_worker`
+    threads, so the workers together do not oversubscribe the cores. Texts are
+    grouped into length-bucketed shards of at most `shard_size` texts and
+    `max_batch_tokens` padded tokens (see `bucket_batches`) that are spread
+    over the workers, the vectors are returned in the order of the texts.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        workers: Optional[int] = None,
+        threads_per_worker: Optional[int] = None,
+        shard_size: int = 64,
+        max_batch_tokens: int = 16384,
+        model_kwargs: Optional[Dict[str, Any]] = None,
+        encode_kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        self.workers, self.threads_per_worker = pool_size(workers, threads_per_worker)
+        self.shard_size = shard_size
+        self.max_batch_tokens = max_batch_tokens
+        self.token_lengths = _load_token_lengths(model_path)
+        # spawn, forking a process that already runs torch threads can deadlock
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_path, model_kwargs or {}, encode_kwargs or {}, self.threads_per_worker),
+        )
+        logger.info(f"Started {self.workers} encoding workers with {self.threads_per_worker} threads each for {model_path}")
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        shards = bucket_batches(self.token_lengths(texts), self.max_batch_tokens, self.shard_size)
+        vectors: Optional[np.ndarray] = None
+        # map yields the shards in submission order whichever worker finishes first
+        for shard, encoded in zip(shards, self._executor.map(_encode, [[texts[i] for i in shard] for shard in shards])):
+            if vectors is None:
+                vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            vectors[shard] = encoded
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._executor.submit(_encode, [text]).result()[0].tolist()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _load_token_lengths(model_path: str) -> Callable[[List[str]], List[int]]:
+    """Token counts from the tokenizer of a sentence-transformers model, or character counts when it has none at its root"""
+    try:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+    except Exception as e:
+        logger.warning(f"Bucketing by characters, no tokenizer in {model_path}: {e}")
+        return lambda texts: [len(text) for text in texts]
+    max_length = None
+    config_path = os.path.join(model_path, "sentence_bert_config.json")
+    if os.path.exists(config_path):
+        with open(config_path, encoding="utf-8") as f:
+            max_length = json.load(f).get("max_seq_length")
+    return token_length_function(tokenizer, max_length)
@@ -12,14 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import codecs
+import inspect
 import io
-import json
+import mmap
+import multiprocessing
+import os
 import re
+import zipfile
 from abc import ABC, abstractmethod
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import nullcontext
 from copy import deepcopy
 from hashlib import md5
 from io import BytesIO
-from typing import Any, List, Optional
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, Type, Union
 
 import chardet
 import docx2txt
@@ -29,30 +44,102 @@ from langchain.docstore.document import Document
 from langchain_text_splitters import MarkdownHeaderTextSplitter
 
 from langchain_lab import logger
+from langchain_lab.core.cache import ParseCache
 
 
 class File(ABC):
-    """Represents an uploaded file comprised of Documents"""
+    """Represents an uploaded file comprised of Documents
+
+    `docs` may be a list or a callable returning a fresh iterator of Documents.
+    A lazy source is only materialised when `docs` is read, `iter_docs` streams
+    it without keeping the Documents around. Documents are shared between
+    copies and should be treated as immutable.
+    """
+
+    # bump when a parser changes its output so stale parse cache entries are ignored
+    version: int = 3
 
     def __init__(
         self,
         name: str,
         id: str,
         metadata: Optional[dict[str, Any]] = None,
-        docs: Optional[List[Document]] = None,
+        docs: Optional[Union[List[Document], Callable[[], Iterator[Document]]]] = None,
     ):
         self.name = name
         self.id = id
         self.metadata = metadata or {}
         self.docs = docs or []
 
+    @property
+    def docs(self) -> List[Document]:
+        if self._docs is None:
+            self._docs = list(self._docs_source())
+            self._docs_source = None
+        elif self._docs_shared:
+            # copy-on-write, the list may be mutated by the caller from now on
+            self._docs = list(self._docs)
+        self._docs_shared = False
+        return self._docs
+
+    @docs.setter
+    def docs(self, docs: Union[List[Document], Callable[[], Iterator[Document]]]):
+        if callable(docs):
+            self._docs, self._docs_source = None, docs
+        else:
+            self._docs, self._docs_source = docs, None
+        self._docs_shared = False
+
+    @property
+    def is_lazy(self) -> bool:
+        return self._docs is None
+
+    def iter_docs(self) -> Iterator[Document]:
+        """Iterates the documents without materialising a lazy source"""
+        if self._docs is None:
+            return self._docs_source()
+        return iter(self._docs)
+
     @classmethod
-    @abstractmethod
-    def from_bytes(cls, file: BytesIO) -> "File":
+    def from_bytes(cls, file: BytesIO, **kwargs) -> "File":
         """Creates a File from a BytesIO object"""
+        return cls.from_buffer(file.name, read_buffer(file), **kwargs)
+
+    @classmethod
+    def from_path(cls, path: str, **kwargs) -> "File":
+        """Creates a File from a file on disk, memory-mapping instead of reading it"""
+        # the mapping is closed on return, so the documents can not be lazy
+        kwargs["lazy"] = False
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls.from_buffer(os.path.basename(path), memoryview(b""), **kwargs)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as data:
+                    return cls.from_buffer(os.path.basename(path), data, **kwargs)
+
+    @classmethod
+    def from_buffer(cls, name: str, data: memoryview, lazy: bool = False, **kwargs) -> "File":
+        """Creates a File from the upload bytes, hashing and parsing the same buffer
+
+        With `lazy` the buffer is kept and parsed only when the documents are used.
+        """
+        if lazy:
+            return cls(name=name, id=content_hash(data), docs=lambda: cls.iter_parse(data, **kwargs))
+        return cls(name=name, id=content_hash(data), docs=cls.parse(data, **kwargs))
+
+    @classmethod
+    @abstractmethod
+    def parse(cls, data: memoryview) -> List[Document]:
+        """Extracts the Documents from the upload bytes"""
+
+    @classmethod
+    def iter_parse(cls, data: memoryview, **kwargs) -> Iterator[Document]:
+        """Extracts the Documents one by one, parsers that can stream override this"""
+        return iter(cls.parse(data, **kwargs))
 
     def __repr__(self) -> str:
-        return f"File(name={self.name}, id={self.id}, " " metadata={self.metadata}, docs={self.docs})"
+        docs = "<lazy>" if self.is_lazy else self._docs
+        return f"File(name={self.name}, id={self.id}, metadata={self.metadata}, docs={docs})"
 
     def __str__(self) -> str:
         return f"File(name={self.name}, id={self.id}, metadata={self.metadata})"
@@ -60,19 +147,18 @@ class File(ABC):
     def __eq__(self, other):
         if not isinstance(other, type(self)):
             return NotImplemented
-        return self.name == other.name and self.id == other.id and self.metadata == other.metadata and self.docs == other.docs
+        return self.id == other.id
 
     def __hash__(self):
-        return hash((self.name, self.id, frozenset(self.metadata.items()), tuple(self.docs)))
+        return hash((type(self), self.id))
 
     def copy(self) -> "File":
-        """Create a deep copy of this File"""
-        return self.__class__(
-            name=self.name,
-            id=self.id,
-            metadata=deepcopy(self.metadata),
-            docs=deepcopy(self.docs),
-        )
+        """Create a copy of this File that shares its documents until either side changes them"""
+        copied = self.__class__(name=self.name, id=self.id, metadata=deepcopy(self.metadata))
+        copied._docs, copied._docs_source = self._docs, self._docs_source
+        if self._docs is not None:
+            self._docs_shared = copied._docs_shared = True
+        return copied
 
 
 def strip_consecutive_newlines(text: str) -> str:
@@ -82,105 +168,437 @@ def strip_consecutive_newlines(text: str) -> str:
     return re.sub(r"\s*\n\s*", "\n", text)
 
 
-def detect_big_bytesio_object(bytes_io_object: BytesIO):
+def read_buffer(file: BytesIO) -> memoryview:
+    """Reads an upload once and returns a read-only view over its bytes
+
+    BytesIO.getvalue() hands out the internal bytes object without copying,
+    so parsers and the hasher all share the upload's own buffer.
+    """
+    if isinstance(file, BytesIO):
+        data = file.getvalue()
+    else:
+        data = file.read()
+        file.seek(0)
+    return memoryview(data).toreadonly()
+
+
+def content_hash(data: memoryview, block_size: int = 1024 * 1024) -> str:
+    """Incrementally md5 hashes a buffer block by block without copying it"""
+    digest = md5()
+    for start in range(0, data.nbytes, block_size):
+        end = start + block_size
+        digest.update(data[start:end])
+    return digest.hexdigest()
+
+
+def as_bytes(data: memoryview) -> bytes:
+    """Returns the bytes object behind a view, copying only if the view is a slice"""
+    if isinstance(data.obj, bytes) and len(data.obj) == data.nbytes:
+        return data.obj
+    return data.tobytes()
+
+
+class BufferReader(io.RawIOBase):
+    """Seekable binary file object over a memoryview, for parsers that expect a file"""
+
+    def __init__(self, data: memoryview):
+        self._data = data
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        start = self._pos
+        end = max(start, min(start + len(buffer), self._data.nbytes))
+        size = end - start
+        buffer[:size] = self._data[start:end]
+        self._pos = end
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._data.nbytes + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+def detect_encoding(data: memoryview, sample_bytes: int = 256 * 1024, block_size: int = 64 * 1024) -> str:
+    """Detects the encoding of the buffer
+
+    Text that decodes as strict UTF-8 all the way through is UTF-8, whatever
+    its prefix looks like. Otherwise chardet guesses from at most `sample_bytes`
+    at the start of the buffer and `sample_bytes` from the first byte that is
+    not UTF-8, so an ASCII prefix does not hide a later single-byte encoding.
+    """
+    invalid = utf8_error_offset(data)
+    if invalid is None:
+        encoding = "utf-8-sig" if data[:3] == codecs.BOM_UTF8 else "utf-8"
+        logger.info(f"Detected file encoding: {encoding}")
+        return encoding
     detector = chardet.UniversalDetector()
-    for line in bytes_io_object:
-        detector.feed(line)
-        if detector.done:
-            break
+    samples = [data[:sample_bytes]]
+    if invalid >= sample_bytes:
+        invalid_end = invalid + sample_bytes
+        samples.append(data[invalid:invalid_end])
+    for sample in samples:
+        for start in range(0, sample.nbytes, block_size):
+            end = start + block_size
+            detector.feed(sample[start:end])
+            if detector.done:
+                break
     detector.close()
-    bytes_io_object.seek(0)
-    encoding = detector.result["encoding"]
+    encoding = detector.result["encoding"] or "utf-8"
+    if encoding.lower() == "ascii":
+        # the buffer has bytes outside ASCII that are not UTF-8, Latin-1 decodes any byte
+        encoding = "latin-1"
     logger.info(f"Detected file encoding: {encoding}")
     return encoding
 
 
+def utf8_error_offset(data: memoryview, block_size: int = 1024 * 1024) -> Optional[int]:
+    """Offset of the first byte that is not valid UTF-8, None when the whole buffer is"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for start in range(0, data.nbytes, block_size):
+        end = start + block_size
+        try:
+            decoder.decode(data[start:end], final=end >= data.nbytes)
+        except UnicodeDecodeError as e:
+            # approximate by the few bytes of a character held back from the previous block
+            return start + e.start
+    return None
+
+
+def iter_text_segments(data: memoryview, encoding: str, segment_bytes: int = 1024 * 1024) -> Iterator[str]:
+    """Incrementally decodes a buffer and yields normalised text segments
+
+    Segments end at line boundaries and characters split across blocks are
+    completed by the incremental decoder, undecodable bytes are replaced.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    carry = ""
+    replaced = 0
+    for start in range(0, data.nbytes, segment_bytes):
+        end = start + segment_bytes
+        final = end >= data.nbytes
+        text = carry + decoder.decode(data[start:end], final=final)
+        cut = len(text) if final else text.rfind("\n")
+        if cut <= 0:
+            cut = len(text)
+        carry = text[cut:]
+        segment = text[:cut]
+        replaced += segment.count("\ufffd")
+        segment = strip_consecutive_newlines(segment).strip()
+        if segment:
+            yield segment
+    if replaced:
+        logger.warning(f"decoding file with {encoding} replaced {replaced} invalid characters")
+
+
 class DocxFile(File):
     @classmethod
-    def from_bytes(cls, file: BytesIO) -> "DocxFile":
-        text = docx2txt.process(file)
+    def parse(cls, data: memoryview) -> List[Document]:
+        text = docx2txt.process(BufferReader(data))
         text = strip_consecutive_newlines(text)
-        doc = Document(page_content=text.strip())
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=[doc])
+        return [Document(page_content=text.strip())]
+
+
+# PDFs with fewer pages than this are extracted serially, the process pool
+# start-up cost outweighs the gain for short documents
+PDF_PARALLEL_MIN_PAGES = 64
+
+
+def process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Process pool for CPU bound parsing and chunking
+
+    Workers come from a fork server, or are spawned where there is none:
+    forking the server process, which runs many threads, can deadlock. The
+    fork server imports the worker modules once, so new pools start quickly.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    context = multiprocessing.get_context("forkserver")
+    # only takes effect before the fork server is started by the first pool
+    context.set_forkserver_preload(["langchain_lab.core.chunking", "src.langchain_lab.core.chunking"])
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+def _iter_pdf_pages(data: bytes, start: int, stop: int) -> Iterator[Tuple[int, str]]:
+    """Extracts and normalises the text of pages [start, stop) of a pdf"""
+    with fitz.open(stream=data, filetype="pdf") as pdf:  # type: ignore
+        for i in range(start, stop):
+            text = pdf[i].get_text(sort=True)
+            text = strip_consecutive_newlines(text)
+            yield i + 1, text.strip()
+
+
+def _extract_pdf_pages(data: bytes, start: int, stop: int) -> List[Tuple[int, str]]:
+    return list(_iter_pdf_pages(data, start, stop))
+
+
+def _split_page_range(page_count: int, parts: int) -> List[Tuple[int, int]]:
+    """Splits [0, page_count) into at most `parts` contiguous ranges"""
+    parts = max(1, min(parts, page_count))
+    size, rest = divmod(page_count, parts)
+    ranges = []
+    start = 0
+    for i in range(parts):
+        stop = start + size + (1 if i < rest else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
 
 
 class PdfFile(File):
     @classmethod
-    def from_bytes(cls, file: BytesIO) -> "PdfFile":
-        pdf = fitz.open(stream=file.read(), filetype="pdf")  # type: ignore
-        docs = []
-        for i, page in enumerate(pdf):
-            text = page.get_text(sort=True)
-            text = strip_consecutive_newlines(text)
-            doc = Document(page_content=text.strip())
-            doc.metadata["page"] = i + 1
-            docs.append(doc)
-        # file.read() mutates the file object, which can affect caching
-        # so we need to reset the file pointer to the beginning
-        file.seek(0)
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=docs)
+    def parse(cls, data: memoryview, workers: Optional[int] = None, executor: Optional[Executor] = None) -> List[Document]:
+        return list(cls.iter_parse(data, workers=workers, executor=executor))
+
+    @classmethod
+    def iter_parse(cls, data: memoryview, workers: Optional[int] = None, executor: Optional[Executor] = None) -> Iterator[Document]:
+        """Extracts pdf pages, on a process pool for large documents.
+
+        `workers` defaults to the number of cpus, pass 1 to force serial extraction
+        which yields the pages one at a time. The page ranges go to `executor`
+        when given, e.g. a pool shared by the files of a batch, otherwise to a
+        pool of their own.
+        """
+        stream = as_bytes(data)
+        with fitz.open(stream=stream, filetype="pdf") as pdf:  # type: ignore
+            page_count = pdf.page_count
+        workers = workers or os.cpu_count() or 1
+        if workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+            for page, text in _iter_pdf_pages(stream, 0, page_count):
+                yield Document(page_content=text, metadata={"page": page})
+            return
+        ranges = _split_page_range(page_count, workers)
+        logger.info(f"Extracting {page_count} pdf pages in {len(ranges)} ranges")
+        with nullcontext(executor) if executor is not None else process_pool(len(ranges)) as pool:
+            futures = [pool.submit(_extract_pdf_pages, stream, start, stop) for start, stop in ranges]
+            try:
+                # each range is yielded once it and the ranges before it are extracted, so pages
+                # stay in order and the first ones are used while later ranges are still extracted
+                for future in futures:
+                    for page, text in future.result():
+                        yield Document(page_content=text, metadata={"page": page})
+            finally:
+                for future in futures:
+                    future.cancel()
 
 
 class TxtFile(File):
     @classmethod
-    def from_bytes(cls, file: BytesIO) -> "TxtFile":
-        encoding = detect_big_bytesio_object(file)
-        encodings = ["gb18030", "gb2312", "gbk"] if encoding.lower() == "gb2312" else [encoding]
-        text = None
-        for enc in encodings:
-            try:
-                logger.info(f"Trying to decode file with {enc}")
-                text = file.read().decode(enc)
-                break
-            except Exception as e:
-                logger.warn(f"decoding file with {enc} resulted in error: {e}")
-        if text is not None:
-            text = strip_consecutive_newlines(text)
-            file.seek(0)
-            doc = Document(page_content=text.strip())
-            return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=[doc])
-        else:
-            raise Exception("Cannot read file")
+    def parse(cls, data: memoryview, segment_bytes: int = 1024 * 1024) -> List[Document]:
+        return list(cls.iter_parse(data, segment_bytes=segment_bytes))
+
+    @classmethod
+    def iter_parse(cls, data: memoryview, segment_bytes: int = 1024 * 1024) -> Iterator[Document]:
+        """Decodes the text segment by segment, each segment becomes a page"""
+        encoding = detect_encoding(data)
+        # gb18030 is a superset of gb2312 and gbk, chardet reports the narrowest
+        if encoding.lower() in ("gb2312", "gbk"):
+            encoding = "gb18030"
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            raise Exception(f"Cannot read file with unknown encoding {encoding}")
+        for i, segment in enumerate(iter_text_segments(data, encoding, segment_bytes)):
+            yield Document(page_content=segment, metadata={"page": i + 1})
 
 
 class CsvFile(File):
+    # number of csv rows pandas parses and serialises at a time
+    chunk_rows: int = 50_000
+
     @classmethod
-    def from_bytes(cls, file: BytesIO) -> "CsvFile":
-        text = file.read().decode("utf-8")
-        data = pd.read_csv(io.StringIO(text))
-        docs = []
-        for index, row in data.iterrows():
-            line = {}
-            for key in data.columns:
-                line[key] = row[key].strip()
-            doc = Document(page_content=json.dumps(line, ensure_ascii=False))
-            docs.append(doc)
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=docs)
+    def parse(cls, data: memoryview, rows_per_doc: int = 1) -> List[Document]:
+        return list(cls.iter_parse(data, rows_per_doc=rows_per_doc))
+
+    @classmethod
+    def iter_parse(cls, data: memoryview, rows_per_doc: int = 1) -> Iterator[Document]:
+        """Streams the csv in chunks and packs `rows_per_doc` JSON rows into each Document"""
+        reader = pd.read_csv(
+            BufferReader(data),
+            encoding="utf-8",
+            dtype=str,
+            keep_default_na=False,
+            chunksize=cls.chunk_rows,
+        )
+        pending: List[str] = []
+        with reader:
+            for df in reader:
+                for key in df.columns:
+                    df[key] = df[key].str.strip()
+                # to_json escapes "/" as "\/", every slash it emits is escaped
+                # that way so unescaping them keeps the JSON valid
+                records = df.to_json(orient="records", lines=True, force_ascii=False).replace("\\/", "/")
+                # newlines in values are escaped, splitlines would also break records at the
+                # line and paragraph separators (U+2028, U+0085, ...) left unescaped in values
+                lines = records.split("\n")
+                if lines and not lines[-1]:
+                    lines.pop()
+                if rows_per_doc == 1:
+                    for line in lines:
+                        yield Document(page_content=line)
+                    continue
+                pending.extend(lines)
+                full = len(pending) - len(pending) % rows_per_doc
+                for start in range(0, full, rows_per_doc):
+                    end = start + rows_per_doc
+                    yield Document(page_content="\n".join(pending[start:end]))
+                pending = pending[full:]
+        if pending:
+            yield Document(page_content="\n".join(pending))
 
 
 class MarkdownFile(File):
     @classmethod
-    def from_bytes(cls, file: BytesIO) -> "MarkdownFile":
+    def parse(cls, data: memoryview) -> List[Document]:
         headers_to_split_on = [("#", "Header 1"), ("##", "Header 2"), ("###", "Header 3"), ("####", "Header 4")]
         markdown_splitter = MarkdownHeaderTextSplitter(
             headers_to_split_on=headers_to_split_on,
             strip_headers=False,
         )
-        docs = markdown_splitter.split_text(text=file.read().decode("utf-8"))
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=docs)
-
-
-def read_file(file: BytesIO) -> File:
-    """Reads an uploaded file and returns a File object"""
-    if file.name.lower().endswith(".docx"):
-        return DocxFile.from_bytes(file)
-    elif file.name.lower().endswith(".pdf"):
-        return PdfFile.from_bytes(file)
-    elif file.name.lower().endswith(".txt"):
-        return TxtFile.from_bytes(file)
-    elif file.name.lower().endswith(".csv"):
-        return CsvFile.from_bytes(file)
-    elif file.name.lower().endswith(".md"):
-        return MarkdownFile.from_bytes(file)
-    else:
+        return markdown_splitter.split_text(text=str(data, "utf-8"))
+
+
+def get_file_class(name: str) -> Optional[Type[File]]:
+    """Returns the File class that parses uploads with this name, None if unsupported"""
+    name = name.lower()
+    if name.endswith(".docx"):
+        return DocxFile
+    elif name.endswith(".pdf"):
+        return PdfFile
+    elif name.endswith(".txt"):
+        return TxtFile
+    elif name.endswith(".csv"):
+        return CsvFile
+    elif name.endswith(".md"):
+        return MarkdownFile
+    return None
+
+
+# lazily read files with more text than this are streamed without being added to the parse cache
+LAZY_CACHE_MAX_CHARS = 16 * 1024 * 1024
+
+# parser options that change how a file is parsed but not the result, left out of parse cache keys
+EXECUTION_OPTIONS = ("workers", "executor")
+
+
+def parser_options(file_cls: Type[File], options: dict[str, Any]) -> dict[str, Any]:
+    """The options that the parser of `file_cls` takes, the others are meant for other file types"""
+    accepted = inspect.signature(file_cls.parse).parameters
+    return {name: value for name, value in options.items() if name in accepted}
+
+
+def read_file(file: BytesIO, cache: Optional[ParseCache] = None, lazy: bool = False, **kwargs) -> File:
+    """Reads an uploaded file and returns a File object
+
+    Extra keyword arguments are parser options, e.g. `rows_per_doc` for csv,
+    each parser gets the ones it takes so a batch of mixed files shares them.
+    When a cache is given, uploads whose bytes were parsed before are
+    rebuilt from the cache without running the parser again. A lazy file
+    that misses the cache is stored in it once its documents have been
+    iterated to the end, unless it has more than LAZY_CACHE_MAX_CHARS of text.
+    """
+    file_cls = get_file_class(file.name)
+    if file_cls is None:
         raise NotImplementedError(f"File type {file.name.split('.')[-1]} not supported")
+
+    kwargs = parser_options(file_cls, kwargs)
+    data = read_buffer(file)
+    if cache is None:
+        return file_cls.from_buffer(file.name, data, lazy=lazy, **kwargs)
+
+    id = content_hash(data)
+    key = cache.key(id, file_cls.__name__, file_cls.version, **{name: value for name, value in kwargs.items() if name not in EXECUTION_OPTIONS})
+    cached = cache.get(key)
+    if cached is not None:
+        id, metadata, cached_docs = cached
+        logger.info(f"Parse cache hit for {file.name}")
+        return file_cls(name=file.name, id=id, metadata=metadata, docs=cached_docs)
+    if lazy:
+
+        def docs() -> Iterator[Document]:
+            collected: Optional[List[Document]] = []
+            size = 0
+            for doc in file_cls.iter_parse(data, **kwargs):
+                size += len(doc.page_content)
+                if size > LAZY_CACHE_MAX_CHARS:
+                    # streaming keeps a few pages in memory, files too large to hold are not cached
+                    collected = None
+                elif collected is not None:
+                    collected.append(doc)
+                yield doc
+            if collected is not None:
+                cache.put(key, id, {}, collected)
+
+        return file_cls(name=file.name, id=id, docs=docs)
+    parsed = file_cls.from_buffer(file.name, data, **kwargs)
+    cache.put(key, parsed.id, parsed.metadata, parsed.docs)
+    return parsed
+
+
+def expand_archives(files: Iterable[BytesIO]) -> Iterator[BytesIO]:
+    """Yields the uploads, replacing zip archives by their supported members"""
+    for file in files:
+        if not file.name.lower().endswith(".zip"):
+            yield file
+            continue
+        with zipfile.ZipFile(BufferReader(read_buffer(file))) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                    continue
+                if get_file_class(info.filename) is None:
+                    logger.info(f"Skipping unsupported file {info.filename} in {file.name}")
+                    continue
+                member = BytesIO(archive.read(info))
+                member.name = info.filename
+                yield member
+
+
+def read_files(
+    files: Iterable[BytesIO],
+    cache: Optional[ParseCache] = None,
+    max_workers: Optional[int] = None,
+    **kwargs,
+) -> Iterator[Tuple[int, str, Union[File, Exception]]]:
+    """Reads many uploads and zip archives concurrently
+
+    Yields (index, name, File or the exception raised while parsing it) as each
+    file finishes, `index` is the position of the file in the expanded batch.
+    At most twice `max_workers` files are in flight, so archive members are
+    only extracted once a worker is about to be free. Large PDFs share one
+    process pool with a worker per cpu instead of each starting their own.
+    """
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+    pending: dict[Future, Tuple[int, str]] = {}
+
+    def collect(futures) -> Iterator[Tuple[int, str, Union[File, Exception]]]:
+        for future in futures:
+            index, name = pending.pop(future)
+            try:
+                yield index, name, future.result()
+            except Exception as e:
+                logger.error(f"Failed to read {name}: {e}")
+                yield index, name, e
+
+    with process_pool(os.cpu_count() or 1) as pages_pool, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, file in enumerate(expand_archives(files)):
+            if len(pending) >= max_workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+            pending[executor.submit(read_file, file, cache, **{"executor": pages_pool, **kwargs})] = (index, file.name)
+        yield from collect(as_completed(list(pending)))
@@ -0,0 +1,243 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+import time
+from io import BytesIO
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from langchain_lab import logger
+from langchain_lab.core.cache import ParseCache
+from langchain_lab.core.chunking import TokenIndex
+from langchain_lab.core.dedup import Deduplicator
+from langchain_lab.core.embedding import FolderIndex, faiss_from_vectors
+from langchain_lab.core.faiss_index import RescoringFAISS, resolve_index_type
+from langchain_lab.core.parsing import expand_archives, read_file
+from langchain_lab.core.store import ChunkStore, ChunkStoreDocstore
+
+# end of a stage's output
+_DONE = object()
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class IngestProgress:
+    """Counters of a running ingestion, updated by the pipeline stages"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.files = 0
+        self.pages = 0
+        self.chunks = 0
+        self.duplicates = 0
+        self.embedded = 0
+        self.indexed = 0
+        self.first_indexed: Optional[float] = None
+        self.done = False
+        self.failed: List[Tuple[str, Exception]] = []
+
+    @property
+    def seconds(self) -> float:
+        return time.monotonic() - self.start
+
+
+def _put(outbox: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            outbox.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _drain(inbox: queue.Queue, stop: threading.Event) -> Iterator[Any]:
+    while not stop.is_set():
+        try:
+            item = inbox.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        if isinstance(item, _Failed):
+            raise item.error
+        yield item
+
+
+def _stage(name: str, run: Callable[[Callable[[Any], bool]], None], outbox: queue.Queue, stop: threading.Event) -> threading.Thread:
+    """Starts a thread that feeds `outbox` through the emit callback it passes to `run`, then ends it with _DONE or the error"""
+
+    def target():
+        try:
+            run(lambda item: _put(outbox, item, stop))
+        except BaseException as e:
+            _put(outbox, _Failed(e), stop)
+        else:
+            _put(outbox, _DONE, stop)
+
+    thread = threading.Thread(target=target, name=f"ingest-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+def ingest_files(
+    files: Iterable[BytesIO],
+    embeddings: Embeddings,
+    chunk_size: int,
+    chunk_overlap: int = 0,
+    model_name: str = "gpt-3.5-turbo",
+    dedup: bool = False,
+    batch_size: int = 64,
+    queue_size: int = 4,
+    progress: Optional[IngestProgress] = None,
+    lock: Optional[threading.Lock] = None,
+    cache: Optional[ParseCache] = None,
+    **index_options,
+) -> Iterator[FolderIndex]:
+    """Parses, chunks, embeds and indexes uploads as a streaming pipeline.
+
+    Each stage runs on its own thread and hands its output to the next through
+    a queue of at most `queue_size` items: pages, batches of `batch_size`
+    chunks and their vectors. Embedding of the first chunks overlaps with
+    parsing of later pages, and only a few pages and batches are held in
+    memory at a time. The FolderIndex over a ChunkStore is yielded after every
+    inserted batch, so it can be queried before the last page is parsed, and
+    once more when it is complete. Vectors are inserted holding `lock`, so
+    other threads can search the index with the same lock while it grows.
+
+    Vectors are streamed into an unquantized flat or HNSW index. Indexes that
+    need training on the whole corpus (IVF, quantized codes, or "auto" above
+    its flat limit) are rebuilt once every chunk is embedded. Uploads parsed
+    before are read from `cache`, and new ones are stored in it once all their
+    pages are streamed. Files that fail to parse are recorded in `progress`.
+    """
+    lock = lock or threading.Lock()
+    progress = progress or IngestProgress()
+    store = ChunkStore()
+    stop = threading.Event()
+    pages: queue.Queue = queue.Queue(maxsize=queue_size)
+    batches: queue.Queue = queue.Queue(maxsize=queue_size)
+    vectors: queue.Queue = queue.Queue(maxsize=queue_size)
+    files = list(files)
+    # sources are prefixed with the file number unless there is a single file
+    numbered = len(files) > 1 or any(file.name.lower().endswith(".zip") for file in files)
+    duplicates = {}
+
+    def parse(emit):
+        for number, upload in enumerate(expand_archives(files), start=1):
+            try:
+                file = read_file(upload, cache=cache, lazy=True)
+                for doc in file.iter_docs():
+                    if not emit((number, file, doc)):
+                        return
+                    progress.pages += 1
+            except Exception as e:
+                logger.error(f"Failed to read {upload.name}: {e}")
+                progress.failed.append((upload.name, e))
+                continue
+            progress.files += 1
+
+    def chunk(emit):
+        deduplicator = Deduplicator() if dedup else None
+        batch: List[Tuple[int, str]] = []
+        for number, file, doc in _drain(pages, stop):
+            file_index = store.add_file(file.name, file.id, f"{number}-" if numbered else "")
+            page = doc.metadata.get("page", 1)
+            # not kept in token_index_cache, which would end up holding the text of every page
+            for i, text in enumerate(TokenIndex.from_text(doc.page_content, model_name).chunks(chunk_size, chunk_overlap)):
+                row = store.append(text, page=page, chunk=i + 1, file_index=file_index)
+                progress.chunks += 1
+                original = deduplicator.add(row, text) if deduplicator is not None else None
+                if original is not None:
+                    duplicates[store.source(row)] = store.source(original)
+                    progress.duplicates += 1
+                    continue
+                batch.append((row, text))
+                if len(batch) >= batch_size:
+                    if not emit(batch):
+                        return
+                    batch = []
+        if batch:
+            emit(batch)
+
+    def embed(emit):
+        for batch in _drain(batches, stop):
+            rows = [row for row, _ in batch]
+            embedded = np.asarray(embeddings.embed_documents([text for _, text in batch]), dtype=np.float32)
+            progress.embedded += len(rows)
+            if not emit((rows, embedded)):
+                return
+
+    threads = [_stage("parse", parse, pages, stop), _stage("chunk", chunk, batches, stop), _stage("embed", embed, vectors, stop)]
+    index_type = index_options.get("index_type", "auto")
+    quantization = index_options.get("quantization", "none")
+    # types that can be filled incrementally without training on the whole corpus, codes are trained at the end
+    streaming_type = index_type if index_type in ("flat", "hnsw") else "flat"
+    streaming_options = {**index_options, "index_type": streaming_type, "quantization": "none"}
+    folder_index: Optional[FolderIndex] = None
+    try:
+        for rows, embedded in _drain(vectors, stop):
+            if folder_index is None:
+                vector_store = faiss_from_vectors(embeddings, embedded, ChunkStoreDocstore(store), [str(row) for row in rows], **streaming_options)
+                folder_index = FolderIndex(docs=store, index=vector_store)
+                folder_index.duplicates = duplicates
+                progress.first_indexed = progress.seconds
+            else:
+                with lock:
+                    folder_index.add_rows(rows, embedded)
+            progress.indexed += len(rows)
+            yield folder_index
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if folder_index is None:
+        progress.done = True
+        return
+    final_type = resolve_index_type(index_type, progress.indexed)
+    needs_rebuild = final_type != streaming_type or quantization != "none"
+    rebuilt = _rebuild(folder_index, embeddings, **{**index_options, "index_type": final_type}) if needs_rebuild else None
+    with lock:
+        if rebuilt is not None:
+            folder_index.index = rebuilt
+            folder_index._vector_files = None
+        # chunks deduplicated while the index was growing are in the store but not in the position map
+        # or in a keyword index built by a search during the ingestion yet
+        folder_index._positions = None
+        positions = folder_index._source_positions()
+        keywords = folder_index.keyword_index()
+        for source in duplicates:
+            if positions[source] not in keywords:
+                keywords.add(positions[source], store.text(positions[source]))
+    progress.done = True
+    logger.info(f"Ingested {progress.files} files, {progress.chunks} chunks in {progress.seconds:.1f}s, first chunk queryable after {progress.first_indexed:.1f}s")
+    yield folder_index
+
+
+def _rebuild(folder_index: FolderIndex, embeddings: Embeddings, **index_options) -> Any:
+    """Builds the vector store again over every vector, in index order"""
+    vector_store = folder_index.index
+    ids = [vector_store.index_to_docstore_id[i] for i in range(len(vector_store.index_to_docstore_id))]
+    if isinstance(vector_store, RescoringFAISS):
+        all_vectors = vector_store.vectors[[vector_store.vector_positions[id] for id in ids]]
+    else:
+        all_vectors = vector_store.index.reconstruct_n(0, vector_store.index.ntotal)
+    return faiss_from_vectors(embeddings, all_vectors, vector_store.docstore, ids, **index_options)
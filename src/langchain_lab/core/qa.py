@@ -12,13 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
-from typing import List
+import threading
+from contextlib import nullcontext
+from functools import partial
+from typing import Any, Dict, List, Optional
 
+from langchain.callbacks.manager import CallbackManagerForChainRun
+from langchain.chains import LLMChain
+from langchain.chains.combine_documents.map_rerank import MapRerankDocumentsChain
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
 from langchain.chat_models.base import BaseChatModel
 from langchain.docstore.document import Document
+from langchain.schema import Generation, LLMResult
 
+from langchain_lab import logger
+from langchain_lab.core.cache import AnswerCache, identifiers
 from langchain_lab.core.prompts.stuff import STUFF_PROMPT
+from langchain_lab.core.scheduler import run_concurrently
 from src.langchain_lab.core.embedding import FolderIndex
 from src.langchain_lab.core.llm import TrackerCallbackHandler, TrackItem
 
@@ -28,6 +38,7 @@ class AnswerWithSources:
     sources: List[Document]
     relevant_docs: List[Document]
     tracks: List[TrackItem]
+    cached: bool
 
     def __init__(
         self,
@@ -35,11 +46,56 @@ class AnswerWithSources:
         sources: List[Document],
         relevant_docs: List[Document],
         tracks: List[TrackItem],
+        cached: bool = False,
     ):
         self.answer = answer
         self.sources = sources
         self.relevant_docs = relevant_docs
         self.tracks = tracks
+        self.cached = cached
+
+
+class ConcurrentLLMChain(LLMChain):
+    """LLMChain whose `apply` sends one LLM call per input on its own thread,
+    at most `max_concurrency` at a time, instead of one call after another.
+
+    Calls that fail or take longer than `timeout` seconds give `failure_output`
+    as their text, so the other inputs still get an answer, only when every
+    call fails the first error is raised.
+    """
+
+    max_concurrency: int = 8
+    timeout: Optional[float] = None
+    failure_output: str = ""
+
+    def generate(self, input_list: List[Dict[str, Any]], run_manager: Optional[CallbackManagerForChainRun] = None) -> LLMResult:
+        prompts, stop = self.prep_prompts(input_list, run_manager=run_manager)
+        callbacks = run_manager.get_child() if run_manager else None
+        calls = [partial(self.llm.generate_prompt, [prompt], stop, callbacks=callbacks, **self.llm_kwargs) for prompt in prompts]
+        results = run_concurrently(calls, self.max_concurrency, self.timeout)
+        failures = [(i, result) for i, result in enumerate(results) if isinstance(result, BaseException)]
+        if failures and len(failures) == len(results):
+            raise failures[0][1]
+        for i, error in failures:
+            logger.warning(f"Map step call {i + 1} of {len(results)} failed: {error!r}")
+        generations = [[Generation(text=self.failure_output)] if isinstance(result, BaseException) else result.generations[0] for result in results]
+        return LLMResult(generations=generations)
+
+
+def concurrent_map_step(chain: Any, max_concurrency: int, timeout: Optional[float] = None) -> Any:
+    """Replaces the map step LLMChain of a map_reduce or map_rerank chain with a ConcurrentLLMChain"""
+    # a failed map_rerank call parses as an empty answer with the lowest score
+    failure_output = "\nScore: 0" if isinstance(chain, MapRerankDocumentsChain) else ""
+    chain.llm_chain = ConcurrentLLMChain(
+        llm=chain.llm_chain.llm,
+        prompt=chain.llm_chain.prompt,
+        callbacks=chain.llm_chain.callbacks,
+        verbose=chain.llm_chain.verbose,
+        max_concurrency=max_concurrency,
+        timeout=timeout,
+        failure_output=failure_output,
+    )
+    return chain
 
 
 def query_folder(
@@ -50,7 +106,46 @@ def query_folder(
     summary_language: str = "English",
     chain_type: str = "stuff",
     callback: TrackerCallbackHandler = None,
+    file_ids: Optional[List[str]] = None,
+    hybrid: bool = False,
+    map_concurrency: int = 1,
+    map_timeout: Optional[float] = None,
+    answer_cache: Optional[AnswerCache] = None,
+    lock: Optional[threading.Lock] = None,
 ) -> AnswerWithSources:
+    """Answers a question from the top_k most similar chunks, searching only
+    the files in `file_ids` when given, with `hybrid` keyword matches are
+    fused with the vector results
+
+    With an `answer_cache`, a question similar enough to one answered before
+    from the same state of the index with the same settings and the same
+    numbers and identifiers gets that answer back without retrieval or LLM calls.
+
+    With `map_concurrency` above 1 the per chunk LLM calls of the map_reduce
+    and map_rerank chains run concurrently, each given up to `map_timeout`
+    seconds, a chunk whose call fails contributes nothing to the answer.
+
+    Retrieval and the lookup of the cited sources hold `lock`, the lock that
+    guards changes of the index, the LLM calls run without it.
+    """
+    if answer_cache is not None:
+        scope = (
+            folder_index.uid,
+            folder_index.generation,
+            getattr(llm, "model_name", type(llm).__name__),
+            chain_type,
+            top_k,
+            summary_language,
+            tuple(file_ids) if file_ids is not None else None,
+            hybrid,
+            # "error 1042" and "error 1043" embed almost the same
+            identifiers(query),
+        )
+        question_vector = folder_index.index.embeddings.embed_query(query)
+        cached = answer_cache.get(scope, question_vector)
+        if cached is not None:
+            return AnswerWithSources(answer=cached.answer, sources=cached.sources, relevant_docs=cached.relevant_docs, tracks=[], cached=True)
+
     if chain_type == "stuff":
         chain = load_qa_with_sources_chain(
             llm=llm,
@@ -76,7 +171,10 @@ def query_folder(
             chain_type=chain_type,
             callbacks=[callback],
         )
-    relevant_docs = folder_index.index.similarity_search(query, k=top_k)
+    if chain_type in ("map_reduce", "map_rerank") and (map_concurrency > 1 or map_timeout is not None):
+        chain = concurrent_map_step(chain, map_concurrency, map_timeout)
+    with lock or nullcontext():
+        relevant_docs = folder_index.similarity_search(query, k=top_k, file_ids=file_ids, hybrid=hybrid)
 
     try:
         # summary_language = detect_language(selection=query)
@@ -88,11 +186,14 @@ def query_folder(
             },
             return_only_outputs=True,
         )
-        sources = get_sources(result["output_text"], folder_index)
+        with lock or nullcontext():
+            sources = get_sources(result["output_text"], folder_index)
         answer = result["output_text"].split("SOURCES: ")[0]
 
         # Translate answer to summary language
         # answer = translate(selection=answer, language=summary_language, llm=llm, callback=callback)
+        if answer_cache is not None:
+            answer_cache.put(scope, question_vector, AnswerWithSources(answer=answer, sources=sources, relevant_docs=relevant_docs, tracks=[]))
     except Exception as e:
         logging.error(e)
         answer = str(e)
@@ -107,11 +208,5 @@ def query_folder(
 def get_sources(answer: str, folder_index: FolderIndex) -> List[Document]:
     """Retrieves the docs that were used to answer the question the generated answer."""
 
-    source_keys = [s for s in answer.split("SOURCES: ")[-1].split(", ")]
-
-    source_docs = []
-    for doc in folder_index.docs:
-        if doc.metadata["source"] in source_keys:
-            source_docs.append(doc)
-
-    return source_docs
+    source_keys = [s.strip() for s in answer.split("SOURCES: ")[-1].split(", ")]
+    return folder_index.find_sources(source_keys)
@@ -0,0 +1,203 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union
+
+import tiktoken
+from langchain.embeddings.base import Embeddings
+
+from langchain_lab import logger
+
+T = TypeVar("T")
+
+
+@lru_cache(maxsize=16)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding used to count tokens of a model"""
+    return tiktoken.encoding_for_model(model_name)
+
+
+def rate_limit_delay(error: Exception) -> Optional[float]:
+    """Returns the Retry-After delay of a 429 error, 0.0 when it has none and None for other errors"""
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status != 429:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return max(float(headers.get("retry-after", 0)), 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class AdaptiveLimit:
+    """Concurrency limit that halves on rate limiting and grows back by one
+    after every `limit` successful calls, pausing all callers for Retry-After.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.active = 0
+        self.paused_until = 0.0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+            delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self, rate_limited: bool = False, delay: float = 0.0):
+        with self._condition:
+            self.active -= 1
+            if rate_limited:
+                self.limit = max(1, self.limit // 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+
+class EmbeddingScheduler(Embeddings):
+    """Embeddings wrapper that sends token-bounded batches concurrently.
+
+    Texts are packed in order into batches of at most `max_batch_tokens` tokens
+    and `max_batch_size` texts, up to `max_concurrency` batches are in flight at
+    a time. Rate limit (429) errors shrink the concurrency, pause every worker for
+    the Retry-After delay (or an exponential backoff) and retry the batch.
+    Vectors are returned in the order of the input texts.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_concurrency: int = 4,
+        max_batch_tokens: int = 100_000,
+        max_batch_size: int = 512,
+        max_retries: int = 6,
+        model_name: str = "gpt-3.5-turbo",
+    ):
+        self.embeddings = embeddings
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.model_name = model_name
+        self.limit = AdaptiveLimit(max_concurrency)
+        self.retries = 0
+
+    def batches(self, texts: List[str]) -> List[List[int]]:
+        """Packs consecutive texts into batches, returned as lists of positions"""
+        token_counts = [len(tokens) for tokens in get_encoding(self.model_name).encode_ordinary_batch(texts)]
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        batch_tokens = 0
+        for i, count in enumerate(token_counts):
+            if batch and (batch_tokens + count > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += count
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _call(self, fn: Callable[[], T]) -> T:
+        attempt = 0
+        while True:
+            self.limit.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                delay = rate_limit_delay(e)
+                if delay is None or attempt >= self.max_retries:
+                    self.limit.release()
+                    raise
+                delay = delay or min(2**attempt, 60)
+                self.limit.release(rate_limited=True, delay=delay)
+                self.retries += 1
+                attempt += 1
+                logger.warning(f"Embedding rate limited, retrying in {delay:.1f}s with concurrency {self.limit.limit}")
+                continue
+            self.limit.release()
+            return result
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        batches = self.batches(texts)
+        results: List[Any] = [None] * len(texts)
+
+        def embed_batch(batch: List[int]):
+            vectors = self._call(lambda: self.embeddings.embed_documents([texts[i] for i in batch]))
+            for i, vector in zip(batch, vectors):
+                results[i] = vector
+
+        if len(batches) == 1:
+            embed_batch(batches[0])
+            return results
+        with ThreadPoolExecutor(max_workers=self.limit.max_concurrency) as executor:
+            # list() re-raises the first failed batch
+            list(executor.map(embed_batch, batches))
+        return results
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call(lambda: self.embeddings.embed_query(text))
+
+
+def run_concurrently(calls: List[Callable[[], T]], max_concurrency: int = 8, timeout: Optional[float] = None) -> List[Union[T, BaseException]]:
+    """Runs the calls on threads, at most `max_concurrency` at a time, and
+    returns their results in order with the exception in place of a failed call.
+
+    A call still running `timeout` seconds after it started fails with a
+    TimeoutError and frees its slot for the next call, its thread is left to
+    finish in the background and its result is discarded.
+    """
+    results: List[Any] = [None] * len(calls)
+    waiting = deque(range(len(calls)))
+    # future -> (position, deadline)
+    running: Dict[Future, Tuple[int, float]] = {}
+    # one thread per call, so calls abandoned on timeout never delay the ones after them
+    executor = ThreadPoolExecutor(max_workers=max(len(calls), 1), thread_name_prefix="map")
+    try:
+        while waiting or running:
+            while waiting and len(running) < max_concurrency:
+                i = waiting.popleft()
+                running[executor.submit(calls[i])] = (i, time.monotonic() + timeout if timeout is not None else float("inf"))
+            next_deadline = min(deadline for _, deadline in running.values())
+            done, _ = wait(running, timeout=None if next_deadline == float("inf") else max(next_deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                i, _ = running.pop(future)
+                error = future.exception()
+                results[i] = error if error is not None else future.result()
+            now = time.monotonic()
+            for future, (i, deadline) in list(running.items()):
+                if deadline <= now:
+                    del running[future]
+                    results[i] = TimeoutError(f"Call did not finish within {timeout}s")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
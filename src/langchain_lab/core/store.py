@@ -0,0 +1,253 @@
+# Copyright 2023 Lei Zhang
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mmap
+import os
+import pickle
+from array import array
+from collections.abc import Sequence
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+from langchain.docstore.base import AddableMixin, Docstore
+from langchain.docstore.document import Document
+
+
+class ChunkStore(Sequence):
+    """Columnar store of chunks, a compact replacement for a list of Documents
+
+    The text of every chunk lives in one utf-8 buffer addressed by an offsets
+    array, page and chunk numbers live in integer arrays and file name/id
+    pairs in a small table shared by all chunks of a file. Sources are derived
+    as "{prefix}{page}-{chunk}". Metadata that does not fit these columns
+    (e.g. web pages whose source is their url) is kept per chunk in a sparse dict.
+
+    The store is a Sequence of Documents, each item is a Document view
+    created on access, so it can be handed to LangChain wherever a list of
+    Documents is expected.
+
+    Rows are append-only. Deleting a chunk leaves a tombstone so row numbers,
+    which the FAISS docstore uses as ids, stay valid. `len` and indexing count
+    every row, deleted rows are skipped by `rows`, `live_count`, `documents`
+    and `find_sources`.
+    """
+
+    _COLUMNS = ("page", "chunk", "source", "file_name", "file_id")
+
+    def __init__(self):
+        self._text = bytearray()
+        self._offsets = array("q", [0])
+        self._pages = array("i")
+        self._chunks = array("i")
+        self._file_index = array("i")
+        # (file_name, file_id, source_prefix)
+        self._files: List[tuple[str, str, str]] = []
+        self._file_lookup: Dict[tuple[str, str, str], int] = {}
+        self._extra: Dict[int, dict[str, Any]] = {}
+        self._deleted: Set[int] = set()
+
+    @classmethod
+    def from_documents(cls, docs: Iterable[Document]) -> "ChunkStore":
+        store = cls()
+        store.extend(docs)
+        return store
+
+    def add_file(self, name: str, id: str, source_prefix: str = "") -> int:
+        """Registers a file and returns its index for `append`"""
+        key = (name, id, source_prefix)
+        if key not in self._file_lookup:
+            self._file_lookup[key] = len(self._files)
+            self._files.append(key)
+        return self._file_lookup[key]
+
+    def append(self, text: str, page: int = 1, chunk: int = 1, file_index: int = -1, extra: Optional[dict[str, Any]] = None) -> int:
+        """Appends a chunk and returns its row"""
+        row = len(self._pages)
+        if not isinstance(self._text, bytearray):
+            # copy a memory-mapped text buffer on the first write
+            self._text = bytearray(self._text)
+        self._text += text.encode("utf-8")
+        self._offsets.append(len(self._text))
+        self._pages.append(page)
+        self._chunks.append(chunk)
+        self._file_index.append(file_index)
+        if extra:
+            self._extra[row] = extra
+        return row
+
+    def append_document(self, doc: Document) -> int:
+        """Appends a Document, keeping metadata the columns can not express as extra"""
+        metadata = doc.metadata
+        page = metadata.get("page", 1)
+        chunk = metadata.get("chunk", 1)
+        source = str(metadata.get("source", ""))
+        suffix = f"{page}-{chunk}"
+        file_index = -1
+        extra = {key: value for key, value in metadata.items() if key not in self._COLUMNS}
+        if not isinstance(page, int) or not isinstance(chunk, int):
+            extra.update(page=page, chunk=chunk)
+            page, chunk = 1, 1
+        if "file_name" in metadata or "file_id" in metadata:
+            prefix = source.removesuffix(suffix) if source.endswith(suffix) else ""
+            file_index = self.add_file(metadata.get("file_name", ""), metadata.get("file_id", ""), prefix)
+        if "source" not in metadata:
+            extra["source"] = None
+        elif not source.endswith(suffix) or (file_index == -1 and source != suffix):
+            extra["source"] = metadata["source"]
+        return self.append(doc.page_content, page=page, chunk=chunk, file_index=file_index, extra=extra)
+
+    def extend(self, docs: Iterable[Document]):
+        for doc in docs:
+            self.append_document(doc)
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def delete(self, rows: Iterable[int]):
+        """Marks rows as deleted"""
+        self._deleted.update(rows)
+
+    def is_deleted(self, row: int) -> bool:
+        return row in self._deleted
+
+    def rows(self) -> Iterator[int]:
+        """Rows that are not deleted"""
+        for row in range(len(self)):
+            if row not in self._deleted:
+                yield row
+
+    def live_count(self) -> int:
+        """Number of rows that are not deleted"""
+        return len(self) - len(self._deleted)
+
+    def documents(self) -> Iterator[Document]:
+        """Documents of the rows that are not deleted"""
+        for row in self.rows():
+            yield self.document(row)
+
+    def text(self, row: int) -> str:
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return self._text[start:end].decode("utf-8")
+
+    def texts(self) -> Iterator[str]:
+        for row in range(len(self)):
+            yield self.text(row)
+
+    def source(self, row: int) -> Optional[str]:
+        extra = self._extra.get(row)
+        if extra is not None and "source" in extra:
+            return extra["source"]
+        prefix = self._files[self._file_index[row]][2] if self._file_index[row] >= 0 else ""
+        return f"{prefix}{self._pages[row]}-{self._chunks[row]}"
+
+    def file_id(self, row: int) -> Optional[str]:
+        return self._files[self._file_index[row]][1] if self._file_index[row] >= 0 else None
+
+    def files(self) -> Dict[str, str]:
+        """file_id -> file_name of the files registered in the store"""
+        return {id: name for name, id, _ in self._files}
+
+    def metadata(self, row: int) -> dict[str, Any]:
+        metadata: dict[str, Any] = {"page": self._pages[row], "chunk": self._chunks[row], "source": self.source(row)}
+        if self._file_index[row] >= 0:
+            name, id, _ = self._files[self._file_index[row]]
+            metadata["file_name"] = name
+            metadata["file_id"] = id
+        extra = self._extra.get(row)
+        if extra:
+            metadata.update(extra)
+        if metadata["source"] is None:
+            del metadata["source"]
+        return metadata
+
+    def document(self, row: int) -> Document:
+        """Creates a Document view of a row"""
+        return Document(page_content=self.text(row), metadata=self.metadata(row))
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[Document, List[Document]]:
+        if isinstance(item, slice):
+            return [self.document(row) for row in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("ChunkStore index out of range")
+        return self.document(item)
+
+    def find_sources(self, sources: Iterable[str]) -> List[int]:
+        """Returns the rows whose source is one of `sources`, in row order"""
+        wanted = set(sources)
+        return [row for row in self.rows() if self.source(row) in wanted]
+
+    def save(self, path: str):
+        """Writes the store to a directory, the text buffer as a raw file that `load` maps into memory"""
+        with open(os.path.join(path, "chunks.bin"), "wb") as f:
+            f.write(self._text)
+        columns = {
+            "offsets": self._offsets.tobytes(),
+            "pages": self._pages.tobytes(),
+            "chunks": self._chunks.tobytes(),
+            "file_index": self._file_index.tobytes(),
+            "files": self._files,
+            "extra": self._extra,
+            "deleted": self._deleted,
+        }
+        with open(os.path.join(path, "chunks.pkl"), "wb") as f:
+            pickle.dump(columns, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: str) -> "ChunkStore":
+        """Opens a store written by `save`, the text buffer is memory-mapped read-only and shared between processes"""
+        store = cls()
+        with open(os.path.join(path, "chunks.pkl"), "rb") as f:
+            columns = pickle.load(f)
+        store._offsets = array("q", columns["offsets"])
+        store._pages = array("i", columns["pages"])
+        store._chunks = array("i", columns["chunks"])
+        store._file_index = array("i", columns["file_index"])
+        store._files = columns["files"]
+        store._file_lookup = {key: index for index, key in enumerate(store._files)}
+        store._extra = columns["extra"]
+        store._deleted = columns["deleted"]
+        if store._offsets[-1] > 0:
+            with open(os.path.join(path, "chunks.bin"), "rb") as f:
+                store._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return store
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the columns"""
+        columns = (self._offsets, self._pages, self._chunks, self._file_index)
+        return len(self._text) + sum(column.itemsize * len(column) for column in columns)
+
+
+class ChunkStoreDocstore(Docstore, AddableMixin):
+    """LangChain docstore serving Document views out of a ChunkStore, ids are row numbers"""
+
+    def __init__(self, store: ChunkStore):
+        self.store = store
+
+    def search(self, search: str) -> Union[str, Document]:
+        try:
+            row = int(search)
+        except ValueError:
+            return f"ID {search} not found."
+        if not 0 <= row < len(self.store) or self.store.is_deleted(row):
+            return f"ID {search} not found."
+        return self.store.document(row)
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        for id, doc in texts.items():
+            if id != str(len(self.store)):
+                raise ValueError(f"ChunkStoreDocstore ids must be the next row number, got {id}")
+            self.store.append_document(doc)
+
+    def delete(self, ids: List) -> None:
+        self.store.delete(int(id) for id in ids)
@@ -12,22 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import re
+import threading
+import time
 from datetime import datetime
-from typing import Any, List
+from typing import Any, List, Optional
 
 import streamlit as st
 from bs4 import BeautifulSoup as Soup
 from langchain_core.documents import Document
 
 from langchain_lab import logger
+from langchain_lab.core.cache import get_answer_cache, get_parse_cache
+from langchain_lab.core.chunking import chunk_file
+from langchain_lab.core.faiss_index import set_search_params
+from langchain_lab.core.pipeline import IngestProgress, ingest_files
+from langchain_lab.core.store import ChunkStore
 from langchain_lab.core.summary import summarize
 from langchain_lab.langchain_community.document_loaders.recursive_url_loader import (
     RecursiveUrlLoader,
 )
 from langchain_lab.scenarios.error import display_error
-from src.langchain_lab.core.chunking import chunk_file
-from src.langchain_lab.core.embedding import embed_docs
-from src.langchain_lab.core.parsing import File, read_file
+from src.langchain_lab.core.embedding import (
+    FolderIndex,
+    embed_docs,
+    folder_index_key,
+    load_folder_index,
+    number_files,
+    save_folder_index,
+)
+from src.langchain_lab.core.parsing import File, content_hash, read_buffer, read_files
 from src.langchain_lab.core.qa import query_folder
 from src.langchain_lab.scenarios.debug import show_debug
 
@@ -74,18 +87,34 @@ def splitting_url(url: str, chunk_size: int, chunk_overlap: int):
 
 
 @st.cache_resource
-def splitting_file(uploaded_file, chunk_size: int, chunk_overlap: int):
-    __file = read_file(uploaded_file)
-    if not is_file_valid(__file):
-        st.stop()
+def splitting_files(uploaded_files, chunk_size: int, chunk_overlap: int):
     start_time = datetime.now()
-    with st.spinner(f"Spitting document {uploaded_file.name}. This may take a while⏳"):
-        docs = chunk_file(__file, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    files = []
+    with st.status(f"Reading {len(uploaded_files)} uploads. This may take a while⏳", expanded=True) as status:
+        for index, name, result in read_files(uploaded_files, cache=get_parse_cache()):
+            if isinstance(result, Exception):
+                status.write(f"❌ {name}: {result}")
+            elif is_file_valid(result):
+                status.write(f"📄 {name} ({len(result.docs)} pages)")
+                files.append((index, result))
+            else:
+                status.write(f"❌ {name}")
+        status.update(label=f"Read {len(files)} documents", state="complete", expanded=False)
+    if not files:
+        st.error("Cannot read any document!")
+        st.stop()
+
+    with st.spinner(f"Spitting {len(files)} documents. This may take a while⏳"):
+        docs = ChunkStore()
+        for number, (_, file) in enumerate(sorted(files, key=lambda item: item[0]), start=1):
+            # sources are prefixed with the file number once there is more than one file
+            source_prefix = f"{number}-" if len(files) > 1 else ""
+            chunk_file(file, chunk_size=chunk_size, chunk_overlap=chunk_overlap, store=docs, source_prefix=source_prefix, use_token_index=True)
         with st.expander(f"Document {len(docs)}"):
             for index, doc in enumerate(docs):
                 if index > 0:
                     st.write("---")
-                st.write(f"📄 {index}-{doc.metadata['source']}")
+                st.write(f"📄 {index}-{doc.metadata['file_name']}-{doc.metadata['source']}")
                 try:
                     st.text(doc.page_content)
                 except Exception as e:
@@ -102,7 +131,15 @@ def splitting_file(uploaded_file, chunk_size: int, chunk_overlap: int):
 
 
 @st.cache_resource
-def indexing_documents(file_name: str, embedding_model, _docs: List[Document], cache_flag: Any = None):
+def indexing_documents(
+    file_name: str,
+    embedding_model,
+    _docs: List[Document],
+    cache_flag: Any = None,
+    dedup: bool = False,
+    index_key: Optional[str] = None,
+    index_options: Optional[dict] = None,
+):
     try:
         start_time = datetime.now()
         with st.spinner(f"Indexing **{file_name}** This may take a while⏳"):
@@ -110,18 +147,149 @@ def indexing_documents(file_name: str, embedding_model, _docs: List[Document], c
                 docs=_docs,
                 vector_store="faiss",
                 embedding=st.session_state["EMBEDDING"],
+                dedup=dedup,
+                **(index_options or {}),
             )
             st.session_state["folder_index"] = folder_index
+            if index_key is not None:
+                save_folder_index(folder_index, index_key)
             end_time = datetime.now()
             time_diff = end_time - start_time
             seconds_diff = time_diff.total_seconds()
             st.info(f"Completed **{len(_docs)}** sections indexes by **{embedding_model}**! ({seconds_diff}s)")
+            if dedup:
+                removed = len(folder_index.duplicates)
+                st.info(f"Removed **{removed}** duplicate sections, saved **{removed}** embedding calls")
 
     except Exception as e:
         logger.error(e)
         display_error(e)
 
 
+@st.cache_resource
+def get_saved_index(index_key: str, nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> dict:
+    """Holder of a saved index shared by every session of this server process, empty until the index is found on disk"""
+    return {"index": None, "lock": threading.Lock()}
+
+
+def opening_index(file_name: str, index_key: str, embedding, nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> Optional[FolderIndex]:
+    """Loads a FolderIndex saved by an earlier run, returns None when the files were never indexed with these settings
+
+    Only found indexes are kept, cache_resource would also keep a miss and
+    never see the index a session saves later.
+    """
+    holder = get_saved_index(index_key, nprobe=nprobe, ef_search=ef_search)
+    with holder["lock"]:
+        if holder["index"] is None:
+            start_time = datetime.now()
+            folder_index = load_folder_index(index_key, embedding)
+            if folder_index is None:
+                return None
+            set_search_params(folder_index.index.index, nprobe=nprobe, ef_search=ef_search)
+            seconds_diff = (datetime.now() - start_time).total_seconds()
+            st.info(f"Opened saved index of **{file_name}** with **{folder_index.docs.live_count()}** sections ({seconds_diff}s)")
+            holder["index"] = folder_index
+    return holder["index"]
+
+
+@st.cache_resource
+def streaming_documents(index_key: str, _files, _embedding, chunk_size: int, chunk_overlap: int, dedup: bool = False, index_options: Optional[dict] = None) -> dict:
+    """Ingests uploads on a thread that outlives script reruns, the holder gets the index as soon as its first sections are indexed"""
+    holder = {"index": None, "lock": threading.Lock(), "progress": IngestProgress(), "error": None}
+
+    def ingest():
+        try:
+            stream = ingest_files(
+                _files, _embedding, chunk_size, chunk_overlap, dedup=dedup, progress=holder["progress"], lock=holder["lock"], cache=get_parse_cache(), **(index_options or {})
+            )
+            for folder_index in stream:
+                holder["index"] = folder_index
+            if holder["index"] is not None:
+                save_folder_index(holder["index"], index_key)
+        except Exception as e:
+            logger.error(e)
+            holder["error"] = e
+            holder["progress"].done = True
+
+    threading.Thread(target=ingest, name=f"ingest-{index_key}", daemon=True).start()
+    return holder
+
+
+def show_streaming(file_name: str, holder: dict) -> FolderIndex:
+    """Waits for the first indexed sections of a streaming ingestion and reports its progress"""
+    progress = holder["progress"]
+    with st.spinner(f"Indexing **{file_name}** This may take a while⏳"):
+        while holder["index"] is None and not progress.done:
+            time.sleep(0.2)
+    for name, error in progress.failed:
+        st.error(f"❌ {name}: {error}")
+    if holder["error"] is not None:
+        display_error(holder["error"])
+    if holder["index"] is None:
+        st.error("Cannot read any document!")
+        st.stop()
+    if progress.done:
+        st.info(
+            f"Completed **{progress.indexed}** sections of **{progress.files}** documents, "
+            f"first sections searchable after {progress.first_indexed:.1f}s ({progress.seconds:.1f}s)"
+        )
+        if progress.duplicates:
+            st.info(f"Removed **{progress.duplicates}** duplicate sections, saved **{progress.duplicates}** embedding calls")
+    else:
+        st.info(f"Indexed **{progress.indexed}** of **{progress.chunks}** sections from **{progress.pages}** pages so far, answers use the indexed sections")
+    return holder["index"]
+
+
+@st.cache_resource
+def get_collection(key: str) -> dict:
+    """Holder of the collection shared by every session of this server process"""
+    return {"index": None, "lock": threading.Lock()}
+
+
+def collection_key() -> str:
+    embedding = st.session_state["EMBEDDING"]
+    index_options = get_index_options()
+    return folder_index_key(
+        [],
+        getattr(embedding, "namespace", st.session_state["EMBED_MODEL_NAME"]),
+        st.session_state["CHUNK_SIZE"],
+        st.session_state["CHUNK_OVERLAP"],
+        collection=True,
+        index_type=index_options["index_type"],
+        quantization=index_options["quantization"],
+    )
+
+
+@st.cache_resource
+def collecting_documents(key: str, _embedding, _docs: ChunkStore, cache_flag: Any = None, dedup: bool = False, index_options: Optional[dict] = None) -> FolderIndex:
+    """Adds the files of an upload to the shared collection, only files it does not hold yet are embedded"""
+    collection = get_collection(key)
+    with collection["lock"], st.spinner("Adding documents to the collection. This may take a while⏳"):
+        start_time = datetime.now()
+        if collection["index"] is None:
+            collection["index"] = load_folder_index(key, _embedding)
+        if collection["index"] is None:
+            store = ChunkStore.from_documents(number_files(_docs))
+            collection["index"] = embed_docs(docs=store, embedding=_embedding, vector_store="faiss", dedup=dedup, **(index_options or {}))
+            added = list(store.files())
+        else:
+            added = collection["index"].add_files(_docs)
+        if added:
+            save_folder_index(collection["index"], key)
+        seconds_diff = (datetime.now() - start_time).total_seconds()
+        st.info(f"Added **{len(added)}** documents to the collection of **{len(collection['index'].files())}** documents ({seconds_diff}s)")
+        return collection["index"]
+
+
+def get_index_options() -> dict:
+    return {
+        "index_type": st.session_state.get("INDEX_TYPE", "auto"),
+        "quantization": st.session_state.get("INDEX_QUANTIZATION", "none"),
+        "nprobe": st.session_state.get("INDEX_NPROBE") or None,
+        "ef_search": st.session_state.get("INDEX_EF_SEARCH", 64),
+    }
+
+
 @st.cache_resource
 def summarize_documents(_docs: List[Document], cache_flag: Any = None):
     if st.session_state.get("SUMMARIZE", False):
@@ -132,7 +300,7 @@ def summarize_documents(_docs: List[Document], cache_flag: Any = None):
 
 
 def is_file_valid(file: File) -> bool:
-    if len(file.docs) == 0 or "".join([doc.page_content for doc in file.docs]).strip() == "":
+    if not any(doc.page_content.strip() for doc in file.iter_docs()):
         st.error("Cannot read document! Make sure the document has selectable text")
         logger.error("Cannot read document")
         return False
@@ -164,6 +332,8 @@ def init_document_scenario():
                     embedding_model=st.session_state["EMBED_MODEL_NAME"],
                     cache_flag=datetime.now(),
                     _docs=docs,
+                    dedup=st.session_state.get("DEDUPLICATE", False),
+                    index_options=get_index_options(),
                 )
                 btn_clicked = True
 
@@ -174,24 +344,83 @@ def init_document_scenario():
                     splitting_url(url=url_input, chunk_size=st.session_state["CHUNK_SIZE"], chunk_overlap=st.session_state["CHUNK_OVERLAP"])
 
     elif document_type == "FILE":
-        file = st.file_uploader(
-            "Upload a pdf, docx, txt or csv file",
-            type=["pdf", "docx", "txt", "csv", "md"],
+        files = st.file_uploader(
+            "Upload pdf, docx, txt, csv, md files or zip archives of them",
+            type=["pdf", "docx", "txt", "csv", "md", "zip"],
+            accept_multiple_files=True,
             help="Scanned documents are not supported yet!",
         )
 
-        if file:
-            docs = splitting_file(file, st.session_state["CHUNK_SIZE"], st.session_state["CHUNK_OVERLAP"])
-            summarize_documents(
-                docs,
-                cache_flag=file.file_id,
-            )
-            indexing_documents(
-                file_name=file.name,
-                embedding_model=st.session_state["EMBED_MODEL_NAME"],
-                cache_flag=file.file_id,
+        st.session_state["FILE_IDS"] = None
+        st.session_state["FOLDER_INDEX_LOCK"] = None
+        if files and st.session_state.get("COLLECTION", False):
+            cache_flag = ",".join(file.file_id for file in files)
+            docs = splitting_files(files, st.session_state["CHUNK_SIZE"], st.session_state["CHUNK_OVERLAP"])
+            summarize_documents(docs, cache_flag=cache_flag)
+            key = collection_key()
+            folder_index = collecting_documents(
+                key,
+                st.session_state["EMBEDDING"],
                 _docs=docs,
+                cache_flag=cache_flag,
+                dedup=st.session_state.get("DEDUPLICATE", False),
+                index_options=get_index_options(),
             )
+            st.session_state["folder_index"] = folder_index
+            # other sessions add files to the shared collection while this one searches it
+            st.session_state["FOLDER_INDEX_LOCK"] = get_collection(key)["lock"]
+            collection_files = folder_index.files()
+            st.session_state["FILE_IDS"] = (
+                st.multiselect(
+                    "Search in",
+                    options=list(collection_files),
+                    default=[file_id for file_id in docs.files() if file_id in collection_files],
+                    format_func=lambda file_id: collection_files[file_id],
+                    help="Documents of the shared collection to answer from, all of them when empty",
+                )
+                or None
+            )
+        elif files:
+            file_name = ", ".join(file.name for file in files)
+            cache_flag = ",".join(file.file_id for file in files)
+            embedding = st.session_state["EMBEDDING"]
+            dedup = st.session_state.get("DEDUPLICATE", False)
+            index_options = get_index_options()
+            index_key = folder_index_key(
+                [content_hash(read_buffer(file)) for file in files],
+                getattr(embedding, "namespace", st.session_state["EMBED_MODEL_NAME"]),
+                st.session_state["CHUNK_SIZE"],
+                st.session_state["CHUNK_OVERLAP"],
+                dedup=dedup,
+                index_type=index_options["index_type"],
+                quantization=index_options["quantization"],
+            )
+            folder_index = opening_index(file_name, index_key, embedding, nprobe=index_options["nprobe"], ef_search=index_options["ef_search"])
+            if folder_index is not None:
+                st.session_state["folder_index"] = folder_index
+                # a saved index may hold deleted rows
+                summarize_documents(list(folder_index.docs.documents()), cache_flag=cache_flag)
+            elif st.session_state.get("STREAMING", False):
+                holder = streaming_documents(index_key, files, embedding, st.session_state["CHUNK_SIZE"], st.session_state["CHUNK_OVERLAP"], dedup, index_options)
+                st.session_state["folder_index"] = show_streaming(file_name, holder)
+                st.session_state["FOLDER_INDEX_LOCK"] = holder["lock"]
+                if holder["progress"].done:
+                    summarize_documents(holder["index"].docs, cache_flag=cache_flag)
+            else:
+                docs = splitting_files(files, st.session_state["CHUNK_SIZE"], st.session_state["CHUNK_OVERLAP"])
+                summarize_documents(
+                    docs,
+                    cache_flag=cache_flag,
+                )
+                indexing_documents(
+                    file_name=file_name,
+                    embedding_model=st.session_state["EMBED_MODEL_NAME"],
+                    cache_flag=cache_flag,
+                    _docs=docs,
+                    dedup=dedup,
+                    index_key=index_key,
+                    index_options=index_options,
+                )
         else:
             st.stop()
 
@@ -215,8 +444,18 @@ def init_document_scenario():
                         top_k=st.session_state["EMBED_TOP_K"],
                         summary_language=st.session_state["SUMMARY_LANGUAGE"],
                         chain_type=st.session_state["CHAIN_TYPE"],
+                        file_ids=st.session_state.get("FILE_IDS"),
+                        hybrid=st.session_state.get("HYBRID_SEARCH", False),
+                        map_concurrency=st.session_state.get("MAP_CONCURRENCY", 1),
+                        map_timeout=st.session_state.get("MAP_TIMEOUT"),
+                        answer_cache=get_answer_cache() if st.session_state.get("ANSWER_CACHE", False) else None,
+                        # a streaming ingestion or another session adding to the collection changes the index under this lock
+                        lock=st.session_state.get("FOLDER_INDEX_LOCK"),
                     )
                     st.balloons()
+                    if result.cached:
+                        stats = get_answer_cache().stats()
+                        st.caption(f"Answered from the cache of similar questions ({stats['hits']} hits, {stats['misses']} misses, {stats['hit_rate']:.0%} hit rate)")
                     if st.session_state["LANGCHAIN_DEBUG"]:
                         show_debug(st, result.tracks)
                         # Output Columns
@@ -225,8 +464,12 @@ def init_document_scenario():
                             st.markdown("#### Answer")
                             st.markdown(result.answer)
                             st.markdown("#### Sources")
+                            folder_index = st.session_state["folder_index"]
                             for source in result.sources:
                                 st.text(f'📄{source.metadata["source"]} {source.page_content}')
+                                also_in = folder_index.duplicates_of(source.metadata["source"])
+                                if also_in:
+                                    st.caption(f"Also in {', '.join(also_in)}")
                                 st.markdown("---")
 
                         with sources_col:
@@ -240,16 +483,3 @@ def init_document_scenario():
                 except Exception as e:
                     st.error(e)
                     logger.error(e)
-
-
-def files_to_docs(files: List[File]) -> List[Document]:
-    """Combines all the documents in a list of files into a single list."""
-
-    all_texts = []
-    for file in files:
-        for doc in file.docs:
-            doc.metadata["file_name"] = file.name
-            doc.metadata["file_id"] = file.id
-            all_texts.append(doc)
-
-    return all_texts
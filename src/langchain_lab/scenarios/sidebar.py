@@ -19,6 +19,7 @@ import streamlit as st
 
 from langchain_lab import logger
 from langchain_lab.core.agents import get_agent_by_name, get_agent_list
+from langchain_lab.core.faiss_index import FAISS_INDEX_TYPES, QUANTIZATIONS
 from langchain_lab.core.translate import LANGUAGES
 from src.langchain_lab.core.embedding import embedding_init
 from src.langchain_lab.core.huggingface import download_hugging_face_model
@@ -68,6 +69,25 @@ def load_embedding(embedding_provider, model_kwargs):
     )
 
 
+def map_step_settings():
+    concurrency = st.slider(
+        "MAP CONCURRENCY",
+        1,
+        16,
+        int(os.environ.get("LANGCHAIN_LAB_MAP_CONCURRENCY", 8)),
+        help="LLM calls of the map step that run at the same time, 1 calls them one after another",
+    )
+    st.session_state["MAP_CONCURRENCY"] = concurrency
+    timeout = st.number_input(
+        "MAP TIMEOUT (s)",
+        0,
+        600,
+        int(os.environ.get("LANGCHAIN_LAB_MAP_TIMEOUT", 60)),
+        help="Seconds a single map step call may take before its chunk is left out, 0 waits for every call",
+    )
+    st.session_state["MAP_TIMEOUT"] = timeout or None
+
+
 def left_sidebar():
     if "DEBUG_CALLBACK" not in st.session_state:
         st.session_state["DEBUG_CALLBACK"] = TrackerCallbackHandler(st)
@@ -188,12 +208,14 @@ def left_sidebar():
                     documents chain (which will often pass them to an LLM). \
                     This compression step is performed recursively if necessary."
                     )
+                    map_step_settings()
                 elif chain_type == "map_rerank":
                     st.info(
                         "The map re-rank documents chain runs an initial prompt on each document, \
                     that not only tries to complete a task but also gives a score for how certain it is in its answer. \
                     The highest scoring response is returned."
                     )
+                    map_step_settings()
                 else:
                     st.error("Chain type not supported")
 
@@ -215,12 +237,50 @@ def left_sidebar():
                     APIs[ai_platform]["embedding"]["model_kwargs"],
                 )
                 chunk_size = st.slider("Chunk Size", 0, 5000, 200)
-                chunk_overlap = st.slider("Chunk Overlap", 0, chunk_size, 20)
+                # an overlap of a whole chunk would never advance
+                max_overlap = max(chunk_size - 1, 1)
+                chunk_overlap = st.slider("Chunk Overlap", 0, max_overlap, min(20, max_overlap))
                 st.session_state["CHUNK_SIZE"] = chunk_size
                 st.session_state["CHUNK_OVERLAP"] = chunk_overlap
 
+                deduplicate = st.toggle("DEDUPLICATE", value=False, help="Embed identical and near-identical sections only once")
+                st.session_state["DEDUPLICATE"] = deduplicate
+
+                collection = st.toggle("COLLECTION", value=False, help="Add uploads to a shared collection and search any selection of its documents")
+                st.session_state["COLLECTION"] = collection
+
+                streaming = st.toggle(
+                    "STREAMING", value=False, help="Parse, split, embed and index pages as they are read, questions can be asked while large documents are still indexing"
+                )
+                st.session_state["STREAMING"] = streaming
+
+                index_type = st.selectbox(
+                    "INDEX TYPE",
+                    FAISS_INDEX_TYPES,
+                    help="auto uses exact search for small documents and IVF-Flat from 20k sections, HNSW does not support removing sections",
+                )
+                st.session_state["INDEX_TYPE"] = index_type
+                quantization = st.selectbox(
+                    "QUANTIZATION",
+                    list(QUANTIZATIONS),
+                    help="Store vectors as float16 or int8 codes, the best candidates are rescored at full precision",
+                )
+                st.session_state["INDEX_QUANTIZATION"] = quantization
+                if index_type in ("auto", "ivf_flat", "ivf_pq"):
+                    st.session_state["INDEX_NPROBE"] = st.number_input("nprobe", 0, 1024, 0, help="Inverted lists visited per query, 0 for nlist / 16")
+                if index_type == "hnsw":
+                    st.session_state["INDEX_EF_SEARCH"] = st.number_input("efSearch", 16, 1024, 64, help="Candidates kept during an HNSW search")
+
                 embed_top_k = st.slider("Top K", 0, 50, 3)
                 st.session_state["EMBED_TOP_K"] = embed_top_k
+                hybrid_search = st.toggle("HYBRID SEARCH", value=True, help="Also match exact keywords such as names, identifiers and error codes (BM25)")
+                st.session_state["HYBRID_SEARCH"] = hybrid_search
+                answer_cache = st.toggle(
+                    "ANSWER CACHE",
+                    value=False,
+                    help="Answer questions nearly identical to one asked before about the same documents, with the same numbers and identifiers, from the cache",
+                )
+                st.session_state["ANSWER_CACHE"] = answer_cache
         elif scenario == "AGENT":
             # clear chat history when changing scenario
             st.session_state.chat_messages = []
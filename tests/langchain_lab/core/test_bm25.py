@@ -0,0 +1,68 @@
+import tempfile
+import unittest
+from unittest import TestCase
+
+from langchain.docstore.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.bm25 import BM25Index, reciprocal_rank_fusion, tokenize
+from langchain_lab.core.embedding import FolderIndex, embed_docs
+from langchain_lab.core.store import ChunkStore
+
+TEXTS = [
+    "The service failed to start after the upgrade",
+    "Error E1042 means the license key has expired",
+    "Restart the service to pick up the new configuration",
+    "向量检索和关键词检索可以结合使用",
+]
+
+
+class TestBM25(TestCase):
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("Error E1042: max_retries"), ["error", "e1042", "max", "retries"])
+        self.assertEqual(tokenize("关键词检索 BM25"), ["关键", "键词", "词检", "检索", "bm25"])
+        self.assertEqual(tokenize("中"), ["中"])
+
+    def test_search(self):
+        index = BM25Index.from_texts(enumerate(TEXTS))
+        self.assertEqual(index.search("E1042")[0][0], 1)
+        self.assertEqual([doc_id for doc_id, _ in index.search("service")], [0, 2])
+        self.assertEqual(index.search("关键词")[0][0], 3)
+        self.assertEqual(index.search("service", allowed=[2, 3]), index.search("service")[1:])
+        self.assertEqual(index.search("unknown"), [])
+
+    def test_delete(self):
+        index = BM25Index.from_texts(enumerate(TEXTS))
+        index.delete([0, 0])
+        self.assertEqual(len(index), 3)
+        self.assertEqual([doc_id for doc_id, _ in index.search("service")], [2])
+        index.add(4, "the service")
+        self.assertEqual(index.search("service")[0][0], 4)
+        with self.assertRaises(ValueError):
+            index.add(0, "the service")
+
+    def test_reciprocal_rank_fusion(self):
+        self.assertEqual(reciprocal_rank_fusion([[1, 2, 3], [3, 1]]), [1, 3, 2])
+        self.assertEqual(reciprocal_rank_fusion([[], [5]]), [5])
+
+    def test_hybrid_search(self):
+        docs = [Document(page_content=text, metadata={"source": f"1-1-{i}", "file_id": "a" if i < 2 else "b"}) for i, text in enumerate(TEXTS)]
+        embedding = DeterministicFakeEmbedding(size=16)
+        for store in (docs, ChunkStore.from_documents(docs)):
+            folder_index = embed_docs(docs=store, embedding=embedding, vector_store="faiss")
+            self.assertEqual(folder_index.similarity_search("what is E1042", k=1, hybrid=True)[0].page_content, TEXTS[1])
+            self.assertEqual(folder_index.similarity_search("service", k=2, hybrid=True, file_ids=["b"])[0].page_content, TEXTS[2])
+            folder_index.delete(["1-1-1"])
+            folder_index.add_documents([Document(page_content="E1042 is fixed in 2.1", metadata={"source": "1-1-9", "file_id": "a"})])
+            self.assertEqual(folder_index.similarity_search("E1042", k=1, hybrid=True)[0].metadata["source"], "1-1-9")
+
+        with tempfile.TemporaryDirectory() as path:
+            folder_index.save(f"{path}/index")
+            loaded = FolderIndex.load(f"{path}/index", embedding)
+            self.assertEqual(len(loaded.keyword_index()), 4)
+            self.assertEqual(loaded.similarity_search("E1042", k=1, hybrid=True)[0].metadata["source"], "1-1-9")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.cache import AnswerCache, CachedEmbeddings, EmbeddingCache, ParseCache
+from langchain_lab.core.embedding import embed_docs
+from langchain_lab.core.llm import TrackerCallbackHandler
+from langchain_lab.core.parsing import PdfFile, read_file
+from langchain_lab.core.qa import query_folder
+from tests.langchain_lab.core.test_parsing import make_pdf, make_upload
+
+
+class TestParseCache(TestCase):
+
+    def test_read_file_hits_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ParseCache(path)
+            data = make_pdf(3)
+            first = read_file(make_upload(data, "a.pdf"), cache=cache)
+            with patch.object(PdfFile, "from_bytes", side_effect=AssertionError("parser called")):
+                second = read_file(make_upload(data, "a.pdf"), cache=cache)
+            self.assertEqual(first, second)
+            self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5})
+
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ParseCache(path, max_bytes=10_000)
+            for i in range(10):
+                cache.put(f"k{i}", f"id{i}", {}, [Document(page_content=os.urandom(1000).hex())])
+            self.assertIsNone(cache.get("k0"))
+            self.assertEqual(cache.get("k9")[0], "id9")
+
+
+class TestEmbeddingCache(TestCase):
+
+    def test_cached_embeddings(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = EmbeddingCache(os.path.join(path, "embeddings.sqlite"))
+            fake = DeterministicFakeEmbedding(size=8)
+            embeddings = CachedEmbeddings(fake, cache=cache, namespace="fake:8")
+            first = embeddings.embed_documents(["a", "b", "a"])
+            with patch.object(DeterministicFakeEmbedding, "embed_documents", side_effect=AssertionError("model called")):
+                second = embeddings.embed_documents(["b", "a"])
+            self.assertEqual(second, [first[1], first[0]])
+            np.testing.assert_allclose(first[0], fake.embed_documents(["a"])[0], rtol=1e-3, atol=1e-3)
+            self.assertEqual(cache.stats(), {"hits": 2, "misses": 3, "hit_rate": 0.4})
+
+            embeddings.embed_query("a")
+            self.assertEqual(len(cache), 3)
+            other = CachedEmbeddings(DeterministicFakeEmbedding(size=4), cache=cache, namespace="fake:4")
+            self.assertEqual(len(other.embed_documents(["a"])[0]), 4)
+
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = EmbeddingCache(os.path.join(path, "embeddings.sqlite"), max_bytes=2 * 1024 * 10)
+            for i in range(30):
+                cache.put_many({f"k{i}": np.ones(1024)})
+                cache.get_many(["k0"])
+            self.assertLessEqual(len(cache), 10)
+            self.assertEqual(set(cache.get_many(["k0", "k1", "k29"])), {"k0", "k29"})
+
+
+class BagOfWordsEmbedding(Embeddings):
+    """Questions with mostly the same words get similar vectors"""
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = np.zeros(64)
+        for word in text.lower().replace("?", "").split():
+            vector[sum(word.encode()) % 64] += 1
+        return vector.tolist()
+
+
+class TestAnswerCache(TestCase):
+
+    def test_similarity_threshold_and_scope(self):
+        cache = AnswerCache(threshold=0.9)
+        cache.put("a", [1.0, 0.0], "east")
+        self.assertEqual(cache.get("a", [10.0, 1.0]), "east")
+        self.assertIsNone(cache.get("a", [1.0, 1.0]))
+        self.assertEqual(cache.get("a", [1.0, 1.0], threshold=0.7), "east")
+        self.assertIsNone(cache.get("b", [1.0, 0.0]))
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "hit_rate": 0.5, "entries": 1})
+
+    def test_lru_and_ttl(self):
+        cache = AnswerCache(max_entries=2, ttl=60)
+        cache.put("a", [1.0, 0.0], 1)
+        cache.put("a", [0.0, 1.0], 2)
+        self.assertEqual(cache.get("a", [1.0, 0.0]), 1)
+        cache.put("a", [1.0, 1.0], 3)
+        self.assertIsNone(cache.get("a", [0.0, 1.0]))
+        self.assertEqual(len(cache), 2)
+        with patch("langchain_lab.core.cache.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get("a", [1.0, 0.0]))
+            self.assertEqual(len(cache), 0)
+
+    def test_query_folder(self):
+        docs = [Document(page_content="The capital of France is Paris", metadata={"source": "1-1"})]
+        folder_index = embed_docs(docs, BagOfWordsEmbedding(), "faiss")
+        llm = FakeListChatModel(responses=["Paris\nSOURCES: 1-1", "Lyon\nSOURCES: 1-1"])
+        cache = AnswerCache(threshold=0.8)
+
+        def ask(question, top_k=1):
+            return query_folder(question, llm, folder_index, top_k=top_k, callback=TrackerCallbackHandler(MagicMock()), answer_cache=cache)
+
+        first = ask("What is the capital of France?")
+        self.assertFalse(first.cached)
+        second = ask("what is the capital of france")
+        self.assertTrue(second.cached)
+        self.assertEqual((second.answer, second.sources), (first.answer, docs))
+        self.assertFalse(ask("What is the capital of France?", top_k=2).cached)
+        # numbers and identifiers of the question have to match
+        self.assertFalse(ask("What was the capital of France in 1792?").cached)
+        self.assertTrue(ask("what was the capital of france in 1792").cached)
+        self.assertFalse(ask("What was the capital of France in 1793?").cached)
+        folder_index.add_documents([Document(page_content="Lyon is in France", metadata={"source": "1-2"})])
+        self.assertFalse(ask("What is the capital of France?").cached)
+        self.assertEqual(cache.stats()["hits"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
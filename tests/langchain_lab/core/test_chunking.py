@@ -0,0 +1,76 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from langchain.docstore.document import Document
+
+from langchain_lab.core.chunking import TokenIndex, chunk_file, get_encoding, get_splitter, token_index_cache
+from langchain_lab.core.parsing import TxtFile
+from langchain_lab.core.store import ChunkStore
+
+
+def make_file(pages: int) -> TxtFile:
+    docs = [Document(page_content=f"Page {i} " + "lorem ipsum dolor sit amet " * 40, metadata={"page": i + 1}) for i in range(pages)]
+    return TxtFile(name="a.txt", id="a", docs=docs)
+
+
+class TestChunking(TestCase):
+
+    def test_splitter_registry(self):
+        self.assertIs(get_splitter("gpt-3.5-turbo", 50, 5), get_splitter("gpt-3.5-turbo", 50, 5))
+        self.assertIsNot(get_splitter("gpt-3.5-turbo", 50, 5), get_splitter("gpt-3.5-turbo", 60, 5))
+
+    def test_parallel_matches_serial(self):
+        file = make_file(70)
+        serial = chunk_file(file, chunk_size=50, chunk_overlap=5, workers=1)
+        parallel = chunk_file(file, chunk_size=50, chunk_overlap=5, workers=2)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial[0].metadata, {"page": 1, "chunk": 1, "source": "1-1"})
+
+    def test_lazy_file_threshold(self):
+        serial = chunk_file(make_file(3), chunk_size=50, workers=1)
+        lazy = TxtFile(name="a.txt", id="a", docs=lambda: iter(make_file(3).docs))
+        with patch("langchain_lab.core.chunking.process_pool", side_effect=AssertionError("started a pool")):
+            self.assertEqual(chunk_file(lazy, chunk_size=50, workers=2), serial)
+        lazy = TxtFile(name="a.txt", id="a", docs=lambda: iter(make_file(70).docs))
+        self.assertEqual(chunk_file(lazy, chunk_size=50, workers=2), chunk_file(make_file(70), chunk_size=50, workers=1))
+
+    def test_chunk_into_store(self):
+        file = make_file(2)
+        store = chunk_file(file, chunk_size=50, store=ChunkStore(), source_prefix="2-", workers=1)
+        self.assertEqual(store[0].metadata, {"page": 1, "chunk": 1, "source": "2-1-1", "file_name": "a.txt", "file_id": "a"})
+        self.assertEqual(list(store.texts()), [doc.page_content for doc in chunk_file(file, chunk_size=50, workers=1)])
+
+    def test_token_index_chunks(self):
+        text = "".join(f"第{i}段。Sentence number {i} ends here.\n\n" for i in range(100))
+        index = TokenIndex.from_text(text)
+        encoding = get_encoding("gpt-3.5-turbo")
+        for chunk_size, chunk_overlap in [(30, 0), (64, 10), (7, 3)]:
+            windows = index.windows(chunk_size, chunk_overlap)
+            self.assertEqual(windows[0][0], 0)
+            self.assertEqual(windows[-1][1], len(index))
+            for start, end in windows:
+                self.assertLessEqual(end - start, chunk_size)
+            for chunk in index.chunks(chunk_size, chunk_overlap):
+                self.assertLessEqual(len(encoding.encode(chunk)), chunk_size)
+        self.assertTrue(all(chunk.endswith("here.") for chunk in index.chunks(30)[:-1]))
+
+    def test_large_overlap_still_advances(self):
+        index = TokenIndex.from_text("".join(f"Sentence number {i} ends here.\n" for i in range(1500)))
+        for chunk_overlap in (0, 100, 150, 200):
+            windows = index.windows(200, chunk_overlap)
+            self.assertLessEqual(len(windows), 2 * len(index) // 100 + 1, chunk_overlap)
+            self.assertEqual(windows[-1][1], len(index))
+            self.assertTrue(all(later[0] > earlier[0] for earlier, later in zip(windows, windows[1:])))
+
+    def test_rechunk_reuses_token_index(self):
+        file = make_file(3)
+        chunk_file(file, chunk_size=50, workers=1, use_token_index=True)
+        with patch.object(TokenIndex, "from_text", side_effect=AssertionError("re-encoded")):
+            docs = chunk_file(file, chunk_size=80, chunk_overlap=10, workers=1, use_token_index=True)
+        self.assertEqual(docs[0].metadata, {"page": 1, "chunk": 1, "source": "1-1"})
+        self.assertIn(("a", 0), [key for key, _ in token_index_cache._indexes])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import json
+import unittest
+from unittest import TestCase
+
+from langchain.docstore.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.dedup import deduplicate, simhash
+from langchain_lab.core.embedding import embed_docs
+
+FOOTER = "Copyright 2024 Example Inc. All rights reserved. Privacy policy | Terms of service | Contact us | Careers | Press"
+
+
+def make_docs():
+    texts = [
+        "The quick brown fox jumps over the lazy dog near the river bank.",
+        FOOTER,
+        "网络运维分析助手用于定位小区告警并给出处理建议。",
+        FOOTER + " |",
+        "  the quick brown fox jumps over the lazy dog near the river BANK. ",
+        "An unrelated sentence about embedding caches and vector stores.",
+    ]
+    return [Document(page_content=text, metadata={"page": i + 1, "chunk": 1, "source": f"{i + 1}-1"}) for i, text in enumerate(texts)]
+
+
+class TestDedup(TestCase):
+
+    def test_simhash_is_close_for_near_duplicates(self):
+        self.assertLessEqual((simhash(FOOTER) ^ simhash(FOOTER + " |")).bit_count(), 3)
+        self.assertGreater((simhash(FOOTER) ^ simhash(make_docs()[0].page_content)).bit_count(), 3)
+
+    def test_deduplicate(self):
+        result = deduplicate(make_docs())
+        self.assertEqual(result.keep, [0, 1, 2, 5])
+        self.assertEqual(result.duplicates, {3: 1, 4: 0})
+
+    def test_identifiers_are_not_duplicates(self):
+        description = " ".join(["heavy duty hex bolt for outdoor steel structures with zinc finish and nylon lock nut included"] * 3)
+        rows = [json.dumps({"part_number": f"PN-{1000 + i}", "name": "hex bolt", "size": "M8", "supplier": "ACME", "description": description}) for i in range(300)]
+        paragraph = " ".join(["The service failed to start after the upgrade because the license key expired, restart it to pick up the new configuration."] * 2)
+        paragraphs = [f"{paragraph} The log shows error E{1000 + i}. {paragraph}" for i in range(200)]
+        for texts in (rows, paragraphs):
+            # SimHash alone puts almost all of them within 3 bits of another
+            self.assertEqual(deduplicate([Document(page_content=text) for text in texts]).removed, 0)
+        self.assertEqual(deduplicate([Document(page_content=text) for text in paragraphs[:1] * 2]).removed, 1)
+
+    def test_embed_docs_with_dedup(self):
+        docs = make_docs()
+        folder_index = embed_docs(docs=docs, embedding=DeterministicFakeEmbedding(size=16), vector_store="faiss", dedup=True)
+        self.assertEqual(folder_index.index.index.ntotal, 4)
+        self.assertEqual(folder_index.duplicates, {"4-1": "2-1", "5-1": "1-1"})
+        self.assertEqual(len(folder_index.docs), 6)
+        # left out of the vector index but still found by keyword
+        self.assertIn("5-1", [doc.metadata["source"] for doc in folder_index.similarity_search("BANK", k=6, hybrid=True)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+from unittest import TestCase
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.faiss_index import (
+    RescoringFAISS,
+    VectorFile,
+    create_faiss_index,
+    default_pq_m,
+    remove_vectors,
+    resolve_index_type,
+)
+
+
+class TestFaissIndex(TestCase):
+
+    def test_index_types(self):
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(50, 32)).astype(np.float32)
+        vectors = centers[rng.integers(0, 50, 5000)] + rng.normal(scale=0.05, size=(5000, 32)).astype(np.float32)
+        queries = vectors[:100] + 0.01
+        _, expected = create_faiss_index(vectors, "flat").search(queries, 1)
+        for index_type, options, min_recall in [("ivf_flat", {"nprobe": 8}, 0.95), ("hnsw", {"ef_search": 64}, 0.95), ("ivf_pq", {"nprobe": 8}, 0.5)]:
+            index = create_faiss_index(vectors, index_type, **options)
+            self.assertEqual(index.ntotal, 5000)
+            _, found = index.search(queries, 1)
+            self.assertGreaterEqual((found == expected).mean(), min_recall, index_type)
+
+    def test_auto_and_defaults(self):
+        self.assertEqual(resolve_index_type("auto", 100), "flat")
+        self.assertEqual(resolve_index_type("auto", 1_000_000), "ivf_flat")
+        self.assertRaises(ValueError, resolve_index_type, "lsh", 100)
+        self.assertEqual(default_pq_m(1536), 192)
+        self.assertEqual(default_pq_m(1000), 125)
+        self.assertEqual(default_pq_m(36), 4)
+
+    def test_quantization(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(2000, 32)).astype(np.float32)
+        for quantization, code_size in [("float16", 64), ("int8", 32)]:
+            for index_type in ("flat", "ivf_flat", "hnsw"):
+                index = create_faiss_index(vectors, index_type, quantization=quantization, nprobe=8)
+                self.assertEqual(index.ntotal, 2000)
+            self.assertEqual(create_faiss_index(vectors, "flat", quantization=quantization).sa_code_size(), code_size)
+
+    def test_rescoring(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(3000, 64)).astype(np.float32)
+        queries = rng.normal(size=(50, 64)).astype(np.float32)
+        _, expected = create_faiss_index(vectors, "flat").search(queries, 5)
+        index = create_faiss_index(vectors, "flat", quantization="int8")
+        ids = [str(i) for i in range(3000)]
+        docstore = InMemoryDocstore({id: Document(page_content=id) for id in ids})
+        store = RescoringFAISS(DeterministicFakeEmbedding(size=64), index, docstore, dict(enumerate(ids)), vectors=VectorFile(64), vector_positions={}, rescore=4)
+        store.add_vectors(ids, vectors)
+        found = [[int(doc.page_content) for doc, _ in store.similarity_search_with_score_by_vector(query.tolist(), k=5)] for query in queries]
+        self.assertGreaterEqual((np.array(found) == expected).mean(), 0.95)
+        _, score = store.similarity_search_with_score_by_vector(vectors[7].tolist(), k=1)[0]
+        self.assertEqual(score, 0.0)
+
+        store.add_texts(["new"], ids=["new"])
+        self.assertEqual(store.vectors.count, 3001)
+        store.delete(["new"])
+        self.assertNotIn("new", store.vector_positions)
+
+    def test_remove_vectors_renumbers_ivf(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(3000, 16)).astype(np.float32)
+        removed = [3, 10, 2000]
+        for index_type in ("flat", "ivf_flat", "ivf_pq"):
+            index = create_faiss_index(vectors, index_type, nprobe=1000)
+            remove_vectors(index, removed)
+            kept = np.delete(vectors, removed, axis=0)
+            _, found = index.search(kept[:100], 1)
+            self.assertGreaterEqual((found[:, 0] == np.arange(100)).mean(), 0.9, index_type)
+            index.add(vectors[:1])
+            self.assertEqual(index.ntotal, 2998)
+            self.assertIn(2997, index.search(vectors[:1], 2)[1][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
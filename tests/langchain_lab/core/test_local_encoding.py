@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+import streamlit as st
+
+from langchain_lab.core.embedding import embedding_init
+from langchain_lab.core.local_encoding import BucketedEncoder, EncodingPool, bucket_batches, pool_size
+
+WORDS = ["the", "service", "failed", "to", "start", "error", "license", "key", "expired", "restart"]
+
+
+def tiny_model(path: str):
+    """Saves a randomly initialised one layer BERT that sentence-transformers loads with mean pooling"""
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    vocab = os.path.join(path, "vocab.txt")
+    with open(vocab, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *WORDS]))
+    config = BertConfig(vocab_size=len(WORDS) + 5, hidden_size=32, num_hidden_layers=1, num_attention_heads=2, intermediate_size=64)
+    BertModel(config).save_pretrained(path)
+    BertTokenizerFast(vocab_file=vocab).save_pretrained(path)
+
+
+class TestEncodingPool(TestCase):
+
+    def test_pool_size(self):
+        self.assertEqual(pool_size(2, 3), (2, 3))
+        workers, threads = pool_size()
+        self.assertLessEqual(workers * threads, max(os.cpu_count(), workers))
+
+    def test_bucket_batches(self):
+        lengths = [100, 30, 31, 95, 29, 200, 32]
+        self.assertEqual(bucket_batches(lengths), [[4, 1, 2], [6], [3, 0], [5]])
+        self.assertEqual(bucket_batches(lengths, max_batch_tokens=62), [[4, 1], [2], [6], [3], [0], [5]])
+        self.assertEqual(bucket_batches(lengths, max_batch_size=2), [[4, 1], [2], [6], [3, 0], [5]])
+        self.assertEqual(bucket_batches([500], max_batch_tokens=10), [[0]])
+
+    def test_bucketed_encoder(self):
+        from sentence_transformers import SentenceTransformer
+
+        texts = [" ".join(WORDS * (i % 5 * 3 + 1)) for i in range(17)]
+        with tempfile.TemporaryDirectory() as path:
+            tiny_model(path)
+            model = SentenceTransformer(path)
+        expected = model.encode(texts)
+        encoder = BucketedEncoder(model, max_batch_tokens=256)
+        np.testing.assert_allclose(encoder.embed_documents(texts), expected, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(encoder.embed_query(texts[3]), expected[3], rtol=1e-4, atol=1e-5)
+
+    def test_encode_in_order(self):
+        from sentence_transformers import SentenceTransformer
+
+        texts = [" ".join(WORDS[i % 7:i % 7 + 1 + i % 4]) for i in range(23)]
+        with tempfile.TemporaryDirectory() as path:
+            tiny_model(path)
+            expected = SentenceTransformer(path).encode(texts)
+            pool = EncodingPool(path, workers=2, threads_per_worker=1, shard_size=5)
+            try:
+                vectors = pool.embed_documents(texts)
+                query = pool.embed_query(texts[7])
+            finally:
+                pool.close()
+        self.assertEqual(len(vectors), len(texts))
+        np.testing.assert_allclose(vectors, expected, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(query, expected[7], rtol=1e-4, atol=1e-5)
+        self.assertEqual(pool.embed_documents([]), [])
+
+    def test_embedding_init_pool_opt_in(self):
+        class FakePool(EncodingPool):
+            def __init__(self, *args, **kwargs):
+                self.closed = False
+
+            def close(self):
+                self.closed = True
+
+        with tempfile.TemporaryDirectory() as path, patch("langchain_lab.core.embedding.HuggingFaceEmbeddings"), patch("langchain_lab.core.embedding.EncodingPool", FakePool):
+            with patch.dict(os.environ, {"HUGGINGFACE_CATCH_PATH": path, "LANGCHAIN_LAB_CACHE_PATH": path, "LANGCHAIN_LAB_EMBEDDING_WORKERS": "0"}):
+                embedding_init("huggingface", "", "", "a", {})
+                self.assertIsInstance(st.session_state["EMBEDDING"].embeddings, BucketedEncoder)
+            with patch.dict(os.environ, {"HUGGINGFACE_CATCH_PATH": path, "LANGCHAIN_LAB_CACHE_PATH": path, "LANGCHAIN_LAB_EMBEDDING_WORKERS": "2"}):
+                embedding_init("huggingface", "", "", "b", {})
+                pool = st.session_state["EMBEDDING"].embeddings
+                self.assertIsInstance(pool, FakePool)
+                # the workers of a replaced pool are shut down
+                embedding_init("huggingface", "", "", "c", {"device": "cuda"})
+                self.assertTrue(pool.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import codecs
+import json
+import threading
+import time
+import tempfile
+import unittest
+import zipfile
+from concurrent.futures import Executor, Future
+from hashlib import md5
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import patch
+
+import fitz
+
+from langchain_lab.core.cache import ParseCache
+from langchain_lab.core.parsing import PdfFile, TxtFile, process_pool, read_file, read_files
+
+
+def make_upload(data: bytes, name: str) -> BytesIO:
+    file = BytesIO(data)
+    file.name = name
+    return file
+
+
+def make_pdf(pages: int) -> bytes:
+    pdf = fitz.open()
+    for i in range(pages):
+        pdf.new_page().insert_text((72, 72), f"page {i + 1}\n\n\n   end")
+    data = pdf.tobytes()
+    pdf.close()
+    return data
+
+
+class TestParsing(TestCase):
+
+    def test_pdf_parallel_matches_serial(self):
+        data = make_pdf(70)
+        serial = PdfFile.from_bytes(make_upload(data, "a.pdf"), workers=1)
+        parallel = PdfFile.from_bytes(make_upload(data, "a.pdf"), workers=3)
+        self.assertEqual(serial, parallel)
+        self.assertEqual([doc.metadata["page"] for doc in parallel.docs], list(range(1, 71)))
+        self.assertEqual(parallel.docs[4].page_content, "page 5\nend")
+
+    def test_id_is_hash_of_upload(self):
+        for name, data in [("a.csv", b"name,city\n a , b \n"), ("b.csv", b"name,city\nc,d\n"), ("a.md", "# 标题\n正文".encode("utf-8"))]:
+            file = read_file(make_upload(data, name))
+            self.assertEqual(file.id, md5(data).hexdigest())
+        self.assertEqual(read_file(make_upload(b"name,city\n a , b \n", "a.csv")).docs[0].page_content, '{"name":"a","city":"b"}')
+
+    def test_csv_rows_per_doc(self):
+        data = ("id,url\n" + "".join(f"{i},http://x/{i}\n" for i in range(7))).encode("utf-8")
+        file = read_file(make_upload(data, "a.csv"), rows_per_doc=3)
+        self.assertEqual([len(doc.page_content.splitlines()) for doc in file.docs], [3, 3, 1])
+        self.assertEqual(json.loads(file.docs[2].page_content), {"id": "6", "url": "http://x/6"})
+        # options of other parsers are ignored
+        self.assertEqual(read_file(make_upload(b"# a\nb", "a.md"), rows_per_doc=3).docs[0].page_content, "# a\nb")
+        results = sorted(read_files([make_upload(data, "a.csv"), make_upload(b"a", "a.txt")], max_workers=1, rows_per_doc=3), key=lambda item: item[0])
+        self.assertEqual([len(result.docs) for _, _, result in results], [3, 1])
+
+    def test_csv_values_with_line_separators(self):
+        data = 'name,city\n"a\u2028b",z\n"c\u0085d\ne",y\n'.encode("utf-8")
+        file = read_file(make_upload(data, "a.csv"))
+        self.assertEqual([json.loads(doc.page_content)["name"] for doc in file.docs], ["a\u2028b", "c\u0085d\ne"])
+
+    def test_txt_segments_across_blocks(self):
+        text = "".join(f"第{i}行  文本内容\n\n" for i in range(200))
+        data = text.encode("gb18030")
+        docs = TxtFile.parse(memoryview(data), segment_bytes=97)
+        self.assertGreater(len(docs), 1)
+        self.assertEqual("\n".join(doc.page_content for doc in docs), text.replace("\n\n", "\n").strip())
+        self.assertEqual([doc.metadata["page"] for doc in docs], list(range(1, len(docs) + 1)))
+
+    def test_encoding_beyond_sample(self):
+        prefix = "plain ascii line\n" * 20000
+        for text, encoding in [(prefix + "第一行 中文内容\n", "utf-8"), (prefix + "café déjà vu\n", "cp1252")]:
+            data = text.encode(encoding)
+            self.assertGreater(len(data), 256 * 1024)
+            docs = TxtFile.parse(memoryview(data))
+            self.assertEqual(docs[-1].page_content.splitlines()[-1], text.splitlines()[-1])
+        self.assertEqual(TxtFile.parse(memoryview(codecs.BOM_UTF8 + "标题".encode("utf-8")))[0].page_content, "标题")
+
+    def test_from_path(self):
+        with tempfile.NamedTemporaryFile(suffix=".txt") as f:
+            f.write(b"hello\n\n  world")
+            f.flush()
+            file = TxtFile.from_path(f.name)
+        self.assertEqual(file.docs[0].page_content, "hello\nworld")
+        self.assertEqual(file.id, md5(b"hello\n\n  world").hexdigest())
+
+    def test_lazy_docs_and_copy_on_write(self):
+        data = "\n".join(f"line {i}" for i in range(100)).encode("utf-8")
+        file = read_file(make_upload(data, "a.txt"), lazy=True, segment_bytes=64)
+        self.assertTrue(file.is_lazy)
+        streamed = list(file.iter_docs())
+        self.assertTrue(file.is_lazy)
+        self.assertEqual([doc.page_content for doc in file.docs], [doc.page_content for doc in streamed])
+        self.assertFalse(file.is_lazy)
+
+        copied = file.copy()
+        self.assertEqual(copied, file)
+        self.assertEqual(hash(copied), hash(file))
+        copied.docs.pop()
+        self.assertEqual(len(file.docs), len(copied.docs) + 1)
+        self.assertIs(file.docs[0], copied.docs[0])
+
+    def test_read_files_with_archive(self):
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as zf:
+            zf.writestr("docs/b.txt", "b")
+            zf.writestr("docs/skip.exe", "x")
+            zf.writestr("docs/c.pdf", make_pdf(2))
+        uploads = [make_upload(b"a", "a.txt"), make_upload(archive.getvalue(), "docs.zip"), make_upload(b"not a pdf", "d.pdf")]
+        results = sorted(read_files(uploads, max_workers=1), key=lambda item: item[0])
+        self.assertEqual([name for _, name, _ in results], ["a.txt", "docs/b.txt", "docs/c.pdf", "d.pdf"])
+        self.assertEqual(results[1][2].docs[0].page_content, "b")
+        self.assertEqual(len(results[2][2].docs), 2)
+        self.assertIsInstance(results[3][2], Exception)
+
+    def test_read_files_share_pdf_pool(self):
+        pdfs = [make_pdf(64 + i) for i in range(3)]
+        uploads = [make_upload(data, f"{i}.pdf") for i, data in enumerate(pdfs)]
+        with tempfile.TemporaryDirectory() as path, patch("langchain_lab.core.parsing.process_pool", wraps=process_pool) as pools:
+            cache = ParseCache(path)
+            results = sorted(read_files(uploads, cache=cache, max_workers=3), key=lambda item: item[0])
+            self.assertEqual([len(result.docs) for _, _, result in results], [64, 65, 66])
+            self.assertEqual(pools.call_count, 1)
+            # the pool is not part of the cache key
+            self.assertEqual(len(read_file(make_upload(pdfs[0], "0.pdf"), cache=cache, workers=1).docs), 64)
+            self.assertEqual(cache.hits, 1)
+
+    def test_pdf_pages_before_last_range(self):
+        class StagedExecutor(Executor):
+            """Runs the first range at once and the others after a second"""
+
+            def submit(self, fn, *args, **kwargs):
+                future = Future()
+                if not hasattr(self, "started"):
+                    self.started = True
+                    future.set_result(fn(*args, **kwargs))
+                else:
+                    threading.Timer(1, lambda: future.set_result(fn(*args, **kwargs))).start()
+                return future
+
+        pages = PdfFile.iter_parse(memoryview(make_pdf(70)), workers=2, executor=StagedExecutor())
+        start = time.monotonic()
+        self.assertEqual(next(pages).metadata["page"], 1)
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertEqual([doc.metadata["page"] for doc in pages], list(range(2, 71)))
+
+    def test_lazy_cache_skips_large_files(self):
+        with tempfile.TemporaryDirectory() as path, patch("langchain_lab.core.parsing.LAZY_CACHE_MAX_CHARS", 100):
+            cache = ParseCache(path)
+            for text, cached in (("short text", True), ("long text " * 20, False)):
+                list(read_file(make_upload(text.encode("utf-8"), "a.txt"), cache=cache, lazy=True).iter_docs())
+                self.assertEqual(read_file(make_upload(text.encode("utf-8"), "a.txt"), cache=cache).docs[0].page_content, text.strip())
+                self.assertEqual(cache.hits, int(cached))
+                cache.hits = 0
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import tempfile
+import unittest
+from io import BytesIO
+from typing import List
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.cache import ParseCache
+from langchain_lab.core.chunking import chunk_file, token_index_cache
+from langchain_lab.core.faiss_index import create_faiss_index
+from langchain_lab.core.parsing import read_file
+from langchain_lab.core.pipeline import IngestProgress, ingest_files
+from langchain_lab.core.store import ChunkStore
+
+PARAGRAPHS = [f"Paragraph {i} talks about topic {i % 7} and error code E{1000 + i}." for i in range(400)]
+
+
+def make_upload(data: bytes, name: str) -> BytesIO:
+    file = BytesIO(data)
+    file.name = name
+    return file
+
+
+class FailingEmbedding(DeterministicFakeEmbedding):
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise RuntimeError("embedding service unavailable")
+
+
+class TestIngestFiles(TestCase):
+
+    def test_streams_into_index(self):
+        data = "\n\n".join(PARAGRAPHS).encode("utf-8")
+        progress = IngestProgress()
+        stream = ingest_files([make_upload(data, "a.txt")], DeterministicFakeEmbedding(size=16), 50, batch_size=8, progress=progress)
+        # the pages are not kept in the process wide token index cache
+        with patch.object(token_index_cache, "get", side_effect=AssertionError("cached a page")):
+            sizes = [folder_index.index.index.ntotal for folder_index in stream]
+        self.assertTrue(progress.done)
+        self.assertEqual(sizes[0], 8)
+        self.assertEqual(sizes, sorted(sizes))
+
+        expected = chunk_file(read_file(make_upload(data, "a.txt")), 50, store=ChunkStore(), use_token_index=True)
+        self.assertEqual(progress.chunks, len(expected))
+        self.assertEqual(sizes[-1], len(expected))
+        self.assertIsNotNone(progress.first_indexed)
+
+    def test_dedup_rebuild_and_search(self):
+        uploads = [make_upload("\n\n".join(PARAGRAPHS).encode("utf-8"), "a.txt"), make_upload("\n\n".join(PARAGRAPHS[:40]).encode("utf-8"), "b.txt")]
+        progress = IngestProgress()
+        *_, folder_index = ingest_files(uploads, DeterministicFakeEmbedding(size=16), 50, dedup=True, batch_size=16, progress=progress, index_type="ivf_flat")
+        self.assertGreater(progress.duplicates, 0)
+        self.assertEqual(len(folder_index.duplicates), progress.duplicates)
+        self.assertEqual(folder_index.index.index.ntotal, progress.chunks - progress.duplicates)
+        self.assertIn("IVF", type(folder_index.index.index).__name__)
+        self.assertEqual(len(folder_index.files()), 2)
+        self.assertTrue(folder_index.docs.source(len(folder_index.docs) - 1).startswith("2-"))
+        self.assertIn("E1042", folder_index.similarity_search("E1042", k=1, hybrid=True)[0].page_content)
+
+    def test_quantized_and_cached(self):
+        data = "\n\n".join(PARAGRAPHS).encode("utf-8")
+        embedding = DeterministicFakeEmbedding(size=16)
+        with tempfile.TemporaryDirectory() as path:
+            cache = ParseCache(path)
+            for hits in (0, 1):
+                progress = IngestProgress()
+                *_, folder_index = ingest_files([make_upload(data, "a.txt")], embedding, 50, batch_size=8, progress=progress, cache=cache, index_type="flat", quantization="int8")
+                self.assertEqual(cache.hits, hits)
+                # the codes are trained on every vector, not on the first batch
+                vectors = np.asarray(embedding.embed_documents(list(folder_index.docs.texts())), dtype=np.float32)
+                expected = create_faiss_index(vectors, index_type="flat", quantization="int8")
+                self.assertEqual(folder_index.index.index.ntotal, progress.chunks)
+                np.testing.assert_allclose(folder_index.index.index.reconstruct_n(0, len(vectors)), expected.reconstruct_n(0, len(vectors)))
+
+    def test_failures(self):
+        progress = IngestProgress()
+        uploads = [make_upload(b"PK broken", "broken.docx"), make_upload(b"some text", "a.txt")]
+        with self.assertRaises(RuntimeError):
+            list(ingest_files(uploads, FailingEmbedding(size=16), 50, progress=progress))
+        self.assertEqual([name for name, _ in progress.failed], ["broken.docx"])
+        self.assertEqual(list(ingest_files([], DeterministicFakeEmbedding(size=16), 50)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import re
+import threading
+import time
+import unittest
+from typing import Any, List, Optional
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from langchain.docstore.document import Document
+from langchain.schema.messages import BaseMessage
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.embedding import embed_docs
+from langchain_lab.core.llm import TrackerCallbackHandler
+from langchain_lab.core.qa import query_folder
+
+DOCS = [Document(page_content=f"Fact {i}: the answer is {i}", metadata={"source": f"1-{i}"}) for i in range(8)]
+
+
+class SlowChatModel(FakeListChatModel):
+    """Answers each map step prompt with the fact it holds after `latency` seconds, fact 7 fails and fact 6 is slow"""
+
+    latency: float = 0.3
+
+    def _call(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        prompt = messages[-1].content
+        facts = re.findall(r"Fact (\d+)", prompt)
+        if "FINAL ANSWER" in prompt:
+            # the reduce step of map_reduce
+            return f"Combined {len(facts)} facts\nSOURCES: 1-2, 1-5"
+        fact = int(facts[-1])
+        if fact == 7:
+            raise RuntimeError("service unavailable")
+        time.sleep(self.latency * (10 if fact == 6 else 1))
+        return f"Fact {fact}\nScore: {fact * 10}"
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+class TestConcurrentMapStep(TestCase):
+
+    def setUp(self):
+        self.folder_index = embed_docs(DOCS, DeterministicFakeEmbedding(size=16), "faiss")
+        self.llm = SlowChatModel(responses=[""])
+
+    def ask(self, chain_type: str, **kwargs):
+        start = time.monotonic()
+        result = query_folder("What is the answer?", self.llm, self.folder_index, top_k=8, chain_type=chain_type, callback=TrackerCallbackHandler(MagicMock()), **kwargs)
+        return result, time.monotonic() - start
+
+    def test_map_rerank(self):
+        # one call after another, the first failure ends the chain
+        result, _ = self.ask("map_rerank")
+        self.assertIn("service unavailable", result.answer)
+
+        # fact 7 fails and fact 6 times out, the best of the others wins in about the latency of one call
+        result, elapsed = self.ask("map_rerank", map_concurrency=8, map_timeout=1)
+        self.assertEqual(result.answer, "Fact 5")
+        self.assertLess(elapsed, 2)
+
+    def test_map_reduce(self):
+        result, elapsed = self.ask("map_reduce", map_concurrency=8, map_timeout=1)
+        # the reduce step sees the six facts that were mapped in time
+        self.assertEqual(result.answer, "Combined 6 facts\n")
+        self.assertEqual([doc.metadata["source"] for doc in result.sources], ["1-2", "1-5"])
+        self.assertLess(elapsed, 2)
+
+    def test_lock_held_for_retrieval_only(self):
+        lock = threading.Lock()
+        held = []
+        search = self.folder_index.similarity_search
+
+        def locked_search(*args, **kwargs):
+            held.append(("search", lock.locked()))
+            return search(*args, **kwargs)
+
+        def locked_call(messages, *args, **kwargs):
+            held.append(("llm", lock.locked()))
+            return "Fact 1\nScore: 10"
+
+        with patch.object(self.folder_index, "similarity_search", side_effect=locked_search), patch.object(SlowChatModel, "_call", side_effect=locked_call):
+            result, _ = self.ask("map_rerank", lock=lock)
+        self.assertEqual(result.answer, "Fact 1")
+        self.assertEqual(held[0], ("search", True))
+        self.assertEqual(set(held[1:]), {("llm", False)})
+        self.assertFalse(lock.locked())
+
+
+if __name__ == "__main__":
+    unittest.main()
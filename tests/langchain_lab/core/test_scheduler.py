@@ -0,0 +1,110 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import TestCase
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.scheduler import AdaptiveLimit, EmbeddingScheduler, rate_limit_delay, run_concurrently
+
+
+class RateLimitError(Exception):
+
+    status_code = 429
+
+    def __init__(self, retry_after: str):
+        super().__init__("rate limited")
+        self.response = type("Response", (), {"status_code": 429, "headers": {"retry-after": retry_after}})()
+
+
+calls = []
+lock = threading.Lock()
+
+
+class FlakyEmbedding(DeterministicFakeEmbedding):
+
+    def embed_documents(self, texts):
+        with lock:
+            calls.append(len(texts))
+            if len(calls) == 2:
+                raise RateLimitError("0.01")
+            # the fake seeds numpy's global random state, keep it to one thread
+            return super().embed_documents(texts)
+
+
+class TestEmbeddingScheduler(TestCase):
+
+    def test_batches_by_tokens(self):
+        scheduler = EmbeddingScheduler(DeterministicFakeEmbedding(size=4), max_batch_tokens=7, max_batch_size=3)
+        texts = ["one two three four five", "six", "seven", "eight", "nine ten eleven twelve thirteen fourteen fifteen"]
+        self.assertEqual(scheduler.batches(texts), [[0, 1, 2], [3], [4]])
+
+    def test_ordered_results_with_rate_limit(self):
+        calls.clear()
+        fake = FlakyEmbedding(size=4)
+        scheduler = EmbeddingScheduler(fake, max_concurrency=3, max_batch_size=2)
+        texts = [f"text {i}" for i in range(11)]
+        self.assertEqual(scheduler.embed_documents(texts), DeterministicFakeEmbedding(size=4).embed_documents(texts))
+        self.assertEqual(scheduler.retries, 1)
+        self.assertEqual(sum(calls), 11 + calls[1])
+
+    def test_adaptive_limit(self):
+        limit = AdaptiveLimit(4)
+        limit.acquire()
+        limit.release(rate_limited=True, delay=0.0)
+        self.assertEqual(limit.limit, 2)
+        for _ in range(2):
+            limit.acquire()
+            limit.release()
+        self.assertEqual(limit.limit, 3)
+
+    def test_import_from_src_only(self):
+        # the scheduler is imported by embedding, which must not need the repo root on sys.path
+        src = os.path.join(os.path.dirname(__file__), "..", "..", "..", "src")
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(src))
+        code = "import langchain_lab.core.embedding"
+        result = subprocess.run([sys.executable, "-c", code], cwd=tempfile.gettempdir(), env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_rate_limit_delay(self):
+        self.assertEqual(rate_limit_delay(RateLimitError("2")), 2.0)
+        self.assertEqual(rate_limit_delay(RateLimitError("soon")), 0.0)
+        self.assertIsNone(rate_limit_delay(ValueError()))
+
+
+class TestRunConcurrently(TestCase):
+
+    def test_limit_timeout_and_failures(self):
+        active = []
+        peak = []
+
+        def call(i):
+            with lock:
+                active.append(i)
+                peak.append(len(active))
+            try:
+                if i == 1:
+                    raise ValueError("bad chunk")
+                time.sleep(1 if i == 2 else 0.1)
+                return i * 10
+            finally:
+                with lock:
+                    active.remove(i)
+
+        start = time.monotonic()
+        results = run_concurrently([lambda i=i: call(i) for i in range(6)], max_concurrency=3, timeout=0.5)
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertEqual([results[i] for i in (0, 3, 4, 5)], [0, 30, 40, 50])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[2], TimeoutError)
+        # the timed out call may still run in the background once its slot is given to the next call
+        self.assertLessEqual(max(peak), 4)
+        self.assertEqual(run_concurrently([], max_concurrency=3), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
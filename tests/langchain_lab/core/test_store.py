@@ -0,0 +1,144 @@
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from langchain.docstore.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from langchain_lab.core.embedding import FolderIndex, embed_docs, folder_index_key, number_files
+from langchain_lab.core.qa import get_sources
+from langchain_lab.core.store import ChunkStore
+
+DOCS = [
+    Document(page_content="第一页 chunk one", metadata={"page": 1, "chunk": 1, "source": "1-1"}),
+    Document(page_content="chunk two", metadata={"page": 1, "chunk": 2, "source": "2-1-2", "file_name": "b.pdf", "file_id": "b"}),
+    Document(page_content="web page", metadata={"source": "https://blog.langchain.dev/", "title": "Blog"}),
+]
+
+
+class TestChunkStore(TestCase):
+
+    def test_round_trip(self):
+        store = ChunkStore.from_documents(DOCS)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store[0], DOCS[0])
+        self.assertEqual(store[1], DOCS[1])
+        self.assertEqual(store[-1].metadata["source"], "https://blog.langchain.dev/")
+        self.assertEqual(store[-1].metadata["title"], "Blog")
+        self.assertEqual(store.find_sources(["2-1-2", "https://blog.langchain.dev/"]), [1, 2])
+        store.delete([1])
+        self.assertEqual((len(store), store.live_count()), (3, 2))
+        self.assertEqual([doc.page_content for doc in store.documents()], [DOCS[0].page_content, DOCS[2].page_content])
+
+    def test_folder_index_on_store(self):
+        store = ChunkStore.from_documents(DOCS)
+        folder_index = embed_docs(docs=store, embedding=DeterministicFakeEmbedding(size=16), vector_store="faiss")
+        self.assertEqual(folder_index.index.similarity_search("chunk two", k=1)[0], DOCS[1])
+        self.assertEqual(get_sources("answer\nSOURCES: 1-1, 2-1-2", folder_index), DOCS[:2])
+
+    def test_source_lookup(self):
+        embedding = DeterministicFakeEmbedding(size=16)
+        copy = Document(page_content=DOCS[0].page_content, metadata={"page": 3, "chunk": 1, "source": "3-1"})
+        for docs in (ChunkStore.from_documents(DOCS + [copy]), DOCS + [copy]):
+            folder_index = embed_docs(docs=docs, embedding=embedding, vector_store="faiss", dedup=True)
+            # cited sources are looked up in the map built with the index, not by scanning the chunks
+            with patch.object(ChunkStore, "rows", side_effect=AssertionError("scanned the store")):
+                found = get_sources("answer\nSOURCES: https://blog.langchain.dev/, missing, 1-1 \n", folder_index)
+            self.assertEqual([doc.page_content for doc in found], [DOCS[0].page_content, DOCS[2].page_content])
+            self.assertEqual(folder_index.duplicates_of("1-1"), ["3-1"])
+            self.assertEqual(folder_index.duplicates_of("2-1-2"), [])
+
+            added = Document(page_content="added", metadata={"page": 1, "chunk": 1, "source": "4-1"})
+            folder_index.add_documents([added])
+            self.assertEqual(get_sources("SOURCES: 4-1", folder_index), [added])
+            folder_index.delete(["1-1"])
+            self.assertEqual(get_sources("SOURCES: 1-1, 3-1", folder_index)[0].metadata["source"], "3-1")
+            self.assertEqual(folder_index.duplicates_of("1-1"), [])
+
+    def test_save_and_load_folder_index(self):
+        embedding = DeterministicFakeEmbedding(size=16)
+        folder_index = embed_docs(docs=ChunkStore.from_documents(DOCS + DOCS[:1]), embedding=embedding, vector_store="faiss", dedup=True)
+        with tempfile.TemporaryDirectory() as path:
+            folder_index.save(f"{path}/index")
+            loaded = FolderIndex.load(f"{path}/index", embedding)
+            self.assertEqual(list(loaded.docs), list(folder_index.docs))
+            self.assertEqual(loaded.duplicates, {"1-1": "1-1"})
+            self.assertEqual(loaded.index.similarity_search("chunk two", k=1)[0], DOCS[1])
+            self.assertEqual(loaded.index.index.ntotal, 3)
+            loaded.docs.append("more", page=2)
+            self.assertEqual(loaded.docs[-1].page_content, "more")
+
+            quantized = embed_docs(docs=ChunkStore.from_documents(DOCS), embedding=embedding, vector_store="faiss", quantization="int8")
+            quantized.save(f"{path}/quantized")
+            loaded = FolderIndex.load(f"{path}/quantized", embedding)
+            self.assertEqual(loaded.index.similarity_search("chunk two", k=1)[0], DOCS[1])
+            self.assertEqual(loaded.add_documents([Document(page_content="new", metadata={"source": "9-9"})]), ["9-9"])
+            self.assertEqual(loaded.index.similarity_search("new", k=1)[0].page_content, "new")
+
+    def test_update_loaded_ivf_index(self):
+        embedding = DeterministicFakeEmbedding(size=16)
+        docs = [Document(page_content=f"chunk {i}", metadata={"page": 1, "chunk": i, "source": f"1-{i}", "file_name": "a.txt", "file_id": "a"}) for i in range(40)]
+        with tempfile.TemporaryDirectory() as path:
+            for quantization in ("none", "int8"):
+                folder_index = embed_docs(docs=ChunkStore.from_documents(docs), embedding=embedding, vector_store="faiss", index_type="ivf_flat", quantization=quantization)
+                folder_index.save(f"{path}/{quantization}")
+                # the inverted lists are memory-mapped read-only until the first change
+                loaded = FolderIndex.load(f"{path}/{quantization}", embedding)
+                self.assertEqual(loaded.index.similarity_search("chunk 7", k=1)[0].page_content, "chunk 7")
+                self.assertEqual(loaded.add_documents([Document(page_content="new", metadata={"source": "2-1"})]), ["2-1"])
+                self.assertEqual(loaded.delete(["1-3", "1-5"]), ["1-3", "1-5"])
+                self.assertEqual(loaded.index.index.ntotal, 39)
+                self.assertEqual(loaded.index.similarity_search("new", k=1)[0].page_content, "new")
+                self.assertEqual(loaded.index.similarity_search("chunk 7", k=1)[0].page_content, "chunk 7")
+                self.assertEqual(loaded.add_files([Document(page_content="b", metadata={"page": 1, "chunk": 1, "source": "1-1", "file_name": "b.txt", "file_id": "b"})]), ["b"])
+
+    def test_folder_index_key(self):
+        key = folder_index_key(["a", "b"], "openai:text-embedding-ada-002", 500, 0, dedup=True)
+        self.assertNotEqual(key, folder_index_key(["b", "a"], "openai:text-embedding-ada-002", 500, 0, dedup=True))
+        self.assertNotEqual(key, folder_index_key(["a", "b"], "openai:text-embedding-ada-002", 500, 0, dedup=False))
+
+    def test_incremental_updates(self):
+        embedding = DeterministicFakeEmbedding(size=16)
+        copy = Document(page_content=DOCS[0].page_content, metadata={"page": 3, "chunk": 1, "source": "3-1"})
+        for docs in (ChunkStore.from_documents(DOCS[:2] + [copy]), DOCS[:2] + [copy]):
+            folder_index = embed_docs(docs=docs, embedding=embedding, vector_store="faiss", dedup=True)
+            edited = Document(page_content="chunk two, edited", metadata=DOCS[1].metadata)
+            with patch.object(DeterministicFakeEmbedding, "embed_documents", wraps=embedding.embed_documents) as embed:
+                self.assertEqual(folder_index.add_documents([DOCS[0], edited, DOCS[2]]), ["2-1-2", "https://blog.langchain.dev/"])
+                self.assertEqual(sum(len(call.args[0]) for call in embed.call_args_list), 2)
+            self.assertEqual(folder_index.index.similarity_search("chunk two, edited", k=1)[0].page_content, "chunk two, edited")
+            self.assertEqual(get_sources("SOURCES: 2-1-2", folder_index), [edited])
+            self.assertEqual(folder_index.index.index.ntotal, 3)
+
+            # "3-1" was left out as a duplicate of "1-1" and takes its place
+            self.assertEqual(folder_index.delete(["1-1", "missing"]), ["1-1"])
+            self.assertEqual(folder_index.duplicates, {})
+            self.assertEqual(get_sources("SOURCES: 1-1, 2-1-2", folder_index), [edited])
+            self.assertEqual(folder_index.index.index.ntotal, 3)
+            self.assertEqual(folder_index.index.similarity_search(DOCS[0].page_content, k=1)[0], copy)
+
+    def test_collection_filtered_search(self):
+        embedding = DeterministicFakeEmbedding(size=16)
+        first = [Document(page_content=f"a{i}", metadata={"page": 1, "chunk": i, "source": f"1-{i}", "file_name": "a.txt", "file_id": "a"}) for i in range(1, 4)]
+        second = [Document(page_content=f"b{i}", metadata={"page": 1, "chunk": i, "source": f"1-{i}", "file_name": "b.txt", "file_id": "b"}) for i in range(1, 4)]
+        for index_type in ("flat", "ivf_flat", "hnsw"):
+            collection = embed_docs(docs=ChunkStore.from_documents(number_files(first)), embedding=embedding, vector_store="faiss", index_type=index_type)
+            self.assertEqual(collection.add_files(first + second), ["b"])
+            self.assertEqual(collection.files(), {"a": "a.txt", "b": "b.txt"})
+            found = collection.similarity_search("a2", k=3, file_ids=["b"])
+            self.assertEqual(sorted(doc.metadata["source"] for doc in found), ["2-1-1", "2-1-2", "2-1-3"])
+            self.assertEqual(collection.similarity_search("a2", k=1, file_ids=["a"])[0].page_content, "a2")
+            self.assertEqual(collection.similarity_search("a2", k=5, file_ids=["missing"]), [])
+            if index_type == "hnsw":
+                self.assertRaises(NotImplementedError, collection.delete, ["2-1-1"])
+                continue
+            collection.delete(["2-1-1"])
+            self.assertEqual(sorted(doc.page_content for doc in collection.similarity_search("b1", k=5, file_ids=["b"])), ["b2", "b3"])
+            collection.add_documents([Document(page_content="c1", metadata={"page": 1, "chunk": 1, "source": "3-1-1", "file_name": "c.txt", "file_id": "c"})])
+            self.assertEqual(collection.similarity_search("c1", k=1)[0].page_content, "c1")
+            self.assertEqual(collection.similarity_search("a1", k=1)[0].page_content, "a1")
+
+
+if __name__ == "__main__":
+    unittest.main()
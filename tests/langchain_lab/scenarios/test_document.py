@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from streamlit.testing.v1 import AppTest
+
+
+def open_after_save():
+    # runs as a streamlit script, where cache_resource keeps values across calls and sessions
+    import streamlit as st
+    from langchain.docstore.document import Document
+    from langchain_community.embeddings import DeterministicFakeEmbedding
+
+    from langchain_lab.core.embedding import embed_docs, save_folder_index
+    from langchain_lab.core.store import ChunkStore
+    from src.langchain_lab.scenarios.document import opening_index
+
+    embedding = DeterministicFakeEmbedding(size=16)
+    missed = opening_index("a.txt", "key", embedding)
+    folder_index = embed_docs(docs=ChunkStore.from_documents([Document(page_content="text", metadata={"source": "1-1"})]), embedding=embedding, vector_store="faiss")
+    save_folder_index(folder_index, "key")
+    opened = opening_index("a.txt", "key", embedding)
+    st.write(f"missed={missed is None} opened={opened.docs.live_count()} shared={opening_index('a.txt', 'key', embedding) is opened}")
+
+
+class TestOpeningIndex(TestCase):
+
+    def test_miss_then_save_then_open(self):
+        with tempfile.TemporaryDirectory() as path, patch.dict(os.environ, {"LANGCHAIN_LAB_CACHE_PATH": path}):
+            app = AppTest.from_function(open_after_save, default_timeout=60).run()
+            self.assertFalse(app.exception)
+            self.assertEqual(app.markdown[-1].value, "missed=True opened=1 shared=True")
+
+
+if __name__ == "__main__":
+    unittest.main()